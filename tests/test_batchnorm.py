@@ -0,0 +1,85 @@
+import copy
+
+import torch
+import torchcvnn.nn.modules as c_nn
+
+from torchtmpl.models.batchnorm import (
+    FusedBatchNorm2d,
+    _FusedBatchNormFunction,
+    compare_training_step,
+    fuse_batchnorms,
+)
+from torchtmpl.models import AutoEncoderWD
+
+
+def batchnorm_pair(num_features=4):
+    torch.manual_seed(0)
+    reference = c_nn.BatchNorm2d(num_features)
+    with torch.no_grad():
+        reference.weight.add_(0.1 * torch.randn_like(reference.weight))
+        reference.bias.add_(0.1 * torch.randn_like(reference.bias))
+    fused = fuse_batchnorms(torch.nn.Sequential(copy.deepcopy(reference)))[0]
+    assert isinstance(fused, FusedBatchNorm2d)
+    return reference, fused
+
+
+def test_fused_batchnorm_gradcheck():
+    torch.manual_seed(0)
+    x = torch.randn(3, 2, 4, 4, 2, dtype=torch.float64, requires_grad=True)
+    weight = torch.eye(2, dtype=torch.float64) + 0.1 * torch.randn(
+        2, 2, 2, dtype=torch.float64
+    )
+    bias = torch.randn(2, 2, dtype=torch.float64)
+
+    def normalize(x, weight, bias):
+        return _FusedBatchNormFunction.apply(x, weight, bias, 1e-5)[0]
+
+    assert torch.autograd.gradcheck(
+        normalize, (x, weight.requires_grad_(), bias.requires_grad_())
+    )
+
+
+def test_fused_batchnorm_matches_torchcvnn_in_training():
+    reference, fused = batchnorm_pair()
+    for _ in range(3):
+        z = 2 * torch.randn(8, 4, 6, 6, dtype=torch.complex64) + 1
+        z_reference = z.clone().requires_grad_()
+        z_fused = z.clone().requires_grad_()
+
+        y_reference, y_fused = reference(z_reference), fused(z_fused)
+        y_reference.abs().square().mean().backward()
+        y_fused.abs().square().mean().backward()
+
+        torch.testing.assert_close(y_fused, y_reference, rtol=1e-4, atol=1e-4)
+        torch.testing.assert_close(z_fused.grad, z_reference.grad, rtol=1e-4, atol=1e-6)
+    for p_fused, p_reference in [
+        (fused.weight, reference.weight),
+        (fused.bias, reference.bias),
+    ]:
+        torch.testing.assert_close(p_fused.grad, p_reference.grad, rtol=1e-4, atol=1e-5)
+    torch.testing.assert_close(fused.running_mean, reference.running_mean)
+    torch.testing.assert_close(fused.running_var, reference.running_var)
+
+
+def test_fused_batchnorm_matches_torchcvnn_in_eval():
+    reference, fused = batchnorm_pair()
+    with torch.no_grad():
+        reference(torch.randn(8, 4, 6, 6, dtype=torch.complex64))
+    fused.load_state_dict(reference.state_dict())
+    reference.eval()
+    fused.eval()
+
+    z = torch.randn(8, 4, 6, 6, dtype=torch.complex64)
+    with torch.no_grad():
+        torch.testing.assert_close(fused(z), reference(z), rtol=1e-4, atol=1e-4)
+
+
+def test_compare_training_step_of_the_autoencoder():
+    torch.manual_seed(0)
+    model = AutoEncoderWD(3, 2, 2, 8, 16, c_nn.modReLU())
+    inputs = torch.randn(4, 3, 16, 16, dtype=torch.complex64)
+
+    report = compare_training_step(model, inputs, repeats=1)
+
+    assert report["output_max_abs_error"] < 1e-4
+    assert report["grad_max_abs_error"] < 1e-4
@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+from torchtmpl import losses
+
+
+def complex_randn(*shape, dtype=torch.complex64):
+    return torch.randn(*shape, dtype=dtype)
+
+
+def latent_statistics(dtype=torch.complex64):
+    # sigma > |delta| keeps the determinant of the latent covariances positive
+    real_dtype = torch.empty(0, dtype=dtype).real.dtype
+    mu = complex_randn(4, 8, dtype=dtype)
+    delta = 0.5 * complex_randn(4, 8, dtype=dtype)
+    sigma = delta.abs() + torch.rand(4, 8, dtype=real_dtype) + 0.1
+    return mu, sigma, delta
+
+
+@pytest.mark.parametrize(
+    "reference, candidate, vae",
+    [
+        (
+            losses.ComplexAmplitudePhaseError(),
+            losses.FusedComplexAmplitudePhaseError(),
+            False,
+        ),
+        (losses.ComplexVAELoss(), losses.FusedComplexVAELoss(), True),
+        (losses.ComplexVAEPhaseLoss(), losses.FusedComplexVAEPhaseLoss(), True),
+    ],
+)
+def test_fused_losses_match_the_reference(reference, candidate, vae):
+    torch.manual_seed(0)
+    x, recon_x = complex_randn(2, 3, 16, 16), complex_randn(2, 3, 16, 16)
+    inputs = (x, recon_x) + (latent_statistics() + (0.1,) if vae else ())
+
+    report = losses.compare_losses(reference, candidate, inputs, repeats=1)
+
+    assert report["value_error"] < 1e-5
+    assert max(report["grad_errors"]) < 1e-5
+
+
+def test_amplitude_phase_error_gradcheck():
+    torch.manual_seed(0)
+    y_true = complex_randn(2, 3, 4, 4, dtype=torch.complex128).requires_grad_()
+    y_pred = complex_randn(2, 3, 4, 4, dtype=torch.complex128).requires_grad_()
+
+    assert torch.autograd.gradcheck(
+        losses.AmplitudePhaseErrorFunction.apply, (y_true, y_pred)
+    )
+
+
+def test_complex_gaussian_kl_gradcheck():
+    torch.manual_seed(0)
+    inputs = tuple(t.requires_grad_() for t in latent_statistics(torch.complex128))
+
+    assert torch.autograd.gradcheck(losses.ComplexGaussianKLFunction.apply, inputs)
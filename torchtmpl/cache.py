@@ -0,0 +1,228 @@
+# coding: utf-8
+
+# Standard imports
+import hashlib
+import json
+import os
+import pathlib
+
+# External imports
+import numpy as np
+import torch
+
+
+def model_fingerprint(model, settings):
+    """
+    Hashes the weights and buffers of the model with the inference settings,
+    so that the tiles reconstructed by another checkpoint, or with other
+    settings, never match
+
+    Arguments:
+        model: the model whose state_dict is hashed
+        settings: a json serializable dictionnary of the inference settings
+
+    Returns:
+        The hexadecimal sha256 digest
+    """
+    digest = hashlib.sha256()
+    digest.update(type(model).__name__.encode())
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    for name, tensor in sorted(model.state_dict().items()):
+        tensor = tensor.detach().cpu().contiguous()
+        digest.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+        digest.update(tensor.view(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+class TileCache:
+    """
+    On-disk cache of the reconstructed tiles, shared across runs.
+
+    A tile is stored in root/<key[:2]>/<key>.npy, its key hashing the
+    fingerprint of the model and the content of the input tile, so that
+    overlapping crops and repeated evaluations of a checkpoint reuse the
+    tiles already reconstructed. The total size of the cache is capped by
+    max_bytes, the least recently used tiles being evicted first. The recency
+    of a tile is its modification time, refreshed at every hit, so that it
+    persists across runs.
+    """
+
+    def __init__(self, root, fingerprint, max_bytes):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.fingerprint = fingerprint.encode()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # path -> (recency, size) of the tiles already in the cache
+        self.entries = {}
+        for path in self.root.glob("*/*.npy"):
+            stat = path.stat()
+            self.entries[path] = (stat.st_mtime_ns, stat.st_size)
+        self.total_bytes = sum(size for _, size in self.entries.values())
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def key(self, tile):
+        """Returns the key of an input tile, as a numpy array"""
+        digest = hashlib.sha256(self.fingerprint)
+        digest.update(f"{tile.dtype}:{tile.shape}".encode())
+        digest.update(np.ascontiguousarray(tile).tobytes())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return self.root / key[:2] / f"{key}.npy"
+
+    def get(self, key):
+        """Returns the cached reconstruction of the key, None if it is missing"""
+        path = self.path(key)
+        try:
+            tile = np.load(path)
+        except (FileNotFoundError, ValueError, EOFError):
+            # Missing, evicted by another process or partially written
+            return None
+        os.utime(path)
+        stat = path.stat()
+        if path not in self.entries:
+            # Written by another process
+            self.total_bytes += stat.st_size
+        self.entries[path] = (stat.st_mtime_ns, stat.st_size)
+        return tile
+
+    def put(self, key, tile):
+        """Stores the reconstruction of the key, evicting the least recently used tiles"""
+        path = self.path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.save(f, tile)
+        os.replace(tmp_path, path)
+        stat = path.stat()
+        self.total_bytes += stat.st_size - self.entries.get(path, (0, 0))[1]
+        self.entries[path] = (stat.st_mtime_ns, stat.st_size)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used tiles until the cache fits in max_bytes"""
+        by_recency = sorted(self.entries.items(), key=lambda item: item[1][0])
+        for path, (_, size) in by_recency:
+            if self.total_bytes <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            del self.entries[path]
+            self.total_bytes -= size
+            self.evictions += 1
+
+    def forward(self, model, inputs):
+        """
+        Reconstructs a batch of tiles, only the tiles missing from the cache
+        going through the model. The model must be in eval mode, every tile
+        being then reconstructed independently of the others of the batch.
+
+        Arguments:
+            model: the model the fingerprint was computed on
+            inputs: the (B, C, H, W) batch of input tiles
+
+        Returns:
+            The (B, C, H, W) reconstructions, on the device of the inputs
+        """
+        keys = [self.key(tile) for tile in inputs.cpu().numpy()]
+        outputs = [self.get(key) for key in keys]
+        missing = [index for index, output in enumerate(outputs) if output is None]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            reconstructions = model(inputs[missing]).cpu().numpy()
+            for index, reconstruction in zip(missing, reconstructions):
+                self.put(keys[index], reconstruction)
+                outputs[index] = reconstruction
+        return torch.from_numpy(np.stack(outputs)).to(inputs.device)
+
+    def stats(self):
+        """
+        Returns:
+            The json serializable dictionnary of the hits, misses and size of the cache
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / max(self.hits + self.misses, 1),
+            "evictions": self.evictions,
+            "num_tiles": len(self.entries),
+            "size_bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+# The keys of the data section which do not change the scene nor its transform
+RUNTIME_DATA_KEYS = ("batch_size", "in_memory", "num_workers", "shards", "valid_ratio")
+
+
+def data_fingerprint(data_config):
+    """
+    Returns:
+        The hexadecimal sha256 digest of the data section, without its runtime keys
+    """
+    scene_config = {
+        key: value for key, value in data_config.items() if key not in RUNTIME_DATA_KEYS
+    }
+    digest = hashlib.sha256(json.dumps(scene_config, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class DecompositionCache:
+    """
+    On-disk cache of the ground truth of a scene: its decompositions, its
+    equalization bounds and its class maps, which only depend on the data
+    section of the configuration and not on the checkpoint. They are stored
+    as root/<data fingerprint>/<name>.npz, the data section being saved
+    alongside in data_config.json.
+    """
+
+    def __init__(self, root, data_config):
+        self.root = pathlib.Path(root) / data_fingerprint(data_config)
+        self.root.mkdir(parents=True, exist_ok=True)
+        with open(self.root / "data_config.json", "w") as f:
+            json.dump(data_config, f, indent=2, default=str)
+        self.hits = []
+        self.misses = []
+
+    def get(self, name, compute):
+        """
+        Returns the cached value of name, computing and storing it with
+        compute() on a miss
+
+        Arguments:
+            name: the name of the value, unique within the scene
+            compute: a function returning a numpy array, or a tuple of them
+
+        Returns:
+            The array, or the tuple of arrays, returned by compute
+        """
+        path = self.root / f"{name}.npz"
+        if path.exists():
+            self.hits.append(name)
+            with np.load(path) as f:
+                if "value" in f.files:
+                    return f["value"]
+                return tuple(f[f"arr_{index}"] for index in range(len(f.files)))
+
+        self.misses.append(name)
+        value = compute()
+        tmp_path = self.root / f"{name}.{os.getpid()}.tmp.npz"
+        if isinstance(value, tuple):
+            np.savez(tmp_path, *value)
+        else:
+            np.savez(tmp_path, value=value)
+        os.replace(tmp_path, path)
+        return value
+
+    def stats(self):
+        """
+        Returns:
+            The json serializable dictionnary of the cached and computed values
+        """
+        return {"root": str(self.root), "hits": self.hits, "misses": self.misses}
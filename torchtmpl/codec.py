@@ -0,0 +1,280 @@
+# coding: utf-8
+
+# Standard imports
+import copy
+import json
+import lzma
+import struct
+import time
+import zlib
+
+# External imports
+import numpy as np
+import torch
+
+# Local imports
+from . import data as dt
+
+MAGIC = b"AELC\x01"
+COMPRESSIONS = {
+    "zlib": (lambda raw: zlib.compress(raw, 9), zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+
+def quantize(latents, bits):
+    """
+    Uniform scalar quantization of the real and imaginary parts of a batch of
+    (B, C, h, w) complex latents, with one scale per tile and channel
+
+    Returns:
+        the (B, C) float32 scales and the (B, C, h, w, 2) integer codes
+    """
+    qmax = 2 ** (bits - 1) - 1
+    pairs = torch.view_as_real(latents)
+    scales = pairs.abs().amax(dim=(2, 3, 4)) / qmax
+    scales = torch.where(scales > 0, scales, torch.ones_like(scales))
+    codes = torch.round(pairs / scales[:, :, None, None, None]).clamp(-qmax, qmax)
+    dtype = torch.int8 if bits <= 8 else torch.int16
+    return scales.float(), codes.to(dtype)
+
+
+def dequantize(scales, codes):
+    return torch.view_as_complex(
+        codes.float() * scales[:, :, None, None, None]
+    ).contiguous()
+
+
+class SceneCodec:
+    """
+    Compresses whole scenes with the encoder of an AutoEncoderWD.
+
+    The scene is split into non overlapping tiles of the size the model was
+    trained on, encoded in batches, and the latents of every tile are
+    quantized and entropy coded into their own chunk. The chunks are indexed
+    so that any window of the scene can be decoded from the tiles covering it.
+
+    The file is laid out as MAGIC, the tile chunks, the JSON index and the
+    8 bytes offset of the index.
+
+    Arguments:
+        model: the trained model, exposing encode and decode
+        tile_size: the side of the tiles, a multiple of the downsampling factor of the model
+        batch_size: the number of tiles encoded or decoded at once
+        bits: the number of bits of the quantized latents, at most 16
+        compression: the entropy coder of the chunks, "zlib" or "lzma"
+        device: the device on which to run the model
+    """
+
+    def __init__(
+        self,
+        model,
+        tile_size,
+        batch_size=64,
+        bits=8,
+        compression="zlib",
+        device=torch.device("cpu"),
+    ):
+        if compression not in COMPRESSIONS:
+            raise ValueError(
+                f"Unknown compression {compression}, expected one of {list(COMPRESSIONS)}"
+            )
+        if not 2 <= bits <= 16:
+            raise ValueError(f"Cannot quantize on {bits} bits")
+        self.model = copy.deepcopy(model).to(device).eval()
+        self.tile_size = tile_size
+        self.batch_size = batch_size
+        self.bits = bits
+        self.compression = compression
+        self.device = device
+
+    def compress(self, scene, path):
+        """
+        Compresses the (C, H, W) complex scene, in the domain of the model inputs,
+        into the file path
+
+        Returns:
+            The report of the compression ratio and of the encoding throughput
+        """
+        start_time = time.perf_counter()
+        scene = torch.as_tensor(scene)
+        num_channels, num_rows, num_cols = scene.shape
+        tile = self.tile_size
+        grid = (-(-num_rows // tile), -(-num_cols // tile))
+
+        # The scene is padded up to a whole number of tiles by replicating its borders
+        padded = np.pad(
+            scene.numpy(),
+            ((0, 0), (0, grid[0] * tile - num_rows), (0, grid[1] * tile - num_cols)),
+            mode="edge",
+        )
+        patches = dt.InMemoryPatches(torch.from_numpy(padded), (tile, tile), (tile, tile))
+        encode, _ = COMPRESSIONS[self.compression]
+
+        tiles = []
+        latent_shape = None
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+            offset = len(MAGIC)
+            with torch.no_grad():
+                for indices in torch.arange(len(patches)).split(self.batch_size):
+                    inputs = patches.gather(indices).to(self.device)
+                    latents = self.model.encode(inputs).cpu()
+                    latent_shape = list(latents.shape[1:])
+                    scales, codes = quantize(latents, self.bits)
+                    for scale, code in zip(scales, codes):
+                        chunk = encode(scale.numpy().tobytes() + code.numpy().tobytes())
+                        f.write(chunk)
+                        tiles.append([offset, len(chunk)])
+                        offset += len(chunk)
+
+            index = {
+                "shape": [num_channels, num_rows, num_cols],
+                "tile_size": tile,
+                "grid": list(grid),
+                "latent_shape": latent_shape,
+                "bits": self.bits,
+                "compression": self.compression,
+                "tiles": tiles,
+            }
+            f.write(json.dumps(index).encode("utf-8"))
+            f.write(struct.pack("<Q", offset))
+            file_size = f.tell()
+
+        elapsed = time.perf_counter() - start_time
+        raw_size = scene.numel() * scene.element_size()
+        return {
+            "raw_bytes": raw_size,
+            "compressed_bytes": file_size,
+            "compression_ratio": raw_size / file_size,
+            "bits_per_pixel": 8 * file_size / (num_rows * num_cols),
+            "num_tiles": len(tiles),
+            "encode_seconds": elapsed,
+            "encode_mpixels_per_second": num_rows * num_cols / elapsed / 1e6,
+        }
+
+    def open(self, path):
+        return CompressedScene(path, self.model, self.batch_size, self.device)
+
+
+class CompressedScene:
+    """
+    Random access reader of a scene compressed by SceneCodec
+
+    Arguments:
+        path: the compressed file
+        model: the model whose decoder produced the latents
+        batch_size: the number of tiles decoded at once
+        device: the device on which to run the decoder
+    """
+
+    def __init__(self, path, model, batch_size=64, device=torch.device("cpu")):
+        self.path = path
+        self.model = copy.deepcopy(model).to(device).eval()
+        self.batch_size = batch_size
+        self.device = device
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a compressed scene")
+            f.seek(-8, 2)
+            end = f.tell()
+            (index_offset,) = struct.unpack("<Q", f.read(8))
+            f.seek(index_offset)
+            self.index = json.loads(f.read(end - index_offset).decode("utf-8"))
+        self.shape = tuple(self.index["shape"])
+        self.tile_size = self.index["tile_size"]
+        self.grid = tuple(self.index["grid"])
+
+    def _read_latents(self, f, tile_indices):
+        _, decode = COMPRESSIONS[self.index["compression"]]
+        num_channels = self.index["latent_shape"][0]
+        dtype = np.int8 if self.index["bits"] <= 8 else np.int16
+        scales, codes = [], []
+        for idx in tile_indices:
+            offset, length = self.index["tiles"][idx]
+            f.seek(offset)
+            raw = decode(f.read(length))
+            scales.append(np.frombuffer(raw[: 4 * num_channels], dtype=np.float32))
+            codes.append(
+                np.frombuffer(raw[4 * num_channels :], dtype=dtype).reshape(
+                    *self.index["latent_shape"], 2
+                )
+            )
+        return dequantize(
+            torch.from_numpy(np.stack(scales)), torch.from_numpy(np.stack(codes))
+        )
+
+    def read_window(self, start_row, start_col, num_rows, num_cols):
+        """
+        Decodes the (C, num_rows, num_cols) window of the scene starting at
+        (start_row, start_col), decoding only the tiles covering it
+        """
+        if (
+            start_row < 0
+            or start_col < 0
+            or start_row + num_rows > self.shape[1]
+            or start_col + num_cols > self.shape[2]
+        ):
+            raise ValueError("The window exceeds the scene")
+
+        tile = self.tile_size
+        first_row, last_row = start_row // tile, (start_row + num_rows - 1) // tile
+        first_col, last_col = start_col // tile, (start_col + num_cols - 1) // tile
+        tile_indices = [
+            r * self.grid[1] + c
+            for r in range(first_row, last_row + 1)
+            for c in range(first_col, last_col + 1)
+        ]
+
+        decoded = []
+        with open(self.path, "rb") as f, torch.no_grad():
+            for start in range(0, len(tile_indices), self.batch_size):
+                latents = self._read_latents(
+                    f, tile_indices[start : start + self.batch_size]
+                )
+                decoded.append(self.model.decode(latents.to(self.device)).cpu())
+        decoded = torch.cat(decoded)
+
+        # Assemble the covering tiles and crop the window out of them
+        nrows, ncols = last_row - first_row + 1, last_col - first_col + 1
+        mosaic = (
+            decoded.reshape(nrows, ncols, self.shape[0], tile, tile)
+            .permute(2, 0, 3, 1, 4)
+            .reshape(self.shape[0], nrows * tile, ncols * tile)
+        )
+        row, col = start_row - first_row * tile, start_col - first_col * tile
+        return mosaic[:, row : row + num_rows, col : col + num_cols].contiguous()
+
+    def read(self):
+        """Decodes the whole scene"""
+        return self.read_window(0, 0, self.shape[1], self.shape[2])
+
+
+def benchmark_codec(codec, scene, path, window_size=256, num_windows=10):
+    """
+    Compresses the scene and measures the decoding throughput of the whole
+    scene and of random windows
+
+    Returns:
+        The report of compress, completed with the decoding throughputs
+    """
+    report = codec.compress(scene, path)
+    reader = codec.open(path)
+    num_rows, num_cols = reader.shape[1:]
+
+    start_time = time.perf_counter()
+    reader.read()
+    elapsed = time.perf_counter() - start_time
+    report["decode_seconds"] = elapsed
+    report["decode_mpixels_per_second"] = num_rows * num_cols / elapsed / 1e6
+
+    window_rows, window_cols = min(window_size, num_rows), min(window_size, num_cols)
+    rng = np.random.default_rng(0)
+    start_time = time.perf_counter()
+    for _ in range(num_windows):
+        row = int(rng.integers(0, num_rows - window_rows + 1))
+        col = int(rng.integers(0, num_cols - window_cols + 1))
+        reader.read_window(row, col, window_rows, window_cols)
+    report["window_size"] = [window_rows, window_cols]
+    report["window_decode_ms"] = 1e3 * (time.perf_counter() - start_time) / num_windows
+    return report
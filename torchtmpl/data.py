@@ -6,9 +6,16 @@ import random
 from scipy.linalg import eigh
 from numpy import linalg as LA
 import os
+import concurrent.futures
+import io
+import json
+import hashlib
 import glob
 import shutil
+import tempfile
+import math
 import pathlib
+import tqdm
 from matplotlib.colors import ListedColormap, BoundaryNorm
 import matplotlib.patches as mpatches
 from sklearn.metrics import confusion_matrix, accuracy_score
@@ -21,6 +28,8 @@ from torchvision import transforms
 
 from torchcvnn.datasets import ALOSDataset, PolSFDataset, Bretigny
 
+from . import execution
+
 
 class LogAmplitudeTransform:
     def __init__(self, characteristics):
@@ -461,11 +470,67 @@ def exp_amplitude_transform(tensor):
     return new_tensor
 
 
-def equalize(image, p2=None, p98=None):
+def histogram_quantiles(counts, edges, quantiles):
+    """
+    Estimates quantiles from a fixed-bin histogram, by linear interpolation
+    within the bin holding every quantile
+    """
+    cumulative = np.concatenate(([0], np.cumsum(counts)))
+    if cumulative[-1] == 0:
+        return [float("nan") for _ in quantiles]
+    return [
+        float(np.interp(q * cumulative[-1], cumulative, edges)) for q in quantiles
+    ]
+
+
+class LogAmplitudeHistogram:
+    """
+    Fixed-bin histogram of log10(|image|), accumulated chunk by chunk, from
+    which the percentiles of the equalization are estimated in linear time.
+    The values outside of log_range fall in the first or the last bin.
+
+    Arguments:
+        bins: the number of bins
+        log_range: the (min, max) of log10(|image|) covered by the bins
+    """
+
+    def __init__(self, bins=4096, log_range=(-8.0, 8.0)):
+        self.edges = np.linspace(log_range[0], log_range[1], bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    def update(self, image, subsample=1):
+        """Accumulates the image, keeping one pixel every `subsample` along its two first axes"""
+        img = np.log10(np.abs(image[::subsample, ::subsample]))
+        bins = len(self.counts)
+        scale = bins / (self.edges[-1] - self.edges[0])
+        indices = np.clip(
+            np.nan_to_num((img - self.edges[0]) * scale, neginf=0, posinf=bins - 1),
+            0,
+            bins - 1,
+        ).astype(np.int64)
+        self.counts += np.bincount(indices.ravel(), minlength=bins)
+
+    def percentiles(self, q):
+        return histogram_quantiles(self.counts, self.edges, [p / 100 for p in q])
+
+
+def equalize(
+    image, p2=None, p98=None, method="percentile", subsample=1, chunk_rows=512
+):
     """
     Automatically adjust contrast of the SAR image
     Input: intensity or amplitude in dB scale
+
+    With method="histogram", the percentiles are estimated from a
+    LogAmplitudeHistogram accumulated over chunks of chunk_rows rows, keeping
+    one pixel every `subsample`, and the mapping to uint8 is applied chunk by
+    chunk, which avoids sorting and copying the whole image
     """
+    if method == "histogram":
+        return _equalize_histogram(image, p2, p98, subsample, chunk_rows)
+    if method != "percentile":
+        raise ValueError(f"Unknown equalization method {method}")
+
     img = np.log10(np.abs(image))
     if not p2:
         p2, p98 = np.percentile(img, (2, 98))
@@ -476,6 +541,27 @@ def equalize(image, p2=None, p98=None):
     return img_resc, (p2, p98)
 
 
+def _equalize_histogram(image, p2, p98, subsample, chunk_rows):
+    num_rows = image.shape[0]
+    if p2 is None:
+        histogram = LogAmplitudeHistogram()
+        # The chunks start on a multiple of subsample to keep the subsampling grid
+        step = max(chunk_rows // subsample, 1) * subsample
+        for row in range(0, num_rows, step):
+            histogram.update(image[row : row + step], subsample)
+        p2, p98 = histogram.percentiles((2, 98))
+
+    scale = 1.0 / (p98 - p2) if p98 > p2 else 0.0
+    img_resc = np.empty(image.shape, dtype=np.uint8)
+    for row in range(0, num_rows, chunk_rows):
+        img = np.log10(np.abs(image[row : row + chunk_rows]))
+        img_resc[row : row + chunk_rows] = np.round(
+            np.clip((img - p2) * scale, 0, 1) * 255
+        )
+
+    return img_resc, (p2, p98)
+
+
 def angular_distance(image1, image2):
     """
     Compute the angular distance between two phase angles, phase1 and phase2, with results in [-pi, pi].
@@ -538,28 +624,59 @@ def plot_fourier_transform_amplitude_phase(image):
 ### As input it takes the image of stacked up covariances, and a mask of classes.
 
 
+class ClassStatistics:
+    """
+    Counts, means and second moments of the stacked covariances of every
+    H-alpha class, accumulated in one pass per tile with bincount and index_add,
+    so that scenes larger than the memory can be processed tile by tile.
+
+    Arguments:
+        dim: the number of entries of the stacked covariances, i.e. p * p
+        num_classes: the number of labels, the classes being 0 to num_classes - 1
+    """
+
+    def __init__(self, dim, num_classes=10):
+        self.counts = torch.zeros(num_classes, dtype=torch.int64)
+        self.sums = torch.zeros((num_classes, dim), dtype=torch.complex128)
+        self.squared_sums = torch.zeros((num_classes, dim), dtype=torch.float64)
+
+    def update(self, image_of_stacked_covariances, classes_H_alpha):
+        """
+        Accumulates the (H, W, p * p) stacked covariances of a tile given its
+        (H, W) H-alpha classes
+        """
+        covariances = torch.as_tensor(
+            np.reshape(image_of_stacked_covariances, (-1, self.sums.shape[1]))
+        ).to(torch.complex128)
+        labels = torch.as_tensor(np.reshape(classes_H_alpha, -1)).long()
+        self.counts += torch.bincount(labels, minlength=len(self.counts))
+        self.sums.index_add_(0, labels, covariances)
+        self.squared_sums.index_add_(0, labels, covariances.abs().square())
+
+    def means(self):
+        """Returns the (num_classes, p * p) means, null for the empty classes"""
+        return self.sums / self.counts.clamp(min=1)[:, None]
+
+    def variances(self):
+        """Returns the (num_classes, p * p) variances of the entries of the covariances"""
+        return (
+            self.squared_sums / self.counts.clamp(min=1)[:, None]
+            - self.means().abs().square()
+        )
+
+
 def calculate_means_of_classes(image_of_stacked_covariances, classes_H_alpha):
 
     list_of_classes = [1, 2, 4, 5, 6, 7, 8, 9]  ### class 3 is not possible
-    dictionary_of_means = {}
 
+    ### All the class sums and counts are computed in a single pass over the pixels
+    statistics = ClassStatistics(image_of_stacked_covariances.shape[-1])
+    statistics.update(image_of_stacked_covariances, classes_H_alpha)
+    means = statistics.means().numpy()
+
+    dictionary_of_means = {}
     for k in list_of_classes:
-        ### Create a mask for the image which is TRUE where a pixel belongs to the class, and FALSE otherwise.
-        mask = classes_H_alpha == k
-        size_of_mask_1, size_of_mask_2 = mask.shape
-        mask = np.reshape(mask, (size_of_mask_1, size_of_mask_2, 1))
-        ### Multiply image with mask, i.e. all pixels/covariances not belonging to the initial class k will be set to zero.
-        cov_times_mask = image_of_stacked_covariances * mask
-        cov_times_mask = np.reshape(
-            cov_times_mask,
-            (
-                cov_times_mask.shape[0] * cov_times_mask.shape[1],
-                cov_times_mask.shape[2],
-            ),
-        )
-        ### Since all other entries are set to zero, taking the mean over the whole image equals the mean of just class k.
-        mean_of_class = np.mean(cov_times_mask, axis=0)
-        dictionary_of_means["mean" + str(k)] = mean_of_class
+        dictionary_of_means["mean" + str(k)] = means[k]
 
     return dictionary_of_means
 
@@ -644,7 +761,357 @@ def h_alpha(pauli_radar_image):
     return classes_H_alpha_original
 
 
-def show_images(samples, generated, image_path, last=False):
+def chunked_map(
+    function,
+    image,
+    halo,
+    num_workers=None,
+    chunk_rows=256,
+    executor="process",
+    out=None,
+):
+    """
+    Applies a windowed function to blocks of rows of the image in parallel.
+
+    The function maps a (h, W, ...) block to its (h - 2 halo, W - 2 halo, ...)
+    valid output, as h_alpha does with halo = 3 for its 7x7 window. Every block
+    is therefore given `halo` rows of its neighbours on both sides, and the
+    outputs are written in a preallocated (H - 2 halo, W - 2 halo, ...) result,
+    identical to the one of function(image).
+
+    Arguments:
+        function: the function, picklable with the process executor
+        image: the (H, W, ...) image
+        halo: the number of rows on every side of a block needed by the function
+        num_workers: the number of workers, by default the number of cores
+                     available to the process
+        chunk_rows: the number of output rows of every block
+        executor: "process" for the functions holding the GIL, as h_alpha,
+                  "thread" for the vectorized ones
+        out: an optional preallocated result, e.g. a memory map, so that the
+             whole result never needs to fit in memory
+
+    Returns:
+        The result, out if it is given
+    """
+    num_rows = image.shape[0] - 2 * halo
+    starts = list(range(0, num_rows, chunk_rows))
+    num_workers = num_workers or len(os.sched_getaffinity(0))
+    if out is None and (len(starts) == 1 or num_workers == 1):
+        return function(image)
+
+    pool = {
+        "process": concurrent.futures.ProcessPoolExecutor,
+        "thread": concurrent.futures.ThreadPoolExecutor,
+    }[executor]
+    result = out
+    with pool(max_workers=num_workers) as workers:
+        futures = {
+            workers.submit(
+                function, image[start : min(start + chunk_rows, num_rows) + 2 * halo]
+            ): start
+            for start in starts
+        }
+        for future in concurrent.futures.as_completed(futures):
+            block = future.result()
+            if result is None:
+                result = np.empty((num_rows,) + block.shape[1:], dtype=block.dtype)
+            start = futures[future]
+            result[start : start + len(block)] = block
+    return result
+
+
+def _vectorized_h_alpha(pauli_radar_image):
+    return h_alpha_classes(local_covariances(pauli_radar_image))
+
+
+def parallel_h_alpha(
+    pauli_radar_image, num_workers=None, chunk_rows=256, vectorized=True
+):
+    """
+    h_alpha computed on blocks of rows with a 3 pixels halo, in a thread pool
+    with the vectorized decomposition, or in a process pool with the per pixel
+    loop of h_alpha
+    """
+    if vectorized:
+        return chunked_map(
+            _vectorized_h_alpha,
+            pauli_radar_image,
+            halo=3,
+            num_workers=num_workers,
+            chunk_rows=chunk_rows,
+            executor="thread",
+        )
+    return chunked_map(
+        h_alpha,
+        pauli_radar_image,
+        halo=3,
+        num_workers=num_workers,
+        chunk_rows=chunk_rows,
+        executor="process",
+    )
+
+
+def local_covariances(pauli_radar_image, son=7):
+    """
+    Vectorized local empirical covariances of h_alpha: the (H, W, p) image
+    gives the (H - son + 1, W - son + 1, p, p) mean of conj(k) k^T over the
+    son x son window of every pixel, the window sums being separable
+    """
+    k = np.asarray(pauli_radar_image, dtype=np.complex128)
+    outer = np.conjugate(k)[..., :, None] * k[..., None, :]
+    sums = np.lib.stride_tricks.sliding_window_view(outer, son, axis=0).sum(axis=-1)
+    sums = np.lib.stride_tricks.sliding_window_view(sums, son, axis=1).sum(axis=-1)
+    return sums / (son**2)
+
+
+def h_alpha_classes(covariances):
+    """
+    Vectorized H-alpha classes of h_alpha, from a (..., 3, 3) stack of
+    local covariances
+    """
+    eigenvalues, eigenvectors = LA.eigh(covariances)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p_vector = eigenvalues / np.sum(eigenvalues, axis=-1, keepdims=True)
+        H = -np.sum(p_vector * np.log(p_vector), axis=-1)
+    H = np.where(np.isnan(H), 0, np.minimum(H, 1.0))
+    alpha_vector = np.arccos(np.abs(eigenvectors[..., 0, :]))
+    alpha = np.minimum(np.sum(p_vector * alpha_vector, axis=-1) * (180.0 / np.pi), 90)
+
+    conditions = [
+        (H <= 0.5) & (alpha <= 42.5),
+        (H <= 0.5) & (alpha <= 47.5),
+        (H <= 0.5) & (alpha <= 90),
+        (H > 0.5) & (H <= 0.9) & (alpha <= 40),
+        (H > 0.5) & (H <= 0.9) & (alpha <= 50),
+        (H > 0.5) & (H <= 0.9) & (alpha <= 90),
+        (H > 0.9) & (alpha <= 55),
+        (H > 0.9) & (alpha <= 90),
+    ]
+    return np.select(conditions, [9, 8, 7, 6, 5, 4, 2, 1], default=0)
+
+
+class WishartClassifier:
+    """
+    Complex Wishart k-means of the local covariances, initialized from the
+    H-alpha classes. A covariance C is assigned to the center S_k minimizing
+    the Wishart distance ln|S_k| + tr(S_k^-1 C), computed for all the centers at
+    once over chunks of covariances, and the centers are then updated to the
+    means of their classes.
+
+    Arguments:
+        max_iterations: the maximal number of passes over the covariances
+        tol: the fraction of changed labels under which the iterations stop
+        chunk_size: the number of covariances processed at once
+    """
+
+    def __init__(self, max_iterations=10, tol=1e-3, chunk_size=65536):
+        self.max_iterations = max_iterations
+        self.tol = tol
+        self.chunk_size = chunk_size
+        self.classes = None
+        self.centers = None
+        self.num_iterations = 0
+
+    def _set_centers(self, statistics):
+        classes = torch.nonzero(statistics.counts).squeeze(1)
+        p = int(np.sqrt(statistics.sums.shape[1]))
+        self.set_centers(classes, statistics.means()[classes].reshape(-1, p, p))
+
+    def set_centers(self, classes, centers):
+        """Sets the (K,) classes and their (K, p, p) centers, e.g. of a previous fit"""
+        self.classes = torch.as_tensor(classes)
+        self.centers = torch.as_tensor(centers)
+        self.inverse_centers = torch.linalg.inv(self.centers)
+        self.log_determinants = torch.linalg.slogdet(self.centers)[1]
+
+    def _statistics(self, covariances, labels):
+        statistics = ClassStatistics(covariances.shape[-1] ** 2)
+        for start in range(0, len(covariances), self.chunk_size):
+            chunk = covariances[start : start + self.chunk_size]
+            statistics.update(
+                chunk.reshape(len(chunk), -1), labels[start : start + self.chunk_size]
+            )
+        return statistics
+
+    def distances(self, covariances):
+        """Returns the (N, K) Wishart distances of the (N, p, p) covariances to the K centers"""
+        covariances = torch.as_tensor(covariances).to(torch.complex128)
+        traces = torch.einsum("kij,nji->nk", self.inverse_centers, covariances).real
+        return self.log_determinants[None, :] + traces
+
+    def predict(self, covariances):
+        """Returns the H-alpha like labels of the (N, p, p) covariances"""
+        labels = []
+        for start in range(0, len(covariances), self.chunk_size):
+            distances = self.distances(covariances[start : start + self.chunk_size])
+            labels.append(self.classes[distances.argmin(dim=1)])
+        return torch.cat(labels).numpy()
+
+    def fit(self, covariances, labels=None):
+        """
+        Iterates the Wishart k-means over the (N, p, p) covariances, which can
+        be a memory mapped array
+
+        Arguments:
+            covariances: the (N, p, p) local covariances
+            labels: the (N,) initial classes, by default the H-alpha classes
+
+        Returns:
+            The (N,) final classes
+        """
+        if labels is None:
+            labels = np.concatenate(
+                [
+                    h_alpha_classes(covariances[start : start + self.chunk_size])
+                    for start in range(0, len(covariances), self.chunk_size)
+                ]
+            )
+        self._set_centers(self._statistics(covariances, labels))
+
+        for self.num_iterations in range(1, self.max_iterations + 1):
+            new_labels = self.predict(covariances)
+            changed = np.count_nonzero(new_labels != labels) / len(labels)
+            labels = new_labels
+            self._set_centers(self._statistics(covariances, labels))
+            logging.info(
+                f"  - Wishart iteration {self.num_iterations} : {100 * changed:.2f}% of the labels changed"
+            )
+            if changed < self.tol:
+                break
+        return labels
+
+
+def wishart_fidelity(
+    original,
+    generated,
+    max_iterations=10,
+    chunk_size=65536,
+    chunk_rows=256,
+    decompositions=None,
+):
+    """
+    Compares the Wishart classes of an original and a generated scene: the
+    classifier is fitted on the original scene, and the generated scene is
+    classified with the same centers
+
+    The local covariances are computed by blocks of chunk_rows rows with a 3
+    pixels halo. Those of the original scene, visited at every iteration of
+    the fit, are streamed into a temporary memory map, and those of the
+    generated scene are classified block by block, so that the whole scene
+    covariances are never held in memory.
+
+    Arguments:
+        original: the (C, H, W) original scene, in the physical domain
+        generated: the (C, H, W) generated scene
+        decompositions: an optional DecompositionCache of the original scene,
+                        holding the fit of the classifier
+
+    Returns:
+        A dictionnary of the agreement of the classes and of the confusion counts
+    """
+    classifier = WishartClassifier(max_iterations=max_iterations, chunk_size=chunk_size)
+
+    def fit():
+        pauli = pauli_transform(original).transpose(1, 2, 0)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            covariances = np.lib.format.open_memmap(
+                pathlib.Path(tmpdir) / "covariances.npy",
+                mode="w+",
+                dtype=np.complex128,
+                shape=(pauli.shape[0] - 6, pauli.shape[1] - 6, 3, 3),
+            )
+            chunked_map(
+                local_covariances,
+                pauli,
+                halo=3,
+                chunk_rows=chunk_rows,
+                executor="thread",
+                out=covariances,
+            )
+            labels = classifier.fit(covariances.reshape(-1, 3, 3))
+            del covariances
+        return (
+            labels,
+            classifier.classes.numpy(),
+            classifier.centers.numpy(),
+            np.array(classifier.num_iterations),
+        )
+
+    if decompositions is not None:
+        labels_original, classes, centers, num_iterations = decompositions.get(
+            f"wishart_{max_iterations}", fit
+        )
+        classifier.set_centers(classes, centers)
+        classifier.num_iterations = int(num_iterations)
+    else:
+        labels_original = fit()[0]
+
+    def predict(block):
+        covariances = local_covariances(block)
+        return classifier.predict(covariances.reshape(-1, 3, 3)).reshape(
+            covariances.shape[:2]
+        )
+
+    labels_generated = chunked_map(
+        predict,
+        pauli_transform(generated).transpose(1, 2, 0),
+        halo=3,
+        chunk_rows=chunk_rows,
+        executor="thread",
+    ).reshape(-1)
+
+    classes = classifier.classes.tolist()
+    counts = np.bincount(
+        10 * labels_original + labels_generated, minlength=100
+    ).reshape(10, 10)[np.ix_(classes, classes)]
+    return {
+        "wishart_accuracy": float(np.mean(labels_original == labels_generated)),
+        "wishart_iterations": classifier.num_iterations,
+        "wishart_classes": classes,
+        "wishart_confusion_counts": counts.tolist(),
+    }
+
+
+def _equalized(image, method):
+    # The equalized image and its bounds, as a flat tuple of arrays
+    equalized, (p2, p98) = equalize(image, method=method)
+    return equalized, np.asarray(p2), np.asarray(p98)
+
+
+def _equalized_bounds(equalized):
+    # The equalized image of _equalized with its bounds back to floats
+    image, p2, p98 = equalized
+    return image, float(p2), float(p98)
+
+
+def show_images(
+    samples,
+    generated,
+    image_path,
+    last=False,
+    equalization="percentile",
+    decompositions=None,
+):
+    """
+    Plots the original and generated images side by side with their
+    decompositions and the comparison metrics
+
+    Arguments:
+        samples: the list of (C, H, W) original images, in the log amplitude domain
+        generated: the list of (C, H, W) generated images
+        image_path: the path of the figure
+        last: whether to add the Fourier transforms
+        equalization: the method of equalize used for the amplitude panels
+        decompositions: an optional DecompositionCache of the original images,
+                        from which their decompositions, equalization bounds
+                        and H-alpha classes are read
+    """
+
+    def ground_truth(name, compute):
+        if decompositions is None:
+            return compute()
+        return decompositions.get(name, compute)
 
     num_samples = len(samples)
     num_channels = samples[0].shape[0]
@@ -676,10 +1143,14 @@ def show_images(samples, generated, image_path, last=False):
         img_dataset_trans = img_dataset.transpose(1, 2, 0)
         img_gen_trans = img_gen.transpose(1, 2, 0)
 
-        pauli_img_dataset = pauli_transform(img_dataset).transpose(1, 2, 0)
+        pauli_img_dataset = ground_truth(
+            f"pauli_{i}", lambda: pauli_transform(img_dataset).transpose(1, 2, 0)
+        )
         pauli_img_gen = pauli_transform(img_gen).transpose(1, 2, 0)
 
-        krogager_img_dataset = krogager_transform(img_dataset).transpose(1, 2, 0)
+        krogager_img_dataset = ground_truth(
+            f"krogager_{i}", lambda: krogager_transform(img_dataset).transpose(1, 2, 0)
+        )
         krogager_img_gen = krogager_transform(img_gen).transpose(1, 2, 0)
 
         """
@@ -691,26 +1162,38 @@ def show_images(samples, generated, image_path, last=False):
         cameron_img_gen = cameron_classification(cameron_transform(img_gen))
         """
         # Plot amplitude using Pauli decomposition
-        eq_dataset, (p2, p98) = equalize(pauli_img_dataset)
+        eq_dataset, p2, p98 = _equalized_bounds(
+            ground_truth(
+                f"pauli_{equalization}_{i}",
+                lambda: _equalized(pauli_img_dataset, equalization),
+            )
+        )
         axes[i][idx].imshow(eq_dataset, origin="lower")
         axes[i][idx].set_title(f"Amplitude dataset Pauli basis {i+1}")
         axes[i][idx].axis("off")  # Turn off axes for image plot
         idx += 1
 
-        eq_generated, _ = equalize(pauli_img_gen, p2=p2, p98=p98)
+        eq_generated, _ = equalize(pauli_img_gen, p2=p2, p98=p98, method=equalization)
         axes[i][idx].imshow(eq_generated, origin="lower")
         axes[i][idx].set_title(f"Amplitude generated Pauli basis {i+1}")
         axes[i][idx].axis("off")  # Turn off axes for image plot
         idx += 1
 
         # Plot amplitude using Krogager decomposition
-        eq_dataset, (p2, p98) = equalize(krogager_img_dataset)
+        eq_dataset, p2, p98 = _equalized_bounds(
+            ground_truth(
+                f"krogager_{equalization}_{i}",
+                lambda: _equalized(krogager_img_dataset, equalization),
+            )
+        )
         axes[i][idx].imshow(eq_dataset, origin="lower")
         axes[i][idx].set_title(f"Amplitude dataset Krogager basis {i+1}")
         axes[i][idx].axis("off")  # Turn off axes for image plot
         idx += 1
 
-        eq_generated, _ = equalize(krogager_img_gen, p2=p2, p98=p98)
+        eq_generated, _ = equalize(
+            krogager_img_gen, p2=p2, p98=p98, method=equalization
+        )
         axes[i][idx].imshow(eq_generated, origin="lower")
         axes[i][idx].set_title(f"Amplitude generated Krogager basis {i+1}")
         axes[i][idx].axis("off")  # Turn off axes for image plot
@@ -801,7 +1284,9 @@ def show_images(samples, generated, image_path, last=False):
             for i in class_colors
         ]
 
-        h_alpha_original = h_alpha(pauli_img_dataset)
+        h_alpha_original = ground_truth(
+            f"h_alpha_{i}", lambda: parallel_h_alpha(pauli_img_dataset)
+        )
 
         ### Plot the H - alpha initialization, i.e. the mask of classes assigend to the pixels according to the H - alpha decomposition.
         axes[i][idx].imshow(h_alpha_original, origin="lower", cmap=cmap, norm=norm)
@@ -810,7 +1295,7 @@ def show_images(samples, generated, image_path, last=False):
         axes[i][idx].axis("off")  # Turn off axes for image plot
         idx += 1
 
-        h_alpha_gen = h_alpha(pauli_img_gen)
+        h_alpha_gen = parallel_h_alpha(pauli_img_gen)
 
         axes[i][idx].imshow(h_alpha_gen, origin="lower", cmap=cmap, norm=norm)
         axes[i][idx].legend(handles=patches, bbox_to_anchor=(1.05, 1), loc="upper left")
@@ -916,6 +1401,12 @@ def get_dataloaders(data_config, use_cuda):
 
     logging.info("  - Dataset creation")
 
+    if "shards" in data_config and data_config["shards"]["stream"]:
+        return get_shard_dataloaders(data_config, use_cuda)
+
+    if "in_memory" in data_config and data_config["in_memory"]:
+        return get_in_memory_dataloaders(data_config, use_cuda)
+
     input_transform = LogAmplitudeTransform(data_config["characteristics"])
 
     if data_config["dataset"]["name"] == "Bretigny":
@@ -954,6 +1445,7 @@ def get_dataloaders(data_config, use_cuda):
         batch_size=batch_size,
         shuffle=True,
         num_workers=num_workers,
+        worker_init_fn=execution.worker_init_fn,
         pin_memory=use_cuda,
     )
 
@@ -962,6 +1454,7 @@ def get_dataloaders(data_config, use_cuda):
         batch_size=batch_size,
         shuffle=False,
         num_workers=num_workers,
+        worker_init_fn=execution.worker_init_fn,
         pin_memory=use_cuda,
     )
 
@@ -983,6 +1476,13 @@ def get_full_image_dataloader(data_config, use_cuda):
 
     logging.info("  - Dataset creation")
 
+    if "in_memory" in data_config and data_config["in_memory"]:
+        base_dataset = InMemoryPatches(load_crop(data_config), img_size, img_stride)
+        logging.info(f"  - I loaded {len(base_dataset)} samples in memory")
+        return IndexBatchLoader(
+            base_dataset, range(len(base_dataset)), batch_size, pin_memory=use_cuda
+        )
+
     input_transform = LogAmplitudeTransform(data_config["characteristics"])
 
     if data_config["dataset"]["name"] == "Bretigny":
@@ -1012,12 +1512,492 @@ def get_full_image_dataloader(data_config, use_cuda):
         batch_size=batch_size,
         shuffle=False,
         num_workers=num_workers,
+        worker_init_fn=execution.worker_init_fn,
         pin_memory=use_cuda,
     )
 
     return data_loader
 
 
+def load_crop(data_config):
+    """
+    Reads the whole crop of the dataset at once and applies the input transform
+    to it, returning a contiguous (C, H, W) complex64 tensor. The transform
+    being pixel-wise, any patch of this tensor equals the transformed patch
+    returned by the map-style dataset.
+    """
+    start_row = data_config["crop"]["start_row"]
+    start_col = data_config["crop"]["start_col"]
+    end_row = data_config["crop"]["end_row"]
+    end_col = data_config["crop"]["end_col"]
+    name_dataset = data_config["dataset"]["name"]
+    trainpath = data_config["dataset"]["trainpath"]
+
+    input_transform = LogAmplitudeTransform(data_config["characteristics"])
+
+    if name_dataset == "ALOSDataset":
+        trainpath = pathlib.Path(trainpath) / "VOL-ALOS2044980750-150324-HBQR1.1__A"
+        crop_size = (end_row - start_row, end_col - start_col)
+        base_dataset = ALOSDataset(
+            volpath=trainpath,
+            transform=input_transform,
+            crop_coordinates=((start_row, start_col), (end_row, end_col)),
+            patch_size=crop_size,
+        )
+        image = base_dataset[0]
+    elif name_dataset == "PolSFDataset":
+        crop_size = (7888 - 2832, 3520 - 736)
+        base_dataset = PolSFDataset(
+            root=trainpath, transform=input_transform, patch_size=crop_size
+        )
+        image, labels = base_dataset[0]
+    else:
+        raise ValueError(f"The in memory mode does not support the {name_dataset}")
+
+    return image.contiguous()
+
+
+class InMemoryPatches:
+    """
+    The patches of an image held in memory as one contiguous tensor.
+
+    The patches are strided views of the image, never copied as a whole,
+    and a batch is built by gathering an index tensor of patches.
+
+    Arguments:
+        image: the (C, H, W) image
+        patch_size: the dimensions of the patches (rows, cols)
+        patch_stride: the shift between two consecutive patches (rows, cols)
+    """
+
+    def __init__(self, image, patch_size, patch_stride):
+        self.image = image
+        # (C, nrows, ncols, patch_rows, patch_cols) view on the image
+        self.patches = image.unfold(1, patch_size[0], patch_stride[0]).unfold(
+            2, patch_size[1], patch_stride[1]
+        )
+        self.nsamples_per_rows = self.patches.shape[1]
+        self.nsamples_per_cols = self.patches.shape[2]
+
+    def __len__(self):
+        return self.nsamples_per_rows * self.nsamples_per_cols
+
+    def __getitem__(self, idx):
+        return self.patches[
+            :, idx // self.nsamples_per_cols, idx % self.nsamples_per_cols
+        ]
+
+    def gather(self, indices):
+        """
+        Returns the (B, C, patch_rows, patch_cols) batch of the patches whose
+        row-major indices are given by the 1D tensor `indices`
+        """
+        rows = torch.div(indices, self.nsamples_per_cols, rounding_mode="floor")
+        cols = indices % self.nsamples_per_cols
+        return self.patches[:, rows, cols].transpose(0, 1).contiguous()
+
+    def __repr__(self):
+        return (
+            f"InMemoryPatches(image={tuple(self.image.shape)}, "
+            f"patches={self.nsamples_per_rows}x{self.nsamples_per_cols})"
+        )
+
+
+class IndexBatchLoader:
+    """
+    Iterates over batches of InMemoryPatches by gathering slices of an index
+    tensor in the main process, without workers nor collate function.
+
+    Arguments:
+        dataset: the InMemoryPatches to draw the patches from
+        indices: the indices of the patches of this loader
+        batch_size: the number of patches per batch
+        shuffle: whether to permute the indices at every iteration
+        pin_memory: whether to pin the batches, to speed up host to device copies
+    """
+
+    def __init__(self, dataset, indices, batch_size, shuffle=False, pin_memory=False):
+        self.dataset = dataset
+        self.indices = torch.as_tensor(indices, dtype=torch.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pin_memory = pin_memory
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        indices = self.indices
+        if self.shuffle:
+            indices = indices[torch.randperm(len(indices))]
+        for batch_indices in indices.split(self.batch_size):
+            batch = self.dataset.gather(batch_indices)
+            if self.pin_memory:
+                batch = batch.pin_memory()
+            yield batch
+
+
+def get_in_memory_dataloaders(data_config, use_cuda):
+    img_size = (data_config["img_size"], data_config["img_size"])
+    img_stride = (data_config["img_stride"], data_config["img_stride"])
+    valid_ratio = data_config["valid_ratio"]
+    batch_size = data_config["batch_size"]
+
+    base_dataset = InMemoryPatches(load_crop(data_config), img_size, img_stride)
+    logging.info(f"  - I loaded {len(base_dataset)} samples in memory")
+
+    indices = list(range(len(base_dataset)))
+    random.shuffle(indices)
+    num_valid = int(valid_ratio * len(indices))
+    train_indices = indices[num_valid:]
+    valid_indices = indices[:num_valid]
+
+    train_loader = IndexBatchLoader(
+        base_dataset, train_indices, batch_size, shuffle=True, pin_memory=use_cuda
+    )
+    valid_loader = IndexBatchLoader(
+        base_dataset, valid_indices, batch_size, shuffle=False, pin_memory=use_cuda
+    )
+
+    return train_loader, valid_loader
+
+
+def load_shard_index(root):
+    """
+    Loads the index.json describing the shards of a directory written by
+    `ShardWriter`
+    """
+    with open(pathlib.Path(root) / "index.json", "r") as f:
+        return json.load(f)
+
+
+def read_shard(root, entry, verify=True):
+    """
+    Reads a whole shard with a single sequential read and returns its patches
+    as a (N, C, H, W) array.
+
+    Arguments:
+        root: the directory holding the shard
+        entry: the entry of the shard in the index
+        verify: whether to check the sha256 of the shard against the index
+    """
+    with open(pathlib.Path(root) / entry["file"], "rb") as f:
+        raw = f.read()
+    if verify and hashlib.sha256(raw).hexdigest() != entry["sha256"]:
+        raise RuntimeError(f"Checksum mismatch for the shard {entry['file']}")
+    return np.load(io.BytesIO(raw))
+
+
+class ShardWriter:
+    """
+    Accumulates patches and writes them as fixed-size .npy shards, keeping the
+    index.json of the directory up to date. Writing into a directory which
+    already holds shards appends to its index, which is how several scenes are
+    gathered into the same archive.
+
+    Arguments:
+        root: the directory where to write the shards
+        shard_size: the number of patches per shard, only the last one can be smaller
+    """
+
+    def __init__(self, root, shard_size):
+        self.root = pathlib.Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.shard_size = shard_size
+        if (self.root / "index.json").exists():
+            self.index = load_shard_index(self.root)
+        else:
+            self.index = {
+                "version": 1,
+                "patch_shape": None,
+                "dtype": None,
+                "num_patches": 0,
+                "shards": [],
+            }
+        self.pending = []
+        self.num_pending = 0
+
+    def write(self, patches):
+        """
+        Queues a (N, C, H, W) batch of patches and flushes every full shard
+        """
+        self.pending.append(np.asarray(patches))
+        self.num_pending += len(patches)
+        while self.num_pending >= self.shard_size:
+            self._flush(self.shard_size)
+
+    def close(self):
+        """
+        Flushes the remaining patches into a last, possibly smaller, shard
+        """
+        if self.num_pending > 0:
+            self._flush(self.num_pending)
+
+    def _flush(self, num_patches):
+        patches = np.concatenate(self.pending)
+        shard, rest = patches[:num_patches], patches[num_patches:]
+        self.pending = [rest] if len(rest) > 0 else []
+        self.num_pending = len(rest)
+
+        if self.index["patch_shape"] is None:
+            self.index["patch_shape"] = list(shard.shape[1:])
+            self.index["dtype"] = str(shard.dtype)
+        elif list(shard.shape[1:]) != self.index["patch_shape"] or str(
+            shard.dtype
+        ) != self.index["dtype"]:
+            raise ValueError(
+                f"Patches of shape {shard.shape[1:]} and dtype {shard.dtype} do not match the archive "
+                f"({self.index['patch_shape']}, {self.index['dtype']})"
+            )
+
+        buffer = io.BytesIO()
+        np.save(buffer, np.ascontiguousarray(shard))
+        raw = buffer.getvalue()
+        filename = f"shard-{len(self.index['shards']):06d}.npy"
+        with open(self.root / filename, "wb") as f:
+            f.write(raw)
+
+        self.index["shards"].append(
+            {
+                "file": filename,
+                "num_patches": len(shard),
+                "sha256": hashlib.sha256(raw).hexdigest(),
+            }
+        )
+        self.index["num_patches"] += len(shard)
+
+        # Write the index atomically so that an interrupted export leaves a
+        # consistent archive behind
+        tmp_path = self.root / "index.json.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(tmp_path, self.root / "index.json")
+
+
+class ShardedPatchDataset(torch.utils.data.IterableDataset):
+    """
+    Streams the patches of a shard archive written by `ShardWriter`.
+
+    At every epoch, the shards are permuted identically on all the ranks, split
+    across the ranks and then across the dataloader workers. Each shard is read
+    with a single sequential read and its patches go through a shuffle buffer.
+
+    Arguments:
+        root: the directory holding the index.json and the shards
+        shuffle_buffer: the number of patches kept in the shuffle buffer, 0 to disable shuffling
+        seed: the seed of the shard permutations and of the shuffle buffer
+        rank: the rank of the process, defaults to the torch.distributed rank
+        world_size: the number of ranks, defaults to the torch.distributed world size
+        verify: whether to check the checksum of every shard when it is read
+        batch_size: the batch size of the DataLoader, in which the resume
+                    position is counted
+    """
+
+    def __init__(
+        self,
+        root,
+        shuffle_buffer=0,
+        seed=0,
+        rank=None,
+        world_size=None,
+        verify=True,
+        batch_size=1,
+    ):
+        super().__init__()
+        self.root = pathlib.Path(root)
+        self.index = load_shard_index(self.root)
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        distributed = torch.distributed.is_available() and (
+            torch.distributed.is_initialized()
+        )
+        if rank is None:
+            rank = torch.distributed.get_rank() if distributed else 0
+        if world_size is None:
+            world_size = torch.distributed.get_world_size() if distributed else 1
+        self.rank = rank
+        self.world_size = world_size
+        self.verify = verify
+        self.batch_size = batch_size
+        self.epoch = 0
+        self.batches_done = 0
+
+    def set_epoch(self, epoch, batches_done=0):
+        """
+        Selects the shard permutation of the epoch and the position to resume from
+
+        Arguments:
+            epoch: the epoch to stream
+            batches_done: the number of batches of the epoch already consumed by
+                          this rank. The DataLoader takes whole batches from its
+                          workers in turn, so that every worker skips its share
+                          of these batches.
+        """
+        self.epoch = epoch
+        self.batches_done = batches_done
+
+    def rank_shards(self):
+        """
+        Returns the index entries of the shards streamed by this rank for the current epoch
+        """
+        shards = list(self.index["shards"])
+        if self.shuffle_buffer > 0:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        return shards[self.rank :: self.world_size]
+
+    def _resume_position(self, num_workers):
+        """
+        Replays the order in which the DataLoader takes the batches from its
+        workers: round-robin, starting from the worker 0 and skipping the
+        exhausted workers
+
+        Returns:
+            The worker of the next batch and the number of batches already
+            taken from every worker
+        """
+        shards = self.rank_shards()
+        num_batches = []
+        for worker in range(num_workers):
+            num_patches = sum(
+                entry["num_patches"] for entry in shards[worker::num_workers]
+            )
+            num_batches.append(math.ceil(num_patches / self.batch_size))
+        taken = [0] * num_workers
+        worker = 0
+        for _ in range(min(self.batches_done, sum(num_batches))):
+            while taken[worker] >= num_batches[worker]:
+                worker = (worker + 1) % num_workers
+            taken[worker] += 1
+            worker = (worker + 1) % num_workers
+        return worker, taken
+
+    def __len__(self):
+        num_patches = sum(entry["num_patches"] for entry in self.rank_shards())
+        return max(num_patches - self.batches_done * self.batch_size, 0)
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+        else:
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+
+        # When resuming, the workers take the streams of the original epoch
+        # rotated so that the batches follow in the same order
+        rotation, skipped_batches = self._resume_position(num_workers)
+        worker_id = (worker_id + rotation) % num_workers
+        shards = self.rank_shards()[worker_id::num_workers]
+        skip = self.batch_size * skipped_batches[worker_id]
+
+        if self.shuffle_buffer <= 0:
+            # Without shuffling, the shards before the resume position are not even read
+            while shards and shards[0]["num_patches"] <= skip:
+                skip -= shards[0]["num_patches"]
+                shards = shards[1:]
+
+        rng = random.Random(
+            (self.seed + self.epoch) * self.world_size * num_workers
+            + self.rank * num_workers
+            + worker_id
+        )
+        for patch in self._stream(shards, rng):
+            if skip > 0:
+                skip -= 1
+                continue
+            yield patch
+
+    def _stream(self, shards, rng):
+        buffer = []
+        for entry in shards:
+            patches = torch.from_numpy(read_shard(self.root, entry, self.verify))
+            if self.shuffle_buffer <= 0:
+                yield from patches
+                continue
+            for patch in patches:
+                # The copy releases the shard once all its patches left the buffer
+                patch = patch.clone()
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(patch)
+                    continue
+                idx = rng.randrange(len(buffer))
+                yield buffer[idx]
+                buffer[idx] = patch
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __repr__(self):
+        return (
+            f"ShardedPatchDataset(root={self.root}, num_shards={len(self.index['shards'])}, "
+            f"num_patches={self.index['num_patches']}, rank={self.rank}/{self.world_size})"
+        )
+
+
+def get_shard_dataloaders(data_config, use_cuda):
+    shards_config = data_config["shards"]
+    root = pathlib.Path(shards_config["path"])
+    batch_size = data_config["batch_size"]
+    num_workers = data_config["num_workers"]
+
+    train_dataset = ShardedPatchDataset(
+        root / "train",
+        shuffle_buffer=shards_config["shuffle_buffer"],
+        seed=shards_config.get("seed", 0),
+        batch_size=batch_size,
+    )
+    valid_dataset = ShardedPatchDataset(root / "valid", batch_size=batch_size)
+    logging.info(
+        f"  - I streamed {train_dataset.index['num_patches'] + valid_dataset.index['num_patches']} samples"
+        f" from {len(train_dataset.index['shards']) + len(valid_dataset.index['shards'])} shards"
+    )
+
+    # The shuffling is done by the datasets, iterable datasets do not accept a sampler
+    train_loader = torch.utils.data.DataLoader(
+        train_dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        worker_init_fn=execution.worker_init_fn,
+        pin_memory=use_cuda,
+    )
+
+    valid_loader = torch.utils.data.DataLoader(
+        valid_dataset,
+        batch_size=batch_size,
+        num_workers=num_workers,
+        worker_init_fn=execution.worker_init_fn,
+        pin_memory=use_cuda,
+    )
+
+    return train_loader, valid_loader
+
+
+def export_shards(data_config, use_cuda):
+    """
+    Writes the transformed patches of the dataset described by `data_config`
+    into the train and valid shard archives of data_config["shards"]["path"].
+    Exporting several scenes into the same path appends them to the archives.
+    """
+    shards_config = data_config["shards"]
+    root = pathlib.Path(shards_config["path"])
+
+    # The patches are read from the original dataset, not from the archive
+    source_config = dict(data_config)
+    source_config["shards"] = dict(shards_config, stream=False)
+    train_loader, valid_loader = get_dataloaders(source_config, use_cuda)
+
+    for fold, loader in [("train", train_loader), ("valid", valid_loader)]:
+        writer = ShardWriter(root / fold, shards_config["shard_size"])
+        for data in tqdm.tqdm(loader):
+            if isinstance(data, tuple) or isinstance(data, list):
+                inputs, labels = data
+            else:
+                inputs = data
+            writer.write(inputs.numpy())
+        writer.close()
+        logging.info(
+            f"  - {fold} archive : {writer.index['num_patches']} patches in {len(writer.index['shards'])} shards"
+        )
+
+
 def reassemble_image(
     segments,
     nb_cols,
@@ -1029,7 +2009,7 @@ def reassemble_image(
     Reassembles the image segments back into a single image, starting with the rows.
 
     Args:
-    - segments: A list of 3D tensors representing image segments.
+    - segments: A list of image segments, or of batches of segments, in row-major order.
     - n_cols: The number of columns in the original image.
     - n_rows: The number of rows in the original image.
     - num_channels: The number of channels in the image.
@@ -1040,6 +2020,11 @@ def reassemble_image(
     """
     # Correct the shape of the reassembled image to match typical (height, width, channels) format
     reassembled_image = np.zeros((num_channels, nb_rows, nb_cols), dtype=np.complex64)
+    segments = [
+        segment
+        for batch in segments
+        for segment in np.reshape(batch, (-1, num_channels, segment_size, segment_size))
+    ]
     segment_index = 0
     for h in range(0, nb_rows, segment_size):
         for w in range(0, nb_cols, segment_size):
@@ -0,0 +1,131 @@
+# coding: utf-8
+
+# Standard imports
+import logging
+import os
+import pathlib
+
+# External imports
+import torch
+
+# The cores of the DataLoader workers, set by apply_execution_profile and
+# inherited by the forked workers
+_worker_cores = None
+
+
+def parse_cpulist(cpulist):
+    """Parses a kernel cpu list such as "0-3,8-11" into the sorted list of cores"""
+    cores = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cores.extend(range(int(start), int(end) + 1))
+        else:
+            cores.append(int(part))
+    return sorted(cores)
+
+
+def numa_nodes():
+    """Returns the dictionnary NUMA node -> cores, a single node if it is unknown"""
+    nodes = {}
+    root = pathlib.Path("/sys/devices/system/node")
+    for node_path in sorted(root.glob("node[0-9]*")):
+        cpulist = (node_path / "cpulist").read_text()
+        nodes[int(node_path.name[len("node") :])] = parse_cpulist(cpulist)
+    if not nodes:
+        nodes[0] = sorted(os.sched_getaffinity(0))
+    return nodes
+
+
+def worker_init_fn(worker_id):
+    """Pins a DataLoader worker to the worker cores of the execution profile"""
+    if _worker_cores:
+        os.sched_setaffinity(0, _worker_cores)
+
+
+def apply_execution_profile(profile):
+    """
+    Applies a CPU execution profile to the current process, before any
+    parallel work is started:
+        - numa_node: the process is restricted to the cores of this node, "auto"
+          picking the node LOCAL_RANK modulo the number of nodes. The memory is
+          then allocated on this node by the first-touch policy of Linux.
+        - worker_cores: the cores of the DataLoader workers, as a list or as
+          the number of cores taken at the end of the cores of the process.
+          They are removed from the cores of the compute threads.
+        - intraop_threads: the threads of the operators. When it is null, the
+          threads of torch are kept unless numa_node or worker_cores shrank the
+          cores of the process, one thread per compute core being then used.
+          A profile with every field null leaves the process untouched.
+        - interop_threads: the threads running independent operators, left to
+          torch by default
+
+    Arguments:
+        profile: the dictionnary of the execution section of the configuration
+
+    Returns:
+        The dictionnary of the effective layout, see describe_execution_layout
+    """
+    global _worker_cores
+
+    cores = sorted(os.sched_getaffinity(0))
+    numa_node = profile["numa_node"]
+    if numa_node is not None:
+        nodes = numa_nodes()
+        if numa_node == "auto":
+            local_rank = int(os.environ.get("LOCAL_RANK", 0))
+            numa_node = sorted(nodes)[local_rank % len(nodes)]
+        if numa_node not in nodes:
+            raise ValueError(
+                f"Unknown NUMA node {numa_node}, expected one of {sorted(nodes)}"
+            )
+        node_cores = [core for core in cores if core in nodes[numa_node]]
+        if not node_cores:
+            raise ValueError(f"No core of the NUMA node {numa_node} is available")
+        cores = node_cores
+
+    worker_cores = profile["worker_cores"]
+    if isinstance(worker_cores, int):
+        if worker_cores >= len(cores):
+            raise ValueError(
+                f"Cannot reserve {worker_cores} of the {len(cores)} cores to the workers"
+            )
+        worker_cores = cores[len(cores) - worker_cores :] if worker_cores > 0 else None
+    compute_cores = cores
+    if worker_cores:
+        compute_cores = [core for core in cores if core not in worker_cores] or cores
+    pinned = compute_cores != sorted(os.sched_getaffinity(0))
+    if pinned:
+        os.sched_setaffinity(0, compute_cores)
+    _worker_cores = worker_cores
+
+    if profile["intraop_threads"] is not None:
+        torch.set_num_threads(profile["intraop_threads"])
+    elif pinned:
+        torch.set_num_threads(len(compute_cores))
+    if profile["interop_threads"] is not None:
+        try:
+            torch.set_num_interop_threads(profile["interop_threads"])
+        except RuntimeError as e:
+            # The interop pool can only be sized before its first use
+            logging.warning(f"Cannot set the interop threads : {e}")
+
+    layout = describe_execution_layout()
+    layout["numa_node"] = numa_node
+    return layout
+
+
+def describe_execution_layout():
+    """
+    Returns:
+        The json serializable dictionnary of the cores and threads of the process
+    """
+    return {
+        "numa_nodes": {str(node): cores for node, cores in numa_nodes().items()},
+        "compute_cores": sorted(os.sched_getaffinity(0)),
+        "worker_cores": _worker_cores,
+        "intraop_threads": torch.get_num_threads(),
+        "interop_threads": torch.get_num_interop_threads(),
+    }
@@ -0,0 +1,121 @@
+# coding: utf-8
+
+# Standard imports
+import copy
+import logging
+import pathlib
+import json
+
+# External imports
+import torch
+
+# Local imports
+from .models.real_pair import to_real_pair, complex_to_real_pair, real_pair_to_complex
+
+
+def parity_check(model, runners, inputs, atol=1e-4):
+    """
+    Compares the outputs of real-valued runners with the complex model
+
+    Arguments:
+        model: the complex model, in eval mode
+        runners: a dictionnary name -> function mapping a (B, 2C, H, W) real
+                 tensor to a (B, 2C, H, W) real tensor
+        inputs: the list of complex input tensors to check on
+        atol: the maximal absolute error tolerated
+
+    Returns:
+        A dictionnary name -> maximal absolute error over the inputs
+    """
+    errors = {name: 0.0 for name in runners}
+    with torch.no_grad():
+        for z in inputs:
+            expected = model(z)
+            x = complex_to_real_pair(z)
+            for name, runner in runners.items():
+                output = real_pair_to_complex(runner(x))
+                error = (output - expected).abs().max().item()
+                errors[name] = max(errors[name], error)
+
+    for name, error in errors.items():
+        logging.info(f"  - Parity {name} : max abs error {error:.3e}")
+        if error > atol:
+            raise RuntimeError(
+                f"The {name} export deviates from the complex model ({error:.3e} > {atol:.1e})"
+            )
+    return errors
+
+
+def export_model(model, savepath, num_channels, img_size, atol=1e-4):
+    """
+    Rewrites the complex model as a real-pair graph and saves it as ONNX and
+    TorchScript, with dynamic batch and spatial axes. The (B, C, H, W) complex
+    input is fed as the (B, 2C, H, W) real tensor of its real and imaginary parts,
+    H and W being multiples of the downsampling factor of the model.
+
+    Arguments:
+        model: the trained complex model
+        savepath: the directory where to write best_model.onnx and best_model.torchscript.pt
+        num_channels: the number of input channels
+        img_size: the spatial size of the dummy input used for the export
+        atol: the tolerance of the parity check
+
+    Returns:
+        The dictionnary of the maximal absolute errors of the exported artifacts
+    """
+    savepath = pathlib.Path(savepath)
+    model = copy.deepcopy(model).cpu().eval()
+    real_model = to_real_pair(model)
+
+    dummy_input = complex_to_real_pair(
+        torch.randn((2, num_channels, img_size, img_size), dtype=torch.complex64)
+    )
+
+    logging.info("= Export to TorchScript")
+    torchscript_path = savepath / "best_model.torchscript.pt"
+    with torch.no_grad():
+        traced = torch.jit.trace(real_model, dummy_input)
+    traced.save(str(torchscript_path))
+
+    logging.info("= Export to ONNX")
+    onnx_path = savepath / "best_model.onnx"
+    torch.onnx.export(
+        real_model,
+        (dummy_input,),
+        str(onnx_path),
+        input_names=["input"],
+        output_names=["output"],
+        dynamic_axes={
+            "input": {0: "batch", 2: "height", 3: "width"},
+            "output": {0: "batch", 2: "height", 3: "width"},
+        },
+    )
+
+    runners = {
+        "real_pair": real_model,
+        "torchscript": torch.jit.load(str(torchscript_path)),
+    }
+    try:
+        import onnxruntime
+
+        session = onnxruntime.InferenceSession(
+            str(onnx_path), providers=["CPUExecutionProvider"]
+        )
+        runners["onnx"] = lambda x: torch.from_numpy(
+            session.run(None, {"input": x.numpy()})[0]
+        )
+    except ImportError:
+        logging.warning("onnxruntime is not installed, the ONNX parity is not checked")
+
+    # The check runs on other batch and spatial sizes than the export to
+    # exercise the dynamic axes
+    inputs = [
+        torch.randn((3, num_channels, 2 * img_size, img_size), dtype=torch.complex64),
+        torch.randn((1, num_channels, img_size, 2 * img_size), dtype=torch.complex64),
+    ]
+    errors = parity_check(model, runners, inputs, atol=atol)
+
+    with open(savepath / "export_parity.json", "w") as f:
+        json.dump(errors, f, indent=2)
+
+    return errors
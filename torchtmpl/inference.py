@@ -0,0 +1,271 @@
+# coding: utf-8
+
+# Standard imports
+import copy
+import logging
+import time
+import warnings
+
+# External imports
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.ao.nn.quantized.dynamic as nnqd
+from torch.ao.quantization import default_dynamic_qconfig
+from sklearn.metrics import accuracy_score
+
+# Local imports
+from . import data as dt
+from .models.real_pair import (
+    to_real_pair,
+    fold_batchnorm,
+    simplify_upsampling,
+    RealPairWrapper,
+)
+
+PRECISIONS = ["float32", "bfloat16", "int8"]
+
+
+def block_names(model):
+    """
+    Returns the names of the blocks (DoubleConv, Down, Up, OutConv) of the
+    encoder and the decoder, which are kept by the real-pair rewrites
+    """
+    return [f"encoder.{name}" for name, _ in model.encoder.named_children()] + [
+        f"decoder.{name}" for name, _ in model.decoder.named_children()
+    ]
+
+
+def time_layers(model, inputs, names, repeats=10, warmup=2):
+    """
+    Measures the mean forward latency of the named submodules of the model
+
+    Arguments:
+        model: the model to profile
+        inputs: the input tensor
+        names: the names, as in model.named_modules(), of the submodules to time
+        repeats: the number of timed forward passes
+        warmup: the number of forward passes before timing
+
+    Returns:
+        A dictionnary name -> mean latency in seconds, with the key "total"
+        for the whole forward pass
+    """
+    modules = dict(model.named_modules())
+    elapsed = {name: 0.0 for name in names}
+    starts = {}
+    handles = []
+    timing = [False]
+
+    def pre_hook(name):
+        def hook(module, args):
+            starts[name] = time.perf_counter()
+
+        return hook
+
+    def post_hook(name):
+        def hook(module, args, output):
+            if timing[0]:
+                elapsed[name] += time.perf_counter() - starts[name]
+
+        return hook
+
+    for name in names:
+        handles.append(modules[name].register_forward_pre_hook(pre_hook(name)))
+        handles.append(modules[name].register_forward_hook(post_hook(name)))
+
+    total = 0.0
+    with torch.no_grad():
+        for _ in range(warmup):
+            model(inputs)
+        timing[0] = True
+        for _ in range(repeats):
+            start = time.perf_counter()
+            model(inputs)
+            total += time.perf_counter() - start
+
+    for handle in handles:
+        handle.remove()
+
+    latencies = {name: elapsed[name] / repeats for name in names}
+    latencies["total"] = total / repeats
+    return latencies
+
+
+def optimize_for_inference(model, input_shape, atol=1e-4, repeats=10):
+    """
+    Rewrites a trained AutoEncoderWD for inference: the model is turned into
+    its real-pair equivalent, the BatchNorms are folded into the preceding
+    convolutions and the upsampling transposed convolutions become 1x1
+    convolutions followed by a pixel shuffle.
+
+    Arguments:
+        model: the trained complex model
+        input_shape: the (B, C, H, W) shape of the inputs used for the parity
+                     check and the latency measures
+        atol: the maximal absolute deviation tolerated from the complex model
+        repeats: the number of timed forward passes
+
+    Returns:
+        The optimized model, taking and returning complex tensors, and the
+        report of the parity check and of the latency per block
+    """
+    # The model of the caller stays on its device
+    model = copy.deepcopy(model).cpu().eval()
+    optimized = RealPairWrapper(
+        simplify_upsampling(fold_batchnorm(to_real_pair(model)))
+    ).eval()
+
+    inputs = torch.randn(input_shape, dtype=torch.complex64)
+    with torch.no_grad():
+        error = (optimized(inputs) - model(inputs)).abs().max().item()
+    logging.info(f"  - Parity of the optimized model : max abs error {error:.3e}")
+    if error > atol:
+        raise RuntimeError(
+            f"The optimized model deviates from the complex model ({error:.3e} > {atol:.1e})"
+        )
+
+    names = block_names(model)
+    before = time_layers(model, inputs, names, repeats=repeats)
+    # The wrapper prefixes the names of the blocks by "model."
+    wrapped = time_layers(
+        optimized, inputs, [f"model.{name}" for name in names], repeats=repeats
+    )
+    after = {name: wrapped[f"model.{name}"] for name in names}
+    after["total"] = wrapped["total"]
+
+    layers = {}
+    for name in names + ["total"]:
+        layers[name] = {
+            "before_ms": 1e3 * before[name],
+            "after_ms": 1e3 * after[name],
+            "speedup": before[name] / after[name],
+        }
+        logging.info(
+            f"  - {name:10s} : {1e3 * before[name]:8.2f} ms -> {1e3 * after[name]:8.2f} ms (x{before[name] / after[name]:.2f})"
+        )
+
+    report = {
+        "input_shape": list(input_shape),
+        "parity_max_abs_error": error,
+        "layers": layers,
+    }
+    return optimized, report
+
+
+class Int8Conv2d(nn.Module):
+    """nn.Conv2d with int8 weights and dynamically quantized activations
+
+    The quantized kernels only pad with zeros, a replicate padding is
+    therefore applied explicitly before the convolution
+    """
+
+    def __init__(self, conv):
+        super().__init__()
+        self.pad = None
+        padding = conv.padding
+        if conv.padding_mode != "zeros":
+            self.pad = (conv.padding[1], conv.padding[1], conv.padding[0], conv.padding[0])
+            self.pad_mode = conv.padding_mode
+            padding = 0
+        float_conv = nn.Conv2d(
+            conv.in_channels,
+            conv.out_channels,
+            kernel_size=conv.kernel_size,
+            stride=conv.stride,
+            padding=padding,
+            dilation=conv.dilation,
+            groups=conv.groups,
+            bias=conv.bias is not None,
+        )
+        float_conv.load_state_dict(conv.state_dict())
+        float_conv.qconfig = default_dynamic_qconfig
+        with warnings.catch_warnings():
+            # torch warns about the accuracy of dynamic quantized convolutions,
+            # which is precisely what precision_fidelity measures
+            warnings.simplefilter("ignore")
+            self.conv = nnqd.Conv2d.from_float(float_conv)
+
+    def forward(self, x):
+        if self.pad is not None:
+            x = F.pad(x, self.pad, mode=self.pad_mode)
+        return self.conv(x)
+
+
+def quantize_convolutions(real_model):
+    """
+    Replaces, in place, every real nn.Conv2d of a real-pair model by its
+    dynamically quantized int8 counterpart
+    """
+    for module in list(real_model.modules()):
+        for name, child in module._modules.items():
+            if type(child) is nn.Conv2d:
+                module._modules[name] = Int8Conv2d(child)
+    return real_model
+
+
+def reduced_precision_model(model, precision):
+    """
+    Builds the optimized real-pair version of the complex model running in the
+    given precision
+
+    Arguments:
+        model: the trained complex model
+        precision: one of PRECISIONS. bfloat16 runs the whole real-pair graph in
+                   bfloat16, int8 quantizes the weights of the convolutions and
+                   dynamically their inputs. Both run on CPU.
+
+    Returns:
+        The model, taking and returning complex64 tensors
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unknown precision {precision}, expected one of {PRECISIONS}")
+
+    real_model = simplify_upsampling(fold_batchnorm(to_real_pair(copy.deepcopy(model).cpu())))
+    if precision == "bfloat16":
+        return RealPairWrapper(real_model.to(torch.bfloat16), dtype=torch.bfloat16)
+    if precision == "int8":
+        return RealPairWrapper(quantize_convolutions(real_model))
+    return RealPairWrapper(real_model)
+
+
+def precision_fidelity(reference, candidate):
+    """
+    Measures how far the reconstruction of a reduced precision model deviates
+    from the float32 reconstruction, in amplitude, in phase and in H-alpha classes
+
+    Arguments:
+        reference: the (C, H, W) float32 reconstruction, in the log amplitude domain
+        candidate: the (C, H, W) reduced precision reconstruction
+
+    Returns:
+        A dictionnary of the metrics, per channel when relevant
+    """
+    reference = dt.exp_amplitude_transform(reference).numpy()
+    candidate = dt.exp_amplitude_transform(candidate).numpy()
+
+    amplitude_mse = np.mean(
+        np.square(np.abs(reference) - np.abs(candidate)), axis=(1, 2)
+    )
+    angular_distance = np.abs(dt.angular_distance(reference, candidate))
+
+    h_alpha_reference = dt.parallel_h_alpha(
+        dt.pauli_transform(reference).transpose(1, 2, 0)
+    )
+    h_alpha_candidate = dt.parallel_h_alpha(
+        dt.pauli_transform(candidate).transpose(1, 2, 0)
+    )
+
+    return {
+        "amplitude_mse": float(np.mean(amplitude_mse)),
+        "amplitude_mse_per_channel": amplitude_mse.tolist(),
+        "angular_distance_mean": float(np.mean(angular_distance)),
+        "angular_distance_mean_per_channel": np.mean(
+            angular_distance, axis=(1, 2)
+        ).tolist(),
+        "angular_distance_p95": float(np.percentile(angular_distance, 95)),
+        "h_alpha_agreement": float(
+            accuracy_score(h_alpha_reference.flatten(), h_alpha_candidate.flatten())
+        ),
+    }
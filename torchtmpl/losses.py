@@ -1,3 +1,5 @@
+import time
+
 import torch
 import torch.nn as nn
 from torchcvnn.nn.modules.loss import ComplexMSELoss
@@ -33,17 +35,35 @@ class ComplexAmplitudePhaseError(nn.Module):
 
 
 class ComplexHuberLoss(nn.Module):
-    def __init__(self):
+    """
+    Element-wise Huber loss of the modulus r = |y_true - y_pred| of the complex
+    error, 0.5 r^2 if r < delta and delta (r - 0.5 delta) otherwise
+
+    Arguments:
+        delta: the modulus where the loss turns from quadratic to linear
+        reduction: "mean", "sum" or "none"
+    """
+
+    def __init__(self, delta=1.0, reduction="mean"):
         super(ComplexHuberLoss, self).__init__()
+        if reduction not in ["mean", "sum", "none"]:
+            raise ValueError(f"Invalid reduction mode: {reduction}")
+        self.delta = delta
+        self.reduction = reduction
 
-    def forward(self, y_true, y_pred, delta=1.0):
+    def forward(self, y_true, y_pred):
 
         # Calculate Huber Loss
         l1 = torch.abs(y_true - y_pred)
-        if l1 < delta:
-            huber = delta * (torch.abs(y_true - y_pred) ** 2)
-        else:
-            huber = torch.mean(delta * (torch.abs(y_true - y_pred) - 0.5 * delta))
+        huber = torch.where(
+            l1 < self.delta,
+            0.5 * torch.square(l1),
+            self.delta * (l1 - 0.5 * self.delta),
+        )
+        if self.reduction == "mean":
+            return torch.mean(huber)
+        if self.reduction == "sum":
+            return torch.sum(huber)
         return huber
 
 
@@ -141,6 +161,190 @@ class ComplexVAEPhaseLoss(nn.Module):
         return recon_loss + kld_weight * kl_divergence, recon_loss, kl_divergence
 
 
+class AmplitudePhaseErrorFunction(torch.autograd.Function):
+    """
+    Fused ComplexAmplitudePhaseError, mean((|t| - |p|)^2 + |t| (1 - cos(arg t - arg p))).
+
+    With u = p / |p| (1 for a null p, whose angle is 0), |t| cos(arg t - arg p)
+    is Re(t conj(u)), so that the amplitudes are computed once and no angle is
+    needed. Only the inputs are saved, the amplitudes being recomputed in backward.
+    As for torch.abs, the gradients of the amplitudes are null at 0.
+    """
+
+    @staticmethod
+    def forward(ctx, y_true, y_pred):
+        a, b = y_true.abs(), y_pred.abs()
+        unit = torch.where(b > 0, y_pred / torch.where(b > 0, b, 1), 1)
+        ctx.save_for_backward(y_true, y_pred)
+        return torch.mean(torch.square(a - b) + a - (y_true * unit.conj()).real)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        y_true, y_pred = ctx.saved_tensors
+        a, b = y_true.abs(), y_pred.abs()
+        scale = grad_output / y_true.numel()
+        unit_true = torch.where(a > 0, y_true / torch.where(a > 0, a, 1), 0)
+        inverse_b = torch.where(b > 0, 1 / torch.where(b > 0, b, 1), 0)
+        unit_pred = y_pred * inverse_b
+        projection = (y_true * unit_pred.conj()).real
+
+        grad_true = grad_pred = None
+        if ctx.needs_input_grad[0]:
+            grad_true = scale * ((2 * (a - b) + 1) * unit_true - unit_pred)
+        if ctx.needs_input_grad[1]:
+            grad_pred = scale * (
+                -2 * (a - b) * unit_pred - (y_true - projection * unit_pred) * inverse_b
+            )
+        return grad_true, grad_pred
+
+
+class ComplexGaussianKLFunction(torch.autograd.Function):
+    """
+    Fused KL divergence of the complex VAE losses,
+    (-D + sum(n / det + 0.5 log det)) / (D B) with n = sigma (1 + |mu|^2) - Re(delta mu^2)
+    and det = sigma^2 - |delta|^2, computed once
+    """
+
+    @staticmethod
+    def forward(ctx, mu, sigma, delta):
+        det = torch.square(sigma) - torch.square(torch.abs(delta))
+        n = sigma * (1 + torch.square(torch.abs(mu))) - (delta * torch.square(mu)).real
+        ctx.save_for_backward(mu, sigma, delta, det, n)
+        return (-mu.shape[1] + torch.sum(n / det + 0.5 * torch.log(det))) / (
+            mu.shape[1] * mu.shape[0]
+        )
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        mu, sigma, delta, det, n = ctx.saved_tensors
+        scale = grad_output / (mu.shape[1] * mu.shape[0])
+        inverse_det = 1 / det
+        n_over_det2 = n * inverse_det * inverse_det
+
+        grad_mu = grad_sigma = grad_delta = None
+        if ctx.needs_input_grad[0]:
+            grad_mu = scale * 2 * (sigma * mu - (delta * mu).conj()) * inverse_det
+        if ctx.needs_input_grad[1]:
+            grad_sigma = scale * (
+                (1 + torch.square(torch.abs(mu)) + sigma) * inverse_det
+                - 2 * sigma * n_over_det2
+            )
+        if ctx.needs_input_grad[2]:
+            grad_delta = scale * (
+                -torch.square(mu).conj() * inverse_det
+                + 2 * delta * n_over_det2
+                - delta * inverse_det
+            )
+        return grad_mu, grad_sigma, grad_delta
+
+
+class FusedComplexAmplitudePhaseError(nn.Module):
+    """ComplexAmplitudePhaseError with the fused forward and backward"""
+
+    def forward(self, y_true, y_pred):
+        return AmplitudePhaseErrorFunction.apply(y_true, y_pred)
+
+
+class FusedComplexVAELoss(nn.Module):
+    """ComplexVAELoss with the fused KL divergence"""
+
+    def forward(self, x, recon_x, mu, sigma, delta, kld_weight):
+        recon_loss = torch.mean(torch.square(torch.abs(x - recon_x)))
+        kl_divergence = ComplexGaussianKLFunction.apply(mu, sigma, delta)
+        return (
+            recon_loss + kld_weight * kl_divergence,
+            recon_loss,
+            kl_divergence,
+            torch.mean(mu),
+            torch.mean(sigma),
+            torch.mean(delta),
+        )
+
+
+class FusedComplexVAEPhaseLoss(nn.Module):
+    """ComplexVAEPhaseLoss with the fused reconstruction loss and KL divergence"""
+
+    def forward(self, x, recon_x, mu, sigma, delta, kld_weight):
+        recon_loss = AmplitudePhaseErrorFunction.apply(x, recon_x)
+        kl_divergence = ComplexGaussianKLFunction.apply(mu, sigma, delta)
+        return recon_loss + kld_weight * kl_divergence, recon_loss, kl_divergence
+
+
+def benchmark_loss(loss, inputs, repeats=10):
+    """Returns the mean time, in ms, of a forward and backward step of the loss on the inputs"""
+    leaves = [x.detach().requires_grad_() for x in inputs]
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        for x in leaves:
+            x.grad = None
+        loss(*leaves).backward()
+    return 1e3 * (time.perf_counter() - start_time) / repeats
+
+
+def compare_losses(reference, candidate, inputs, repeats=10):
+    """
+    Checks the parity of two implementations of a loss and measures, for one
+    forward and backward step, their latency and the memory of the tensors
+    saved for the backward
+
+    Arguments:
+        reference: the reference loss, called as reference(*inputs)
+        candidate: the candidate loss, its first output is the value to differentiate
+        inputs: the tuple of inputs, the floating ones being differentiated
+        repeats: the number of timed steps
+
+    Returns:
+        A dictionnary of the maximal absolute errors of the values and gradients,
+        and of the time and saved memory per step of both losses
+    """
+
+    def step(loss):
+        leaves = [
+            x.detach().requires_grad_(x.is_floating_point() or x.is_complex())
+            if torch.is_tensor(x)
+            else x
+            for x in inputs
+        ]
+        saved = []
+
+        def pack(tensor):
+            saved.append(tensor)
+            return tensor
+
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            output = loss(*leaves)
+        value = output[0] if isinstance(output, tuple) else output
+        value.backward()
+        # The saved tensors are counted once, whatever the number of nodes saving them
+        unique = {t.untyped_storage().data_ptr(): t for t in saved}
+        saved_bytes = sum(t.untyped_storage().nbytes() for t in unique.values())
+        grads = [x.grad for x in leaves if torch.is_tensor(x) and x.requires_grad]
+        return value.detach(), grads, saved_bytes
+
+    reference_value, reference_grads, reference_bytes = step(reference)
+    candidate_value, candidate_grads, candidate_bytes = step(candidate)
+
+    timings = {}
+    for name, loss in [("reference", reference), ("candidate", candidate)]:
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            step(loss)
+        timings[name] = (time.perf_counter() - start_time) / repeats
+
+    return {
+        "value_error": (reference_value - candidate_value).abs().item(),
+        "grad_errors": [
+            (g_ref - g_cand).abs().max().item()
+            for g_ref, g_cand in zip(reference_grads, candidate_grads)
+        ],
+        "reference_ms_per_step": 1e3 * timings["reference"],
+        "candidate_ms_per_step": 1e3 * timings["candidate"],
+        "speedup": timings["reference"] / timings["candidate"],
+        "reference_saved_bytes": reference_bytes,
+        "candidate_saved_bytes": candidate_bytes,
+    }
+
+
 # Example usage
 # loss_fn = ComplexMeanSquareError()
 # loss = loss_fn(y_true, y_pred)
@@ -7,6 +7,8 @@ from os import path, makedirs, path
 import pathlib
 import shutil
 import random
+import json
+import time
 
 # External imports
 import yaml
@@ -25,6 +27,17 @@ from . import data as dt
 from . import models
 from . import optim
 from . import utils
+from . import export
+from . import inference
+from . import codec
+from . import search
+from . import metrics
+from . import cache
+from . import render
+from . import memory
+from . import execution
+from . import parallel
+from . import scheduler
 import torchtmpl as tl
 from torchtmpl.models import AutoEncoderWD
 
@@ -74,6 +87,14 @@ def load(config):
     use_cuda = torch.cuda.is_available()
     device = torch.device("cuda") if use_cuda else torch.device("cpu")
 
+    # Threads and cores of the process and of the DataLoader workers
+    if "execution" in config:
+        execution_layout = execution.apply_execution_profile(config["execution"])
+    else:
+        execution_layout = execution.describe_execution_layout()
+    execution_layout["num_workers"] = config["data"]["num_workers"]
+    logging.info(f"CPU execution layout : {execution_layout}")
+
     if "wandb" in config["logging"]:
         wandb_config = config["logging"]["wandb"]
         if config["pretrained"]:
@@ -92,6 +113,14 @@ def load(config):
     else:
         wandb_log = None
 
+    # Pick the largest training batch size fitting in the memory budget
+    if "memory" in config and config["memory"]["auto_batch_size"]:
+        logging.info("= Planning the memory")
+        plan = memory.plan_from_config(
+            models.build_model(config).to(device), config, training=True
+        )
+        config["data"]["batch_size"] = plan["batch_size"]
+
     # Build the dataloaders
     logging.info("= Building the dataloaders")
     data_config = config["data"]
@@ -134,7 +163,10 @@ def load(config):
 
     # Build the loss
     logging.info("= Loss")
-    loss = tl.optim.get_loss(config["loss"]["name"])
+    loss = tl.optim.get_loss(
+        config["loss"]["name"],
+        config["loss"]["params"] if "params" in config["loss"] else None,
+    )
 
     # Build the optimizer
     logging.info("= Optimizer")
@@ -142,10 +174,13 @@ def load(config):
     optimizer = tl.optim.get_optimizer(optim_config, model.parameters())
 
     epoch = 1
+    batches_done = 0
 
     if config["pretrained"]:
         optimizer.load_state_dict(checkpoint["optimizer_state_dict"])
         epoch = checkpoint["epoch"] + 1  # Start from the next epoch
+        # Batches of this epoch consumed before a checkpoint within the epoch
+        batches_done = checkpoint.get("batches_done", 0)
 
     # Copy the config file into the logdir
     # Let us use as base logname the class name of the model when wandb is not used
@@ -175,6 +210,15 @@ def load(config):
     else:
         input_size = next(iter(train_loader)).shape
 
+    # Real FLOPs and memory of the complex layers, which torchinfo miscounts
+    profile = models.profile_model(model, tuple(input_size))
+    with open(logdir / "profile.json", "w") as f:
+        json.dump(profile, f, indent=2)
+    totals = profile["totals"]
+    logging.info(
+        f"  - {totals['inference_flops_per_sample'] / 1e9:.3f} real GFLOPs per sample"
+    )
+
     summary_text = (
         f"Logdir : {logdir}\n"
         + "## Command \n"
@@ -184,6 +228,13 @@ def load(config):
         + (f" Wandb run name : {wandb.run.name}\n\n" if wandb_log is not None else "")
         + "## Summary of the model architecture\n"
         + f"{torchinfo.summary(model, input_size=input_size, dtypes=[cdtype])}\n\n"
+        + "## Complex profile (profile.json)\n"
+        + f"Real FLOPs per sample : {totals['inference_flops_per_sample'] / 1e9:.3f} G\n"
+        + f"Parameters : {totals['parameter_bytes'] / 2**20:.2f} MiB\n"
+        + f"Inference peak activations : {totals['inference_peak_activation_bytes'] / 2**20:.2f} MiB\n"
+        + f"Training saved activations : {totals['training_saved_activation_bytes'] / 2**20:.2f} MiB\n\n"
+        + "## CPU execution layout\n"
+        + f"{json.dumps(execution_layout)}\n\n"
         + "## Loss\n\n"
         + f"{loss}\n\n"
         + "## Datasets : \n"
@@ -207,6 +258,7 @@ def load(config):
         device,
         input_size,
         epoch,
+        batches_done,
         wandb_log,
         logdir,
     )
@@ -250,6 +302,7 @@ def train(config):
         device,
         input_size,
         epoch,
+        batches_done,
         wandb_log,
         logdir,
     ) = load(config)
@@ -259,8 +312,33 @@ def train(config):
         model, optimizer, logdir, len(input_size), min_is_best=True
     )
 
+    # The position within an epoch can only be resumed with the sharded datasets
+    sharded = isinstance(train_loader.dataset, dt.ShardedPatchDataset)
+    checkpoint_batches = (
+        config["data"]["shards"]["checkpoint_batches"]
+        if sharded and "checkpoint_batches" in config["data"]["shards"]
+        else 0
+    )
+
     for e in range(epoch, config["nepochs"] + epoch):
         last = False
+        start_batch = batches_done if e == epoch else 0
+        if sharded:
+            if start_batch > 0:
+                logging.info(f"Resuming epoch {e} after {start_batch} batches")
+            train_loader.dataset.set_epoch(e, start_batch)
+
+        def save_position(num_batches, e=e, start_batch=start_batch):
+            if checkpoint_batches and num_batches % checkpoint_batches == 0:
+                torch.save(
+                    {
+                        "epoch": e - 1,
+                        "batches_done": start_batch + num_batches,
+                        "model_state_dict": model.state_dict(),
+                        "optimizer_state_dict": optimizer.state_dict(),
+                    },
+                    path.join(logdir, "last_model.pt"),
+                )
         # Train 1 epoch
         (
             train_loss,
@@ -272,6 +350,7 @@ def train(config):
             optim=optimizer,
             device=device,
             config=config,
+            on_batch=save_position,
         )
 
         # Test
@@ -299,6 +378,7 @@ def train(config):
         torch.save(
             {
                 "epoch": e,
+                "batches_done": 0,
                 "model_state_dict": model.state_dict(),
                 "optimizer_state_dict": optimizer.state_dict(),
                 "loss": train_loss,
@@ -353,11 +433,27 @@ def test(config):
     use_cuda = torch.cuda.is_available()
     device = torch.device("cuda") if use_cuda else torch.device("cpu")
 
+    # Threads and cores of the process and of the DataLoader workers
+    if "execution" in config:
+        execution_layout = execution.apply_execution_profile(config["execution"])
+    else:
+        execution_layout = execution.describe_execution_layout()
+    execution_layout["num_workers"] = config["data"]["num_workers"]
+    logging.info(f"CPU execution layout : {execution_layout}")
+
     # Build the dataloaders
     logging.info("= Building the dataloaders")
     data_config = config["data"]
     data_config["batch_size"] = 1
 
+    # Batch the tiles as much as the memory budget allows
+    if "memory" in config and config["memory"]["auto_batch_size"]:
+        logging.info("= Planning the memory")
+        plan = memory.plan_from_config(
+            models.build_model(config).to(device), config, training=False
+        )
+        data_config["batch_size"] = plan["batch_size"]
+
     data_loader = dt.get_full_image_dataloader(data_config, use_cuda)
 
     # Load the checkpoint if needed
@@ -388,28 +484,184 @@ def test(config):
 
     logdir = pathlib.Path(logdir)
 
-    orginal_tensors = []
-    for data in tqdm.tqdm(data_loader):
-        if isinstance(data, tuple) or isinstance(data, list):
-            inputs, labels = data
-        else:
-            inputs = data
-        orginal_tensors.append(data.cpu().detach().numpy())
+    # The reduced precision models are derived from the complex model
+    complex_model = model
 
-    original_image = dt.reassemble_image(
-        segments=orginal_tensors,
-        nb_cols=config["data"]["crop"]["end_col"] - config["data"]["crop"]["start_col"],
-        nb_rows=config["data"]["crop"]["end_row"] - config["data"]["crop"]["start_row"],
-        num_channels=config["data"]["num_channels"],
-        segment_size=config["data"]["img_size"],
+    if "inference" in config and config["inference"]["optimize"]:
+        logging.info("= Optimizing the model for inference")
+        model, report = inference.optimize_for_inference(
+            model,
+            (
+                config["data"]["batch_size"],
+                config["data"]["num_channels"],
+                config["data"]["img_size"],
+                config["data"]["img_size"],
+            ),
+        )
+        model.to(device)
+        with open(logdir / "inference_optimization.json", "w") as f:
+            json.dump(report, f, indent=2)
+
+    reduced_precision = (
+        "inference" in config and config["inference"]["precision"] != "float32"
     )
 
+    # With the streaming metrics, the full images are only reassembled when
+    # they are displayed or compared with a reduced precision reconstruction
+    scene_metrics = None
+    keep_images = True
+    if "metrics" in config and config["metrics"]["stream"]:
+        scene_metrics = metrics.StreamingMetrics(
+            num_channels=config["data"]["num_channels"],
+            amplitude_range=config["metrics"]["amplitude_range"],
+            bins=config["metrics"]["bins"],
+            h_alpha=config["metrics"]["h_alpha"],
+        )
+        keep_images = config["metrics"]["show_images"] or reduced_precision
+
+    # The ground truth of the scene does not depend on the checkpoint
+    decompositions = None
+    if "cache" in config and config["cache"]["decompositions"]:
+        decompositions = cache.DecompositionCache(
+            pathlib.Path(config["cache"]["path"]) / "decompositions", config["data"]
+        )
+        logging.info(f"= Decomposition cache {decompositions.root}")
+
+    def ground_truth(name, compute):
+        if decompositions is None:
+            return compute()
+        return decompositions.get(name, compute)
+
+    def reassemble_original():
+        orginal_tensors = []
+        for data in tqdm.tqdm(data_loader):
+            if isinstance(data, tuple) or isinstance(data, list):
+                inputs, labels = data
+            else:
+                inputs = data
+            orginal_tensors.append(data.cpu().detach().numpy())
+
+        return dt.reassemble_image(
+            segments=orginal_tensors,
+            nb_cols=config["data"]["crop"]["end_col"]
+            - config["data"]["crop"]["start_col"],
+            nb_rows=config["data"]["crop"]["end_row"]
+            - config["data"]["crop"]["start_row"],
+            num_channels=config["data"]["num_channels"],
+            segment_size=config["data"]["img_size"],
+        )[0]
+
+    if keep_images:
+        original_image = [ground_truth("original", reassemble_original)]
+
+    # Tiles already reconstructed by this checkpoint with the same settings
+    tile_cache = None
+    strips = "inference" in config and config["inference"]["strip_workers"] > 0
+    if "cache" in config and config["cache"]["tiles"] and strips:
+        logging.warning(
+            "The tile cache is not used by the reconstruction by strips, it is disabled"
+        )
+    elif "cache" in config and config["cache"]["tiles"]:
+        fingerprint = cache.model_fingerprint(
+            complex_model,
+            {
+                "model": config["model"],
+                "optimize": "inference" in config and config["inference"]["optimize"],
+                "device": device.type,
+            },
+        )
+        tile_cache = cache.TileCache(
+            pathlib.Path(config["cache"]["path"]) / "tiles",
+            fingerprint,
+            max_bytes=int(config["cache"]["max_gb"] * 2**30),
+        )
+        logging.info(
+            f"= Tile cache {config['cache']['path']} : {len(tile_cache.entries)} tiles, "
+            f"{tile_cache.total_bytes / 2**30:.2f} GiB"
+        )
+
+    scene_renderer = None
+    if "rendering" in config and config["rendering"]["pyramid"]:
+        logging.info("= Computing the equalization of the pyramids")
+
+        def percentiles():
+            percentiles = render.equalization_percentiles(data_loader)
+            return np.array(percentiles["pauli"]), np.array(percentiles["krogager"])
+
+        pauli, krogager = ground_truth("pyramid_percentiles", percentiles)
+        pyramid_percentiles = {"pauli": pauli.tolist(), "krogager": krogager.tolist()}
+        scene_renderer = render.SceneRenderer(
+            logdir / "pyramid",
+            num_rows=config["data"]["crop"]["end_row"]
+            - config["data"]["crop"]["start_row"],
+            num_cols=config["data"]["crop"]["end_col"]
+            - config["data"]["crop"]["start_col"],
+            segment_size=config["data"]["img_size"],
+            percentiles=pyramid_percentiles,
+            tile_size=config["rendering"]["tile_size"],
+            h_alpha=config["rendering"]["h_alpha"],
+        )
+
     # Test
-    reconstructed_tensors = utils.one_forward(
-        model=model,
-        loader=data_loader,
-        device=device,
-    )
+    start_time = time.perf_counter()
+    if strips:
+        logging.info("= Reconstruction by strips")
+        reconstruction, timings = parallel.strip_inference(
+            model,
+            dt.load_crop(config["data"]),
+            segment_size=config["data"]["img_size"],
+            output_path=logdir / "reconstruction.npy",
+            num_workers=config["inference"]["strip_workers"],
+            num_threads=config["inference"]["strip_threads"],
+            batch_size=config["data"]["batch_size"],
+            metrics=scene_metrics,
+            renderer=scene_renderer,
+        )
+        with open(logdir / "strip_inference.json", "w") as f:
+            json.dump(timings, f, indent=2)
+        reconstructed_tensors = []
+        if keep_images:
+            reconstructed_tensors.append(
+                parallel.image_tiles(reconstruction, config["data"]["img_size"])
+            )
+    else:
+        reconstructed_tensors = utils.one_forward(
+            model=model,
+            loader=data_loader,
+            device=device,
+            metrics=scene_metrics,
+            renderer=scene_renderer,
+            keep_outputs=keep_images,
+            cache=tile_cache,
+        )
+    reconstruction_time = time.perf_counter() - start_time
+
+    if tile_cache is not None:
+        cache_stats = tile_cache.stats()
+        cache_stats["reconstruction_seconds"] = reconstruction_time
+        logging.info(f"Tile cache : {cache_stats}")
+        with open(logdir / "tile_cache.json", "w") as f:
+            json.dump(cache_stats, f, indent=2)
+
+    if scene_renderer is not None:
+        description = scene_renderer.close()
+        logging.info(
+            f"Wrote the pyramids of {list(description['maps'])} in {logdir / 'pyramid'}"
+        )
+
+    if scene_metrics is not None:
+        scene_name = config["data"]["dataset"]["name"]
+        report = scene_metrics.save(
+            logdir / f"metrics_{scene_name}.json",
+            scene=scene_name,
+            crop=config["data"]["crop"],
+            reconstruction_seconds=reconstruction_time,
+        )
+        logging.info(
+            f"Amplitude MSE {report['amplitude_mse']:.4e}, mean angular distance {report['angular_distance_mean']:.4f}"
+        )
+        if not keep_images:
+            return
 
     reconstructed_image = dt.reassemble_image(
         segments=reconstructed_tensors,
@@ -419,33 +671,264 @@ def test(config):
         segment_size=config["data"]["img_size"],
     )
 
+    if "metrics" in config and config["metrics"]["wishart"]:
+        logging.info("= Wishart classification of the scenes")
+        report = dt.wishart_fidelity(
+            dt.exp_amplitude_transform(original_image[0]).numpy(),
+            dt.exp_amplitude_transform(reconstructed_image[0]).numpy(),
+            decompositions=decompositions,
+        )
+        logging.info(f"Agreement of the Wishart classes : {report['wishart_accuracy']:.4f}")
+        scene_name = config["data"]["dataset"]["name"]
+        with open(logdir / f"wishart_{scene_name}.json", "w") as f:
+            json.dump(report, f, indent=2)
+
+    if reduced_precision:
+        precision = config["inference"]["precision"]
+        logging.info(f"= Reconstruction in {precision}")
+        reduced_model = inference.reduced_precision_model(complex_model, precision)
+
+        # The reduced precision kernels run on CPU
+        start_time = time.perf_counter()
+        reduced_tensors = utils.one_forward(
+            model=reduced_model,
+            loader=data_loader,
+            device=torch.device("cpu"),
+        )
+        reduced_time = time.perf_counter() - start_time
+
+        reduced_image = dt.reassemble_image(
+            segments=reduced_tensors,
+            nb_cols=config["data"]["crop"]["end_col"]
+            - config["data"]["crop"]["start_col"],
+            nb_rows=config["data"]["crop"]["end_row"]
+            - config["data"]["crop"]["start_row"],
+            num_channels=config["data"]["num_channels"],
+            segment_size=config["data"]["img_size"],
+        )
+
+        report = inference.precision_fidelity(reconstructed_image[0], reduced_image[0])
+        report["precision"] = precision
+        report["float32_seconds"] = reconstruction_time
+        report["reduced_seconds"] = reduced_time
+        report["speedup"] = reconstruction_time / reduced_time
+        logging.info(f"Fidelity of the {precision} reconstruction : {report}")
+        with open(logdir / f"precision_fidelity_{precision}.json", "w") as f:
+            json.dump(report, f, indent=2)
+
+        reconstructed_image = reduced_image
+
     dt.show_images(
         samples=original_image,
         generated=reconstructed_image,
         image_path=logdir / f"full_images.png",
         last=False,
+        equalization=(
+            config["rendering"]["equalization"] if "rendering" in config else "percentile"
+        ),
+        decompositions=decompositions,
     )
 
+    if decompositions is not None:
+        logging.info(f"Decomposition cache : {decompositions.stats()}")
+        with open(logdir / "decomposition_cache.json", "w") as f:
+            json.dump(decompositions.stats(), f, indent=2)
+
+
+def export_shards(config):
+
+    use_cuda = torch.cuda.is_available()
+
+    logging.info("= Exporting the patches into shards")
+    dt.export_shards(config["data"], use_cuda)
+
+
+def export_onnx(config):
+
+    log_path = config["logging"]["logdir"]
+
+    # Load the checkpoint
+    checkpoint_path = log_path + "/best_model.pt"
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    logging.info(f"Loading checkpoint from {checkpoint_path}")
+
+    # Build the model
+    logging.info("= Model")
+    model = models.build_model(config)
+    model.load_state_dict(checkpoint["model_state_dict"])
+
+    export.export_model(
+        model,
+        log_path,
+        num_channels=config["data"]["num_channels"],
+        img_size=config["data"]["img_size"],
+    )
+
+
+def compress(config):
+
+    log_path = config["logging"]["logdir"]
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda") if use_cuda else torch.device("cpu")
+
+    # Load the checkpoint
+    checkpoint_path = log_path + "/best_model.pt"
+    checkpoint = torch.load(checkpoint_path, map_location=device)
+    logging.info(f"Loading checkpoint from {checkpoint_path}")
+
+    # Build the model
+    logging.info("= Model")
+    model = models.build_model(config)
+    model.load_state_dict(checkpoint["model_state_dict"])
+
+    logging.info("= Loading the scene")
+    scene = dt.load_crop(config["data"])
+
+    logging.info("= Compressing the scene")
+    codec_config = config["codec"]
+    scene_codec = codec.SceneCodec(
+        model,
+        tile_size=config["data"]["img_size"],
+        batch_size=codec_config["batch_size"],
+        bits=codec_config["bits"],
+        compression=codec_config["compression"],
+        device=device,
+    )
+    logdir = pathlib.Path(log_path)
+    report = codec.benchmark_codec(scene_codec, scene, logdir / "scene.aelc")
+    logging.info(f"Compression report : {report}")
+    with open(logdir / "codec_report.json", "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def batch(config):
+
+    log_path = config["logging"]["logdir"]
+
+    # Load the checkpoint
+    checkpoint_path = log_path + "/best_model.pt"
+    checkpoint = torch.load(checkpoint_path, map_location=torch.device("cpu"))
+    logging.info(f"Loading checkpoint from {checkpoint_path}")
+
+    # Build the model
+    logging.info("= Model")
+    model = models.build_model(config)
+    model.load_state_dict(checkpoint["model_state_dict"])
+
+    batch_config = config["batch"]
+    scenes = scheduler.load_manifest(batch_config["manifest"])
+    logging.info(
+        f"= Reconstructing the {len(scenes)} scenes of {batch_config['manifest']}"
+    )
+    scheduler.run_batch(
+        model,
+        scenes,
+        config["data"],
+        pathlib.Path(log_path) / "batch",
+        num_workers=batch_config["num_workers"],
+        num_threads=batch_config["threads"],
+        checkpoint_tiles=batch_config["checkpoint_tiles"],
+        metrics_config=config["metrics"] if "metrics" in config else None,
+    )
+
+
+def index(config):
+
+    log_path = config["logging"]["logdir"]
+    use_cuda = torch.cuda.is_available()
+    device = torch.device("cuda") if use_cuda else torch.device("cpu")
+
+    # Load the checkpoint
+    checkpoint_path = log_path + "/best_model.pt"
+    checkpoint = torch.load(checkpoint_path, map_location=device)
+    logging.info(f"Loading checkpoint from {checkpoint_path}")
+
+    # Build the model
+    logging.info("= Model")
+    model = models.build_model(config)
+    model.load_state_dict(checkpoint["model_state_dict"])
+
+    logging.info("= Loading the scene")
+    scene = dt.load_crop(config["data"])
+
+    logging.info("= Computing the tile embeddings")
+    search_config = config["search"]
+    vectors, coordinates = search.tile_embeddings(
+        model,
+        scene,
+        tile_size=config["data"]["img_size"],
+        batch_size=config["data"]["batch_size"],
+        device=device,
+    )
+
+    # The index is shared between the runs, every indexed scene being appended to it
+    index_path = pathlib.Path(search_config["index_path"])
+    if index_path.exists():
+        logging.info(f"= Loading the index from {index_path}")
+        tile_index = search.IVFPQIndex.load(index_path)
+    else:
+        logging.info("= Creating the index")
+        tile_index = search.IVFPQIndex(
+            num_lists=search_config["num_lists"],
+            num_subquantizers=search_config["num_subquantizers"],
+            nprobe=search_config["nprobe"],
+            rerank=search_config["rerank"],
+        )
+    scene_name = config["data"]["dataset"]["name"]
+    ids = tile_index.add(
+        vectors, [[scene_name, row, col] for row, col in coordinates.tolist()]
+    )
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+    tile_index.save(index_path)
+    logging.info(f"Added {len(ids)} tiles, the index holds {len(tile_index)} tiles")
+
+    # The brute force reference needs all the indexed vectors, which are only
+    # known when the index keeps them for reranking or holds this scene only
+    if tile_index.rerank > 0:
+        all_vectors = tile_index.vectors.float()
+    elif ids[0] == 0:
+        all_vectors = vectors
+    else:
+        logging.info("The index does not keep its vectors, the benchmark is skipped")
+        return
+
+    logging.info("= Benchmarking the index")
+    generator = torch.Generator().manual_seed(0)
+    queries = vectors[torch.randperm(len(vectors), generator=generator)[:100]]
+    report = search.benchmark_index(tile_index, all_vectors, queries, k=search_config["k"])
+    logging.info(f"Search report : {report}")
+    with open(pathlib.Path(log_path) / "search_benchmark.json", "w") as f:
+        json.dump(report, f, indent=2)
+
 
 if __name__ == "__main__":
     logging.basicConfig(stream=sys.stdout, level=logging.INFO, format="%(message)s")
 
-    if sys.argv[2] not in ["train", "retrain", "test"]:
-        if sys.argv[2] == "train":
+    if sys.argv[2] not in [
+        "train",
+        "retrain",
+        "test",
+        "export_shards",
+        "export_onnx",
+        "compress",
+        "index",
+        "batch",
+    ]:
+        if sys.argv[2] in ["train", "export_shards"]:
             if len(sys.argv) != 3:
-                logging.error(f"Usage : {sys.argv[0]} config.yaml train")
+                logging.error(f"Usage : {sys.argv[0]} config.yaml train|export_shards")
                 sys.exit(-1)
         else:
             if len(sys.argv) != 5:
                 logging.error(
-                    f"Usage : {sys.argv[0]} config.yaml retrain|test path_to_run"
+                    f"Usage : {sys.argv[0]} config.yaml retrain|test|export_onnx|compress|index|batch path_to_run"
                 )
                 sys.exit(-1)
 
     command = sys.argv[2]
     logging.info("Loading {}".format(sys.argv[1]))
 
-    if command == "train":
+    if command in ["train", "export_shards"]:
         config = yaml.safe_load(open(sys.argv[1], "r"))
         config["pretrained"] = False
     else:
@@ -0,0 +1,173 @@
+# coding: utf-8
+
+# Standard imports
+import copy
+import logging
+
+# External imports
+import torch
+
+# Local imports
+from .models.complexity import profile_model
+
+
+def available_memory(device=torch.device("cpu")):
+    """Returns the free memory of the device, in bytes"""
+    if device.type == "cuda":
+        return torch.cuda.mem_get_info(device)[0]
+    with open("/proc/meminfo") as f:
+        for line in f:
+            if line.startswith("MemAvailable"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("Cannot read the available memory from /proc/meminfo")
+
+
+def measure_peak_bytes(model, input_shape, training):
+    """
+    Measures the peak memory allocated by a forward pass of the model, and in
+    training by its backward pass, on zero inputs of the given shape. On CPU,
+    the allocations and frees recorded by the profiler are replayed in order.
+
+    Arguments:
+        model: the complex model, copied to keep its running statistics untouched
+        input_shape: the (B, C, H, W) shape of the inputs
+        training: whether to measure a training step or an inference
+
+    Returns:
+        The peak of the memory allocated during the pass, in bytes
+    """
+    model = copy.deepcopy(model).train(training)
+    device = next(model.parameters()).device
+    inputs = torch.zeros(input_shape, dtype=torch.complex64, device=device)
+
+    def step():
+        if training:
+            model(inputs).abs().mean().backward()
+        else:
+            with torch.no_grad():
+                model(inputs)
+
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        baseline = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        step()
+        torch.cuda.synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - baseline
+
+    with torch.profiler.profile(profile_memory=True) as profiler:
+        step()
+    events = sorted(profiler.events(), key=lambda event: event.time_range.start)
+    allocated, peak = 0, 0
+    for event in events:
+        allocated += event.self_cpu_memory_usage
+        peak = max(peak, allocated)
+    return peak
+
+
+def plan_batch_size(
+    model,
+    input_size,
+    budget,
+    training,
+    safety=0.8,
+    max_batch_size=1024,
+    probe_batch_sizes=(1, 2),
+):
+    """
+    Finds the largest batch size whose peak memory fits in the budget.
+
+    The peak memory is modelled as fixed + batch_size * per_sample. The analytic
+    accounting of profile_model gives the activations per sample (the tensors
+    saved for the backward in training, the largest input and output of a
+    layer in inference) and the fixed cost of the parameters (and in training,
+    of their gradients and of the two moments of Adam). A short probing run at
+    two small batch sizes measures the actual peaks, which also include the
+    temporaries of the layers. The larger of both slopes is kept, and the fixed
+    cost measured by the probe is added to the one of the parameters.
+
+    Arguments:
+        model: the complex model
+        input_size: the (C, H, W) size of one sample
+        budget: the memory budget in bytes, None for the memory available
+        training: whether to plan a training step or an inference
+        safety: the fraction of the budget that the peak may use
+        max_batch_size: the upper bound of the batch size
+        probe_batch_sizes: the two batch sizes of the probing run
+
+    Returns:
+        The dictionnary describing the decision, "batch_size" being the batch size
+    """
+    device = next(model.parameters()).device
+    if budget is None:
+        budget = available_memory(device)
+    input_size = tuple(input_size)
+
+    totals = profile_model(model, (1,) + input_size)["totals"]
+    if training:
+        analytic_per_sample = totals["training_saved_activation_bytes"]
+        analytic_fixed = totals["training_parameter_state_bytes"]
+    else:
+        analytic_per_sample = totals["inference_peak_activation_bytes"]
+        analytic_fixed = totals["parameter_bytes"]
+
+    small, large = probe_batch_sizes
+    probe_small = measure_peak_bytes(model, (small,) + input_size, training)
+    probe_large = measure_peak_bytes(model, (large,) + input_size, training)
+    probe_per_sample = (probe_large - probe_small) / (large - small)
+    probe_fixed = max(probe_small - small * probe_per_sample, 0)
+
+    per_sample = max(analytic_per_sample, probe_per_sample)
+    fixed = analytic_fixed + probe_fixed
+    usable = safety * budget - fixed
+    batch_size = int(min(max(usable // per_sample, 1), max_batch_size))
+
+    plan = {
+        "mode": "training" if training else "inference",
+        "input_size": list(input_size),
+        "budget_bytes": int(budget),
+        "safety": safety,
+        "analytic_bytes_per_sample": int(analytic_per_sample),
+        "analytic_fixed_bytes": int(analytic_fixed),
+        "probe_batch_sizes": list(probe_batch_sizes),
+        "probe_peak_bytes": [int(probe_small), int(probe_large)],
+        "bytes_per_sample": int(per_sample),
+        "fixed_bytes": int(fixed),
+        "batch_size": batch_size,
+        "estimated_peak_bytes": int(fixed + batch_size * per_sample),
+    }
+    if usable < per_sample:
+        logging.warning(
+            f"A single sample needs {(fixed + per_sample) / 2**30:.2f} GiB, "
+            f"more than {safety:.0%} of the {budget / 2**30:.2f} GiB budget"
+        )
+    logging.info(
+        f"  - {plan['mode'].capitalize()} batch size {batch_size} : "
+        f"{per_sample / 2**20:.1f} MiB per sample + {fixed / 2**20:.1f} MiB, "
+        f"estimated peak {plan['estimated_peak_bytes'] / 2**30:.2f} GiB "
+        f"out of {budget / 2**30:.2f} GiB"
+    )
+    return plan
+
+
+def plan_from_config(model, config, training):
+    """
+    Plans the batch size with the memory section of the configuration
+
+    Returns:
+        The dictionnary of plan_batch_size
+    """
+    memory_config = config["memory"]
+    budget = memory_config["budget_gb"]
+    return plan_batch_size(
+        model,
+        (
+            config["data"]["num_channels"],
+            config["data"]["img_size"],
+            config["data"]["img_size"],
+        ),
+        budget=budget * 2**30 if budget is not None else None,
+        training=training,
+        safety=memory_config["safety"],
+        max_batch_size=memory_config["max_batch_size"],
+    )
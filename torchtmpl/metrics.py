@@ -0,0 +1,204 @@
+# coding: utf-8
+
+# Standard imports
+import json
+
+# External imports
+import numpy as np
+import torch
+
+# Local imports
+from . import data as dt
+
+# The labels of the H-alpha classes, 0 being given to the pixels left unclassified
+NUM_H_ALPHA_CLASSES = 10
+
+
+class StreamingMetrics:
+    """
+    Reconstruction metrics of a scene accumulated over the (original,
+    reconstruction) tile pairs, in a memory independent of the size of the scene.
+
+    The tiles are given in the log amplitude domain of the model and the metrics
+    are computed in the physical domain, as in show_images:
+        - the mean squared error of the amplitudes, per channel
+        - the circular statistics of the phase errors, per channel
+        - fixed-bin histograms of the amplitude differences and of the phase errors
+        - the confusion counts of the H-alpha classes, which are computed per tile
+          and therefore lose a border of 3 pixels around every tile
+
+    Arguments:
+        num_channels: the number of channels of the tiles
+        amplitude_range: the histogram of the amplitude differences covers
+                         [-amplitude_range, amplitude_range], the values outside
+                         being counted apart
+        bins: the number of bins of the histograms
+        h_alpha: whether to compute the H-alpha confusion counts, which is costly
+    """
+
+    def __init__(self, num_channels, amplitude_range=1.0, bins=100, h_alpha=True):
+        self.num_channels = num_channels
+        self.h_alpha = h_alpha
+        self.amplitude_edges = np.linspace(-amplitude_range, amplitude_range, bins + 1)
+        self.phase_edges = np.linspace(-np.pi, np.pi, bins + 1)
+
+        self.num_pixels = 0
+        self.squared_amplitude_error = np.zeros(num_channels)
+        self.absolute_phase_error = np.zeros(num_channels)
+        self.phase_error_cos = np.zeros(num_channels)
+        self.phase_error_sin = np.zeros(num_channels)
+        self.amplitude_counts = np.zeros(bins, dtype=np.int64)
+        self.amplitude_outliers = np.zeros(2, dtype=np.int64)
+        self.phase_counts = np.zeros(bins, dtype=np.int64)
+        self.h_alpha_counts = np.zeros(
+            NUM_H_ALPHA_CLASSES * NUM_H_ALPHA_CLASSES, dtype=np.int64
+        )
+
+    def update(self, originals, reconstructions):
+        """
+        Accumulates a batch of tiles
+
+        Arguments:
+            originals: the (B, C, H, W) complex tiles fed to the model
+            reconstructions: the (B, C, H, W) complex outputs of the model
+        """
+        originals = dt.exp_amplitude_transform(np.asarray(originals)).numpy()
+        reconstructions = dt.exp_amplitude_transform(
+            np.asarray(reconstructions)
+        ).numpy()
+
+        self.num_pixels += originals.shape[0] * originals.shape[2] * originals.shape[3]
+
+        amplitude_difference = np.abs(originals) - np.abs(reconstructions)
+        self.squared_amplitude_error += np.square(amplitude_difference).sum(
+            axis=(0, 2, 3)
+        )
+        self.amplitude_counts += np.histogram(
+            amplitude_difference, bins=self.amplitude_edges
+        )[0]
+        self.amplitude_outliers += [
+            np.count_nonzero(amplitude_difference < self.amplitude_edges[0]),
+            np.count_nonzero(amplitude_difference > self.amplitude_edges[-1]),
+        ]
+
+        phase_error = dt.angular_distance(originals, reconstructions)
+        self.absolute_phase_error += np.abs(phase_error).sum(axis=(0, 2, 3))
+        self.phase_error_cos += np.cos(phase_error).sum(axis=(0, 2, 3))
+        self.phase_error_sin += np.sin(phase_error).sum(axis=(0, 2, 3))
+        self.phase_counts += np.histogram(phase_error, bins=self.phase_edges)[0]
+
+        if self.h_alpha:
+            for original, reconstruction in zip(originals, reconstructions):
+                classes_original = dt.h_alpha_classes(
+                    dt.local_covariances(dt.pauli_transform(original).transpose(1, 2, 0))
+                )
+                classes_reconstruction = dt.h_alpha_classes(
+                    dt.local_covariances(
+                        dt.pauli_transform(reconstruction).transpose(1, 2, 0)
+                    )
+                )
+                self.h_alpha_counts += np.bincount(
+                    (
+                        NUM_H_ALPHA_CLASSES * classes_original + classes_reconstruction
+                    ).ravel(),
+                    minlength=NUM_H_ALPHA_CLASSES * NUM_H_ALPHA_CLASSES,
+                )
+
+    def merge(self, other):
+        """Adds the counts accumulated by another StreamingMetrics, e.g. on another strip"""
+        self.num_pixels += other.num_pixels
+        self.squared_amplitude_error += other.squared_amplitude_error
+        self.absolute_phase_error += other.absolute_phase_error
+        self.phase_error_cos += other.phase_error_cos
+        self.phase_error_sin += other.phase_error_sin
+        self.amplitude_counts += other.amplitude_counts
+        self.amplitude_outliers += other.amplitude_outliers
+        self.phase_counts += other.phase_counts
+        self.h_alpha_counts += other.h_alpha_counts
+        return self
+
+    def state_dict(self):
+        """Returns the accumulated counts, json serializable, to resume the accumulation"""
+        return {
+            name: value.tolist() if isinstance(value, np.ndarray) else value
+            for name, value in vars(self).items()
+        }
+
+    def load_state_dict(self, state):
+        """Restores the counts of state_dict"""
+        for name, value in state.items():
+            current = getattr(self, name)
+            if isinstance(current, np.ndarray):
+                value = np.asarray(value, dtype=current.dtype)
+            setattr(self, name, value)
+        return self
+
+    def report(self):
+        """
+        Returns:
+            The dictionnary of the metrics, json serializable
+        """
+        num_pixels = max(self.num_pixels, 1)
+        amplitude_mse = self.squared_amplitude_error / num_pixels
+
+        # Mean resultant length of the phase errors and the derived circular statistics
+        resultant = np.hypot(self.phase_error_cos, self.phase_error_sin) / num_pixels
+        circular_std = np.sqrt(-2 * np.log(np.clip(resultant, 1e-12, 1.0)))
+
+        amplitude_q5, amplitude_q95 = dt.histogram_quantiles(
+            self.amplitude_counts, self.amplitude_edges, (0.05, 0.95)
+        )
+        report = {
+            "num_pixels": self.num_pixels,
+            "amplitude_mse": float(amplitude_mse.mean()),
+            "amplitude_mse_per_channel": amplitude_mse.tolist(),
+            "amplitude_difference_q5": amplitude_q5,
+            "amplitude_difference_q95": amplitude_q95,
+            "amplitude_difference_histogram": {
+                "edges": self.amplitude_edges.tolist(),
+                "counts": self.amplitude_counts.tolist(),
+                "below": int(self.amplitude_outliers[0]),
+                "above": int(self.amplitude_outliers[1]),
+            },
+            "angular_distance_mean": float(
+                self.absolute_phase_error.sum() / (num_pixels * self.num_channels)
+            ),
+            "angular_distance_mean_per_channel": (
+                self.absolute_phase_error / num_pixels
+            ).tolist(),
+            "phase_error_circular_mean_per_channel": np.arctan2(
+                self.phase_error_sin, self.phase_error_cos
+            ).tolist(),
+            "phase_error_resultant_length_per_channel": resultant.tolist(),
+            "phase_error_circular_std_per_channel": circular_std.tolist(),
+            "angular_distance_histogram": {
+                "edges": self.phase_edges.tolist(),
+                "counts": self.phase_counts.tolist(),
+            },
+        }
+
+        if self.h_alpha:
+            counts = self.h_alpha_counts.reshape(
+                NUM_H_ALPHA_CLASSES, NUM_H_ALPHA_CLASSES
+            )
+            # Only the classes met in the scene are reported, as confusion_matrix does
+            present = np.flatnonzero(counts.sum(axis=0) + counts.sum(axis=1))
+            counts = counts[np.ix_(present, present)]
+            totals = counts.sum(axis=1, keepdims=True)
+            report["h_alpha_classes"] = present.tolist()
+            report["h_alpha_confusion_counts"] = counts.tolist()
+            report["h_alpha_confusion_normalized"] = (
+                counts / np.maximum(totals, 1)
+            ).round(3).tolist()
+            report["h_alpha_accuracy"] = float(
+                np.trace(counts) / max(counts.sum(), 1)
+            )
+        return report
+
+    def save(self, path, **extra):
+        """Writes the report, completed with the extra entries, as JSON"""
+        report = self.report()
+        report.update(extra)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        return report
@@ -1,6 +1,18 @@
 # Local imports
 
+import functools
+import logging
+
 from .complex_autoencoder_without_dense.model import AutoEncoderWD
+from .complex_autoencoder_without_dense.parts import (
+    DoubleConv,
+    SeparableDoubleConv,
+    GroupedDoubleConv,
+    InvertedBottleneck,
+)
+from .complexity import count_complexity, profile_model
+from .autotune import autotune
+from .batchnorm import fuse_batchnorms
 from torchcvnn.nn.modules.activation import *
 
 """
@@ -23,6 +35,28 @@ def build_model(cfg):
     activation = cfg["model"]["activation"]
     activation = eval(f"{activation}()")
 
-    return eval(
-        f"{model}(num_channels, num_layers, channels_ratio, latent_dim, img_size, activation)"
+    # The convolution block of the encoder and decoder, DoubleConv by default
+    block = DoubleConv
+    if "block" in cfg["model"]:
+        block = functools.partial(
+            eval(cfg["model"]["block"]["class"]), **cfg["model"]["block"]["params"]
+        )
+
+    model = eval(
+        f"{model}(num_channels, num_layers, channels_ratio, latent_dim, img_size, activation, block)"
     )
+    # The FLOPs, which need forward passes, are profiled by load and count_complexity
+    logging.info(f"  - {sum(p.numel() for p in model.parameters())} parameters")
+
+    # Compute the complex BatchNorms as one affine map per channel
+    if "fused_batchnorm" in cfg["model"] and cfg["model"]["fused_batchnorm"]:
+        model = fuse_batchnorms(model)
+
+    # Select the fastest implementation of every convolution for the training shapes
+    if "autotune" in cfg["model"] and cfg["model"]["autotune"]["enabled"]:
+        model, _ = autotune(
+            model,
+            (cfg["data"]["batch_size"], num_channels, img_size, img_size),
+            cfg["model"]["autotune"]["cache"],
+        )
+    return model
@@ -0,0 +1,271 @@
+""" Per-shape selection of the implementation of the complex convolutions
+
+A complex convolution can be computed natively in complex64, or on the real
+and imaginary parts: as one real convolution with a 2x2 block kernel
+("real_pair"), the same in channels last memory format ("channels_last"),
+as three real convolutions with Gauss' trick ("gauss") or as an unfold
+followed by a matrix product ("im2col"). The fastest one depends on the shape
+and on the host, it is measured for every convolution of the model and cached
+on disk per host and torch version.
+"""
+
+import json
+import logging
+import os
+import pathlib
+import platform
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+IMPLEMENTATIONS = ["native", "real_pair", "channels_last", "gauss", "im2col"]
+
+
+def host_key(device=torch.device("cpu")):
+    """Identifies the host CPU (or GPU) and the torch version"""
+    if device.type == "cuda":
+        name = torch.cuda.get_device_name(device)
+    else:
+        name = platform.processor() or platform.machine()
+        try:
+            with open("/proc/cpuinfo") as f:
+                for line in f:
+                    if line.startswith("model name"):
+                        name = line.split(":", 1)[1].strip()
+                        break
+        except OSError:
+            pass
+        name = f"{name} x{os.cpu_count()}"
+    return f"{name} | torch {torch.__version__}"
+
+
+class TunedConv2d(nn.Conv2d):
+    """
+    Complex nn.Conv2d computed with one of IMPLEMENTATIONS. It holds the same
+    parameters as nn.Conv2d, the checkpoints being unchanged.
+    """
+
+    implementation = "native"
+
+    @classmethod
+    def from_conv(cls, conv, implementation):
+        """Returns the TunedConv2d sharing the parameters of the complex conv"""
+        if implementation not in IMPLEMENTATIONS:
+            raise ValueError(
+                f"Unknown implementation {implementation}, expected one of {IMPLEMENTATIONS}"
+            )
+        if conv.groups != 1:
+            raise NotImplementedError("Grouped complex convolutions are not tuned")
+        tuned = cls(
+            conv.in_channels,
+            conv.out_channels,
+            kernel_size=conv.kernel_size,
+            stride=conv.stride,
+            padding=conv.padding,
+            dilation=conv.dilation,
+            bias=conv.bias is not None,
+            padding_mode=conv.padding_mode,
+            dtype=conv.weight.dtype,
+            device=conv.weight.device,
+        )
+        tuned.weight = conv.weight
+        tuned.bias = conv.bias
+        tuned.implementation = implementation
+        return tuned
+
+    def _pad(self, x):
+        if self.padding_mode == "zeros":
+            return x, self.padding
+        pad = (self.padding[1], self.padding[1], self.padding[0], self.padding[0])
+        return F.pad(x, pad, mode=self.padding_mode), 0
+
+    def _real_conv(self, x, weight, padding):
+        return F.conv2d(x, weight, None, self.stride, padding, self.dilation)
+
+    def forward(self, x):
+        if self.implementation == "native":
+            return super().forward(x)
+
+        x, padding = self._pad(x)
+        A, B = self.weight.real, self.weight.imag
+        x_real, x_imag = x.real, x.imag
+
+        if self.implementation == "gauss":
+            # (A + iB)(x + iy) = k1 - k2 + i (k1 + k3)
+            k1 = self._real_conv(x_real + x_imag, A, padding)
+            k2 = self._real_conv(x_imag, A + B, padding)
+            k3 = self._real_conv(x_real, B - A, padding)
+            y_real, y_imag = k1 - k2, k1 + k3
+        else:
+            pair = torch.cat((x_real, x_imag), dim=1)
+            weight = torch.cat((torch.cat((A, -B), dim=1), torch.cat((B, A), dim=1)))
+            if self.implementation == "channels_last":
+                pair = pair.contiguous(memory_format=torch.channels_last)
+                weight = weight.contiguous(memory_format=torch.channels_last)
+                y = self._real_conv(pair, weight, padding)
+            elif self.implementation == "im2col":
+                y = self._im2col(pair, weight, padding)
+            else:
+                y = self._real_conv(pair, weight, padding)
+            y_real, y_imag = y.chunk(2, dim=1)
+
+        y = torch.complex(y_real.contiguous(), y_imag.contiguous())
+        if self.bias is not None:
+            y = y + self.bias.view(1, -1, 1, 1)
+        return y
+
+    def _im2col(self, x, weight, padding):
+        batch_size, _, height, width = x.shape
+        padding = (padding, padding) if isinstance(padding, int) else padding
+        kernel_size = self.kernel_size
+        out_height = (
+            height + 2 * padding[0] - self.dilation[0] * (kernel_size[0] - 1) - 1
+        ) // self.stride[0] + 1
+        out_width = (
+            width + 2 * padding[1] - self.dilation[1] * (kernel_size[1] - 1) - 1
+        ) // self.stride[1] + 1
+        columns = F.unfold(
+            x, kernel_size, dilation=self.dilation, padding=padding, stride=self.stride
+        )  # B, C k k, L
+        y = weight.flatten(1) @ columns
+        return y.view(batch_size, -1, out_height, out_width)
+
+
+def _signature(conv, input_shape):
+    return json.dumps(
+        {
+            "in": conv.in_channels,
+            "out": conv.out_channels,
+            "kernel": list(conv.kernel_size),
+            "stride": list(conv.stride),
+            "padding": list(conv.padding),
+            "padding_mode": conv.padding_mode,
+            "dilation": list(conv.dilation),
+            "bias": conv.bias is not None,
+            "input": list(input_shape),
+        },
+        sort_keys=True,
+    )
+
+
+def benchmark_implementations(conv, input_shape, repeats=5, warmup=1):
+    """
+    Measures the mean time of a forward and backward pass of the convolution
+    with every implementation
+
+    Returns:
+        A dictionnary implementation -> seconds
+    """
+    device = conv.weight.device
+    x = torch.randn(input_shape, dtype=torch.complex64, device=device)
+    probe = TunedConv2d.from_conv(conv, "native")
+    probe.weight = nn.Parameter(conv.weight.detach().clone())
+    if conv.bias is not None:
+        probe.bias = nn.Parameter(conv.bias.detach().clone())
+    timings = {}
+    for implementation in IMPLEMENTATIONS:
+        probe.implementation = implementation
+        for step in range(warmup + repeats):
+            if step == warmup:
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                start_time = time.perf_counter()
+            probe.zero_grad(set_to_none=True)
+            probe(x).abs().sum().backward()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        timings[implementation] = (time.perf_counter() - start_time) / repeats
+    return timings
+
+
+def load_cache(cache_path):
+    cache_path = pathlib.Path(cache_path)
+    if cache_path.exists():
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def autotune(model, input_shape, cache_path, repeats=5):
+    """
+    Replaces, in place, every complex nn.Conv2d of the model, but the grouped
+    ones, by a TunedConv2d using the fastest implementation for its input
+    shape. The shapes are recorded with a forward pass of a (B, C, H, W) input,
+    the implementations are benchmarked for the shapes missing from the cache,
+    which is then updated.
+
+    Arguments:
+        model: the complex model
+        input_shape: the (B, C, H, W) shape of the inputs of the model
+        cache_path: the json file of the cached choices, keyed by host_key
+        repeats: the number of timed passes per implementation
+
+    Returns:
+        The model and the dictionnary name -> implementation
+    """
+    convs = {
+        name: module
+        for name, module in model.named_modules()
+        if isinstance(module, nn.Conv2d)
+        and module.weight.is_complex()
+        and module.groups == 1
+    }
+    shapes = {}
+
+    def record_shape(name):
+        def hook(module, args):
+            shapes[name] = tuple(args[0].shape)
+
+        return hook
+
+    handles = [
+        module.register_forward_pre_hook(record_shape(name))
+        for name, module in convs.items()
+    ]
+    device = next(model.parameters()).device
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        model(torch.zeros(input_shape, dtype=torch.complex64, device=device))
+    model.train(training)
+    for handle in handles:
+        handle.remove()
+
+    cache = load_cache(cache_path)
+    key = host_key(device)
+    choices = cache.setdefault(key, {})
+    num_benchmarks = 0
+    selected = {}
+    parents = dict(model.named_modules())
+    for name, conv in convs.items():
+        if name not in shapes:
+            continue
+        signature = _signature(conv, shapes[name])
+        if signature not in choices:
+            timings = benchmark_implementations(conv, shapes[name], repeats=repeats)
+            choices[signature] = min(timings, key=timings.get)
+            num_benchmarks += 1
+            logging.info(
+                f"  - {name} {tuple(shapes[name])} : "
+                + ", ".join(f"{impl} {1e3 * t:.2f} ms" for impl, t in timings.items())
+            )
+        selected[name] = choices[signature]
+        parent_name, _, child_name = name.rpartition(".")
+        parents[parent_name]._modules[child_name] = TunedConv2d.from_conv(
+            conv, selected[name]
+        )
+
+    if num_benchmarks > 0:
+        cache_path = pathlib.Path(cache_path)
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        # The cache is shared between runs, it is replaced atomically
+        tmp_path = cache_path.with_suffix(cache_path.suffix + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_path, cache_path)
+    logging.info(
+        f"  - Autotuned {len(selected)} convolutions, {num_benchmarks} benchmarked"
+    )
+    return model, selected
@@ -0,0 +1,205 @@
+""" Fused complex BatchNorm
+
+torchcvnn BatchNorm2d whitens every channel with the inverse square root of
+the 2x2 covariance of its real and imaginary parts, then applies a 2x2 affine
+map. Both collapse into y = M x + c per channel, with M = weight cov^-1/2 and
+c = bias - M mean, so that the batch is read once for the statistics and once
+to be normalized. The backward only involves per channel 2x2 quantities
+besides two reductions and one elementwise pass over the batch.
+"""
+
+import copy
+import time
+
+import torch
+import torchcvnn.nn.modules as c_nn
+from torchcvnn.nn.modules.batchnorm import inv_sqrt_2x2
+
+
+def _affine_map(mean, covs, weight, bias, eps):
+    """Returns the (C, 2, 2) M and the (C, 2) c of y = M x + c"""
+    M = inv_sqrt_2x2(covs + eps * torch.eye(2, device=covs.device, dtype=covs.dtype))
+    if weight is not None:
+        M = torch.bmm(weight, M)
+    c = -torch.bmm(M, mean.unsqueeze(-1)).squeeze(-1)
+    if bias is not None:
+        c = c + bias
+    return M, c
+
+
+def _channel_shape(x):
+    # Broadcasts a (C, 2) tensor over the (B, C, ..., 2) real view
+    return (1, -1) + (1,) * (x.dim() - 3) + (2,)
+
+
+def _apply_affine(M, c, x):
+    """y = M x + c on the (B, C, ..., 2) real view of a complex tensor"""
+    return torch.einsum("cij,bc...j->bc...i", M, x) + c.view(_channel_shape(x))
+
+
+class _FusedBatchNormFunction(torch.autograd.Function):
+    """
+    Training forward of the BatchNorm on the (B, C, ..., 2) real view of the
+    input, returning the normalized view and the batch mean and covariances.
+    Only the input is saved for backward, with tensors of size C.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, bias, eps):
+        dims = [0] + list(range(2, x.dim() - 1))
+        num_samples = x.numel() // (x.shape[1] * 2)
+        mean = x.mean(dim=dims)  # C, 2
+        centered = x - mean.view(_channel_shape(x))
+        covs = torch.einsum("bc...i,bc...j->cij", centered, centered) / (
+            num_samples - 1
+        )
+        del centered
+        M, c = _affine_map(mean, covs, weight, bias, eps)
+        ctx.save_for_backward(x, mean, covs, weight, bias, M)
+        ctx.eps = eps
+        ctx.mark_non_differentiable(mean, covs)
+        return _apply_affine(M, c, x), mean, covs
+
+    @staticmethod
+    def backward(ctx, grad_y, grad_mean, grad_covs):
+        x, mean, covs, weight, bias, M = ctx.saved_tensors
+        num_samples = x.numel() // (x.shape[1] * 2)
+
+        # The two reductions of the upstream gradient over the batch
+        grad_M = torch.einsum("bc...i,bc...j->cij", grad_y, x)
+        grad_c = grad_y.sum(dim=[0] + list(range(2, x.dim() - 1)))
+
+        # Back through the per channel 2x2 algebra, on tensors of size C
+        with torch.enable_grad():
+            small = [
+                t.detach().requires_grad_() if t is not None else None
+                for t in (mean, covs, weight, bias)
+            ]
+            M_small, c_small = _affine_map(*small, ctx.eps)
+            grads = torch.autograd.grad(
+                (M_small, c_small),
+                [t for t in small if t is not None],
+                (grad_M, grad_c),
+            )
+        grad_mean, grad_covs = grads[0], grads[1]
+        grad_weight = grads[2] if weight is not None else None
+        grad_bias = grads[-1] if bias is not None else None
+
+        # dx = M^T dy + dmean / N + (dcov + dcov^T)(x - mean) / (N - 1)
+        S = (grad_covs + grad_covs.transpose(1, 2)) / (num_samples - 1)
+        b = grad_mean / num_samples - torch.bmm(S, mean.unsqueeze(-1)).squeeze(-1)
+        grad_x = (
+            torch.einsum("cji,bc...j->bc...i", M, grad_y)
+            + torch.einsum("cij,bc...j->bc...i", S, x)
+            + b.view(_channel_shape(x))
+        )
+        return grad_x, grad_weight, grad_bias, None
+
+
+class FusedBatchNorm2d(c_nn.BatchNorm2d):
+    """
+    torchcvnn BatchNorm2d, with the same parameters, buffers and running
+    statistics updates, computed as a single affine map per channel
+    """
+
+    def forward(self, z):
+        x = torch.view_as_real(z)  # B, C, H, W, 2
+        weight = self.weight if self.affine else None
+        bias = torch.view_as_real(self.bias) if self.affine else None
+
+        if self.training or not self.track_running_stats:
+            y, mean, covs = _FusedBatchNormFunction.apply(x, weight, bias, self.eps)
+            if self.training and self.track_running_stats:
+                with torch.no_grad():
+                    self.running_mean.mul_(1.0 - self.momentum).add_(
+                        self.momentum * torch.view_as_complex(mean)
+                    )
+                    self.running_var.mul_(1.0 - self.momentum).add_(
+                        self.momentum * covs
+                    )
+                if torch.isnan(self.running_mean).any():
+                    raise RuntimeError("Running mean divergence")
+                if torch.isnan(self.running_var).any():
+                    raise RuntimeError("Running var divergence")
+        else:
+            M, c = _affine_map(
+                torch.view_as_real(self.running_mean),
+                self.running_var,
+                weight,
+                bias,
+                self.eps,
+            )
+            y = _apply_affine(M, c, x)
+        return torch.view_as_complex(y.contiguous())
+
+
+def fuse_batchnorms(model):
+    """
+    Replaces, in place, every torchcvnn BatchNorm2d of the model by a
+    FusedBatchNorm2d sharing its parameters and buffers
+    """
+    for module in list(model.modules()):
+        for name, child in module._modules.items():
+            if type(child) is c_nn.BatchNorm2d:
+                fused = FusedBatchNorm2d(
+                    child.num_features,
+                    eps=child.eps,
+                    momentum=child.momentum,
+                    affine=child.affine,
+                    track_running_stats=child.track_running_stats,
+                )
+                fused.weight, fused.bias = child.weight, child.bias
+                fused.running_mean = child.running_mean
+                fused.running_var = child.running_var
+                fused.num_batches_tracked = child.num_batches_tracked
+                module._modules[name] = fused
+    return model
+
+
+def compare_training_step(model, inputs, repeats=5):
+    """
+    Compares a training step of the model with its copy using FusedBatchNorm2d:
+    the outputs, the gradients and the mean time of a forward, backward and
+    AdamW step
+
+    Arguments:
+        model: the complex model, with torchcvnn BatchNorms
+        inputs: the (B, C, H, W) complex batch
+        repeats: the number of timed steps
+
+    Returns:
+        A dictionnary of the maximal absolute errors and of the timings
+    """
+    reference = copy.deepcopy(model).train()
+    fused = fuse_batchnorms(copy.deepcopy(model)).train()
+
+    def step(m, optimizer=None):
+        m.zero_grad(set_to_none=True)
+        output = m(inputs)
+        torch.mean(torch.square(torch.abs(output - inputs))).backward()
+        if optimizer is not None:
+            optimizer.step()
+        return output.detach()
+
+    output_error = (step(reference) - step(fused)).abs().max().item()
+    grad_error = max(
+        (p_ref.grad - p_fused.grad).abs().max().item()
+        for p_ref, p_fused in zip(reference.parameters(), fused.parameters())
+    )
+
+    timings = {}
+    for name, m in [("reference", reference), ("fused", fused)]:
+        optimizer = torch.optim.AdamW(m.parameters())
+        step(m, optimizer)
+        start_time = time.perf_counter()
+        for _ in range(repeats):
+            step(m, optimizer)
+        timings[name] = (time.perf_counter() - start_time) / repeats
+
+    return {
+        "output_max_abs_error": output_error,
+        "grad_max_abs_error": grad_error,
+        "reference_ms_per_step": 1e3 * timings["reference"],
+        "fused_ms_per_step": 1e3 * timings["fused"],
+        "speedup": timings["reference"] / timings["fused"],
+    }
@@ -14,6 +14,7 @@ class AutoEncoderWD(nn.Module):
         latent_dim,
         input_size,
         activation,
+        block=DoubleConv,
     ):
         super(AutoEncoderWD, self).__init__()
         self.n_channels = num_channels
@@ -22,12 +23,14 @@ class AutoEncoderWD(nn.Module):
         current_channels = channels_ratio
         self.encoder_layers = []
         self.encoder_layers.append(
-            DoubleConv(self.n_channels, current_channels, activation)
+            block(self.n_channels, current_channels, activation)
         )
         for i in range(1, num_layers):
             out_channels = channels_ratio * 2**i
             input_size //= 2
-            self.encoder_layers.append(Down(current_channels, out_channels, activation))
+            self.encoder_layers.append(
+                Down(current_channels, out_channels, activation, block)
+            )
             current_channels = out_channels
         self.encoder = nn.Sequential(*self.encoder_layers)
 
@@ -35,14 +38,22 @@ class AutoEncoderWD(nn.Module):
         self.decoder_layers = []
         for i in range(num_layers - 2, -1, -1):
             out_channels = channels_ratio * 2**i
-            self.decoder_layers.append(Up(current_channels, out_channels, activation))
+            self.decoder_layers.append(
+                Up(current_channels, out_channels, activation, block)
+            )
             current_channels = out_channels
         self.decoder_layers.append(OutConv(current_channels, num_channels))
         self.decoder = nn.Sequential(*self.decoder_layers)
 
+    def encode(self, x):
+        return self.encoder(x)
+
+    def decode(self, z):
+        return self.decoder(z)
+
     def forward(self, x):
-        x = self.encoder(x)
-        x = self.decoder(x)
+        x = self.encode(x)
+        x = self.decode(x)
         return x
 
     def use_checkpointing(self):
@@ -4,6 +4,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchcvnn.nn.modules as c_nn
+import math
 from math import prod
 
 
@@ -47,13 +48,132 @@ class DoubleConv(nn.Module):
         return self.double_conv(x)
 
 
+def complex_conv(in_channels, out_channels, kernel_size, stride=1, groups=1):
+    """Complex nn.Conv2d without bias, padded to keep the size at stride 1"""
+    return nn.Conv2d(
+        in_channels,
+        out_channels,
+        kernel_size=kernel_size,
+        stride=stride,
+        padding=kernel_size // 2,
+        groups=groups,
+        bias=False,
+        padding_mode="replicate",
+        dtype=torch.complex64,
+    )
+
+
+class SeparableDoubleConv(nn.Module):
+    """(depthwise convolution => pointwise convolution => [BN] => ReLU) * 2
+
+    Every 3x3 convolution of DoubleConv is factorized into a 3x3 convolution
+    per channel followed by a 1x1 convolution mixing the channels, which
+    divides its cost by about 9 for wide layers
+    """
+
+    def __init__(
+        self, in_channels, out_channels, activation, stride=1, mid_channels=None
+    ):
+        super().__init__()
+        if not mid_channels:
+            mid_channels = out_channels
+        self.double_conv = nn.Sequential(
+            complex_conv(in_channels, in_channels, 3, stride, groups=in_channels),
+            complex_conv(in_channels, mid_channels, 1),
+            c_nn.BatchNorm2d(mid_channels),
+            activation,
+            complex_conv(mid_channels, mid_channels, 3, groups=mid_channels),
+            complex_conv(mid_channels, out_channels, 1),
+            c_nn.BatchNorm2d(out_channels),
+            activation,
+        )
+
+    def forward(self, x):
+        return self.double_conv(x)
+
+
+class GroupedDoubleConv(nn.Module):
+    """(grouped convolution => [BN] => ReLU) * 2, with a channel shuffle in between
+
+    The 3x3 convolutions only connect the channels within `groups` groups,
+    reduced to a common divisor of the channels, which divides their cost by
+    `groups`. The shuffle lets the second convolution mix the groups of the first.
+    """
+
+    def __init__(
+        self,
+        in_channels,
+        out_channels,
+        activation,
+        stride=1,
+        mid_channels=None,
+        groups=4,
+    ):
+        super().__init__()
+        if not mid_channels:
+            mid_channels = out_channels
+        first_groups = math.gcd(groups, math.gcd(in_channels, mid_channels))
+        second_groups = math.gcd(groups, math.gcd(mid_channels, out_channels))
+        self.double_conv = nn.Sequential(
+            complex_conv(in_channels, mid_channels, 3, stride, groups=first_groups),
+            c_nn.BatchNorm2d(mid_channels),
+            activation,
+            nn.ChannelShuffle(second_groups),
+            complex_conv(mid_channels, out_channels, 3, groups=second_groups),
+            c_nn.BatchNorm2d(out_channels),
+            activation,
+        )
+
+    def forward(self, x):
+        return self.double_conv(x)
+
+
+class InvertedBottleneck(nn.Module):
+    """pointwise expansion => [BN] => ReLU => depthwise convolution => [BN] => ReLU
+    => pointwise projection => [BN], with a residual connection when the
+    shapes allow it (MobileNetV2)
+
+    The 3x3 convolution is computed per channel on `expansion` times the input
+    channels, the channels being mixed by the 1x1 convolutions only
+    """
+
+    def __init__(
+        self,
+        in_channels,
+        out_channels,
+        activation,
+        stride=1,
+        mid_channels=None,
+        expansion=4,
+    ):
+        super().__init__()
+        if not mid_channels:
+            mid_channels = in_channels * expansion
+        self.residual = stride == 1 and in_channels == out_channels
+        self.bottleneck = nn.Sequential(
+            complex_conv(in_channels, mid_channels, 1),
+            c_nn.BatchNorm2d(mid_channels),
+            activation,
+            complex_conv(mid_channels, mid_channels, 3, stride, groups=mid_channels),
+            c_nn.BatchNorm2d(mid_channels),
+            activation,
+            complex_conv(mid_channels, out_channels, 1),
+            c_nn.BatchNorm2d(out_channels),
+        )
+
+    def forward(self, x):
+        if self.residual:
+            return x + self.bottleneck(x)
+        return self.bottleneck(x)
+
+
 class Down(nn.Module):
     """Downscaling with maxpool then double conv"""
 
-    def __init__(self, in_channels, out_channels, activation):
+    def __init__(self, in_channels, out_channels, activation, block=DoubleConv):
         super().__init__()
         self.maxpool_conv = nn.Sequential(
-            DoubleConv(
+            block(
                 in_channels,
                 out_channels,
                 activation,
@@ -68,12 +188,12 @@ class Down(nn.Module):
 class Up(nn.Module):
     """Upscaling then double conv"""
 
-    def __init__(self, in_channels, out_channels, activation):
+    def __init__(self, in_channels, out_channels, activation, block=DoubleConv):
         super().__init__()
         self.up = c_nn.ConvTranspose2d(
             in_channels, out_channels, kernel_size=2, stride=2
         )
-        self.conv = DoubleConv(out_channels, out_channels, activation)
+        self.conv = block(out_channels, out_channels, activation)
 
     def forward(self, x):
         x = self.up(x)
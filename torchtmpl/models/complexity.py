@@ -0,0 +1,269 @@
+""" Parameters, FLOPs and memory of the complex models
+
+torchinfo counts a complex64 tensor like a real one and ignores the layers
+without weights. Here, the FLOPs are real operations: a complex multiply-add
+costs 4 real multiplications and 4 real additions, and the torchcvnn
+BatchNorm2d and the activations are given a cost per complex element (a
+square root, an atan2 or a sine counting as one operation). The memory is
+measured on the tensors actually produced by a forward pass: the outputs of
+the layers and, in training, the tensors saved by autograd for the backward.
+"""
+
+import copy
+
+import torch
+import torch.nn as nn
+import torchcvnn.nn.modules as c_nn
+
+from .batchnorm import FusedBatchNorm2d
+
+# Real operations per complex element of the activations
+ACTIVATION_FLOPS = {
+    # |z| (4), + b, relu, angle (1), exp(i angle) (2), product (2)
+    "modReLU": 11,
+    "CReLU": 2,
+    "zReLU": 4,
+    "zAbsReLU": 6,
+    "zLeakyReLU": 6,
+    "CPReLU": 4,
+    "Mod": 4,
+    "Cardioid": 12,
+}
+
+# Real operations per complex element of the BatchNorm: the mean (2), the
+# centering (2) and the 2x2 covariance (8) in training, the whitening (6),
+# the 2x2 affine map (6) and the bias (2). FusedBatchNorm2d folds the
+# whitening, the affine map and the centering into a single 2x2 affine map.
+BATCHNORM_FLOPS = {"train": 26, "eval": 16}
+FUSED_BATCHNORM_FLOPS = {"train": 20, "eval": 8}
+
+
+def _is_leaf(module):
+    # torchcvnn ConvTranspose2d is made of two real transposed convolutions
+    return len(module._modules) == 0 or isinstance(module, c_nn.ConvTranspose2d)
+
+
+def _tensor_bytes(tensor):
+    return tensor.numel() * tensor.element_size()
+
+
+def layer_flops(module, inputs, output):
+    """
+    Real FLOPs of one call of a leaf module
+
+    Returns:
+        The number of operations, None for the modules without a known cost
+    """
+    if isinstance(module, nn.Conv2d):
+        kernel_height, kernel_width = module.kernel_size
+        macs = (
+            output.numel()
+            * (module.in_channels // module.groups)
+            * kernel_height
+            * kernel_width
+        )
+        flops = (8 if module.weight.is_complex() else 2) * macs
+        if module.bias is not None:
+            flops += (2 if module.bias.is_complex() else 1) * output.numel()
+        return flops
+    if isinstance(module, c_nn.ConvTranspose2d):
+        # Four real transposed convolutions, every input pixel being spread
+        # over a kernel, each adding its bias, then combined by two additions
+        conv = module.m_real
+        kernel_height, kernel_width = conv.kernel_size
+        macs = (
+            inputs[0].numel()
+            * (conv.out_channels // conv.groups)
+            * kernel_height
+            * kernel_width
+        )
+        flops = 8 * macs + 2 * output.numel()
+        if conv.bias is not None:
+            flops += 4 * output.numel()
+        return flops
+    if isinstance(module, c_nn.BatchNorm2d):
+        mode = "train" if module.training else "eval"
+        costs = (
+            FUSED_BATCHNORM_FLOPS
+            if isinstance(module, FusedBatchNorm2d)
+            else BATCHNORM_FLOPS
+        )
+        return costs[mode] * output.numel()
+    if type(module).__name__ in ACTIVATION_FLOPS:
+        return ACTIVATION_FLOPS[type(module).__name__] * output.numel()
+    if isinstance(module, (nn.Identity, nn.ChannelShuffle)):
+        return 0
+    return None
+
+
+def _profile_pass(model, inputs, training):
+    """Forward pass recording the leaf calls, see profile_model"""
+    layers = []
+    stack = []
+    saved_storages = set()
+
+    def pre_hook(name):
+        def hook(module, args):
+            if _is_leaf(module):
+                # A module shared by several layers, e.g. the activation, is
+                # named after the parent it is called from and its position in it
+                parent_name, parent, calls = stack[-1]
+                attributes = [
+                    key for key, child in parent._modules.items() if child is module
+                ]
+                position = calls.get(id(module), 0)
+                calls[id(module)] = position + 1
+                attribute = attributes[min(position, len(attributes) - 1)]
+                name_in_parent = f"{parent_name}.{attribute}".lstrip(".")
+                layers.append(
+                    {
+                        "name": name_in_parent,
+                        "type": type(module).__name__,
+                        "input_shape": list(args[0].shape),
+                        "saved_bytes": 0,
+                    }
+                )
+            stack.append((name, module, {}))
+
+        return hook
+
+    def post_hook(module, args, output):
+        stack.pop()
+        if not _is_leaf(module):
+            return
+        layer = layers[-1]
+        flops = layer_flops(module, args, output)
+        layer["output_shape"] = list(output.shape)
+        layer["output_dtype"] = str(output.dtype).replace("torch.", "")
+        layer["flops"] = flops
+        layer["output_bytes"] = _tensor_bytes(output)
+        layer["input_bytes"] = _tensor_bytes(args[0])
+
+    def pack_hook(tensor):
+        # Tensors saved by several operations, or views of a saved tensor,
+        # share their storage and are counted once
+        storage = tensor.untyped_storage()
+        key = (storage.data_ptr(), storage.nbytes())
+        if layers and stack and key not in saved_storages:
+            saved_storages.add(key)
+            layers[-1]["saved_bytes"] += storage.nbytes()
+        return tensor
+
+    handles = []
+    leaves = []
+    for name, module in model.named_modules():
+        # The submodules of a leaf, e.g. of ConvTranspose2d, are not profiled
+        if any(name.startswith(f"{leaf}.") for leaf in leaves):
+            continue
+        if _is_leaf(module):
+            leaves.append(name)
+        handles.append(module.register_forward_pre_hook(pre_hook(name)))
+        handles.append(module.register_forward_hook(post_hook))
+
+    model.train(training)
+    try:
+        if training:
+            with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda t: t):
+                model(inputs)
+        else:
+            with torch.no_grad():
+                model(inputs)
+    finally:
+        for handle in handles:
+            handle.remove()
+    return layers
+
+
+def profile_model(model, input_shape):
+    """
+    Profiles, layer by layer, a forward pass of the model in inference and in
+    training. The model is copied, its running statistics being left untouched.
+
+    For every call of a leaf layer, are reported its real FLOPs, the bytes of
+    its parameters (a parameter shared by several layers being counted at its
+    first call), of its output and, in training, of the tensors it saves for
+    the backward. The peak activation memory of the inference is estimated as
+    the largest input plus output of a layer, the activation memory of the
+    training as the sum of the saved tensors, and the FLOPs of a training step
+    as 3 times the ones of the forward pass.
+
+    Arguments:
+        model: the complex model
+        input_shape: the (B, C, H, W) shape of the inputs
+
+    Returns:
+        A json serializable dictionnary with the "layers" of both modes and the "totals"
+    """
+    model = copy.deepcopy(model)
+    device = next(model.parameters()).device
+    inputs = torch.zeros(input_shape, dtype=torch.complex64, device=device)
+
+    inference = _profile_pass(model, inputs, training=False)
+    training = _profile_pass(model, inputs.clone().requires_grad_(), training=True)
+
+    # Parameters, attributed to the first call of the module holding them
+    modules = dict(model.named_modules())
+    seen = set()
+    for layer_inference, layer_training in zip(inference, training):
+        module = modules.get(layer_inference["name"])
+        parameters = [
+            p
+            for p in (module.parameters() if module is not None else [])
+            if id(p) not in seen
+        ]
+        seen.update(id(p) for p in parameters)
+        parameter_bytes = sum(_tensor_bytes(p) for p in parameters)
+        layer_inference["parameter_bytes"] = parameter_bytes
+        layer_training["parameter_bytes"] = parameter_bytes
+        del layer_inference["saved_bytes"]
+
+    def total_flops(layers):
+        return sum(layer["flops"] for layer in layers if layer["flops"] is not None)
+
+    parameter_bytes = sum(_tensor_bytes(p) for p in model.parameters())
+    forward_training_flops = total_flops(training)
+    totals = {
+        "batch_size": input_shape[0],
+        "input_shape": list(input_shape),
+        "params": sum(p.numel() for p in model.parameters()),
+        "real_params": sum(
+            p.numel() * (2 if p.is_complex() else 1) for p in model.parameters()
+        ),
+        "parameter_bytes": parameter_bytes,
+        "inference_flops": total_flops(inference),
+        "inference_flops_per_sample": total_flops(inference) // input_shape[0],
+        "inference_peak_activation_bytes": max(
+            layer["input_bytes"] + layer["output_bytes"] for layer in inference
+        ),
+        "training_forward_flops": forward_training_flops,
+        "training_step_flops": 3 * forward_training_flops,
+        "training_saved_activation_bytes": sum(
+            layer["saved_bytes"] for layer in training
+        ),
+        # Parameters, their gradients and the two moments of Adam
+        "training_parameter_state_bytes": 4 * parameter_bytes,
+        "uncounted_layers": sorted(
+            {layer["type"] for layer in inference if layer["flops"] is None}
+        ),
+    }
+    return {"totals": totals, "inference": inference, "training": training}
+
+
+def count_complexity(model, input_size):
+    """
+    Counts the parameters of the model and the real FLOPs of a forward pass
+
+    Arguments:
+        model: the complex model
+        input_size: the (C, H, W) size of one sample
+
+    Returns:
+        A dictionnary with the number of parameters, of real parameters (a
+        complex one counting twice) and the real FLOPs per sample
+    """
+    totals = profile_model(model, (1,) + tuple(input_size))["totals"]
+    return {
+        "params": totals["params"],
+        "real_params": totals["real_params"],
+        "flops": totals["inference_flops"],
+    }
@@ -0,0 +1,427 @@
+""" Real-valued rewrite of the complex AutoEncoder for export and deployment
+
+A complex tensor of shape (B, C, H, W) is represented by the real tensor
+(B, 2C, H, W) holding the real parts in its first C channels and the imaginary
+parts in its last C channels. Every complex layer of the model is then
+rewritten as an equivalent real layer on this representation.
+"""
+
+import copy
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torchcvnn.nn.modules as c_nn
+from torchcvnn.nn.modules.batchnorm import inv_sqrt_2x2
+
+
+def complex_to_real_pair(z):
+    """(B, C, ...) complex => (B, 2C, ...) real"""
+    return torch.cat((z.real, z.imag), dim=1)
+
+
+def real_pair_to_complex(x):
+    """(B, 2C, ...) real => (B, C, ...) complex"""
+    x_real, x_imag = x.chunk(2, dim=1)
+    return torch.complex(x_real, x_imag)
+
+
+class RealPairConv2d(nn.Module):
+    """Complex nn.Conv2d as a real convolution with 2x the channels
+
+    For a complex kernel A + iB, the real kernel is [[A, -B], [B, A]]. A
+    grouped convolution needs the real and imaginary parts of a group to be
+    contiguous: its input channels are reordered group by group, and its
+    output channels ordered back, with in_order and out_order.
+    """
+
+    def __init__(self, conv):
+        super().__init__()
+        weight = conv.weight.detach()
+        groups = conv.groups
+        self.conv = nn.Conv2d(
+            2 * conv.in_channels,
+            2 * conv.out_channels,
+            kernel_size=conv.kernel_size,
+            stride=conv.stride,
+            padding=conv.padding,
+            dilation=conv.dilation,
+            groups=groups,
+            bias=conv.bias is not None,
+            padding_mode=conv.padding_mode,
+        )
+        in_group = conv.in_channels // groups
+        out_group = conv.out_channels // groups
+        blocks = []
+        for A, B in zip(weight.real.chunk(groups), weight.imag.chunk(groups)):
+            blocks += [torch.cat((A, -B), dim=1), torch.cat((B, A), dim=1)]
+        bias = conv.bias.detach() if conv.bias is not None else None
+        if groups == 1:
+            self.in_order = self.out_order = None
+        else:
+            # Group g reads [re, im] of its input channels and writes [re, im]
+            # of its output channels, at 2 * g * in_group and 2 * g * out_group
+            channels = torch.arange(conv.in_channels).view(groups, 1, in_group)
+            in_order = torch.cat((channels, channels + conv.in_channels), dim=1)
+            channels = torch.arange(conv.out_channels)
+            position = (channels // out_group) * 2 * out_group + channels % out_group
+            self.register_buffer("in_order", in_order.flatten())
+            self.register_buffer(
+                "out_order", torch.cat((position, position + out_group))
+            )
+        with torch.no_grad():
+            self.conv.weight.copy_(torch.cat(blocks, dim=0))
+            if bias is not None:
+                real_bias = torch.cat((bias.real, bias.imag))
+                if self.out_order is not None:
+                    real_bias = torch.empty_like(real_bias).index_copy_(
+                        0, self.out_order, real_bias
+                    )
+                self.conv.bias.copy_(real_bias)
+
+    def output_rows(self):
+        """Returns the rows of the real kernel giving the real and imaginary outputs"""
+        if self.out_order is None:
+            return torch.arange(self.conv.out_channels).chunk(2)
+        return self.out_order.chunk(2)
+
+    def forward(self, x):
+        if self.in_order is None:
+            return self.conv(x)
+        return self.conv(x[:, self.in_order])[:, self.out_order]
+
+
+class RealPairDepthwiseConv2d(nn.Module):
+    """Depthwise complex nn.Conv2d as two real depthwise convolutions
+
+    With the complex kernel A + iB, [A x_re, A x_im] and [B x_re, B x_im] are
+    computed by two depthwise convolutions of the real-pair input, in channels
+    last memory format where they are much faster on CPU than the grouped
+    convolution of RealPairConv2d, and then combined into
+    [A x_re - B x_im, A x_im + B x_re].
+    """
+
+    def __init__(self, conv):
+        super().__init__()
+        weight = conv.weight.detach()
+        self.stride = conv.stride
+        self.dilation = conv.dilation
+        self.padding = conv.padding
+        self.padding_mode = conv.padding_mode
+        self.register_buffer(
+            "weight_a",
+            torch.cat((weight.real, weight.real)).contiguous(
+                memory_format=torch.channels_last
+            ),
+        )
+        self.register_buffer(
+            "weight_b",
+            torch.cat((weight.imag, weight.imag)).contiguous(
+                memory_format=torch.channels_last
+            ),
+        )
+        bias = None
+        if conv.bias is not None:
+            bias = conv.bias.detach()
+            bias = torch.cat((bias.real, bias.imag)).view(1, -1, 1, 1)
+        self.register_buffer("bias", bias)
+
+    def forward(self, x):
+        padding = self.padding
+        if self.padding_mode != "zeros":
+            x = F.pad(
+                x,
+                (padding[1], padding[1], padding[0], padding[0]),
+                mode=self.padding_mode,
+            )
+            padding = 0
+        x = x.contiguous(memory_format=torch.channels_last)
+        groups = len(self.weight_a)
+        a_real, a_imag = F.conv2d(
+            x, self.weight_a, None, self.stride, padding, self.dilation, groups
+        ).chunk(2, dim=1)
+        b_real, b_imag = F.conv2d(
+            x, self.weight_b, None, self.stride, padding, self.dilation, groups
+        ).chunk(2, dim=1)
+        y = torch.cat((a_real - b_imag, a_imag + b_real), dim=1)
+        if self.bias is not None:
+            y = y + self.bias
+        return y.contiguous()
+
+
+class RealPairConvTranspose2d(nn.Module):
+    """torchcvnn ConvTranspose2d as a single real transposed convolution
+
+    torchcvnn computes m_real(z.real) - m_imag(z.imag) + i (m_real(z.imag) + m_imag(z.real)),
+    both modules holding a bias, hence the real kernel [[A, B], [-B, A]] in
+    the (in, out) layout of transposed convolutions.
+    """
+
+    def __init__(self, conv):
+        super().__init__()
+        m_real, m_imag = conv.m_real, conv.m_imag
+        A, B = m_real.weight.detach(), m_imag.weight.detach()
+        self.conv = nn.ConvTranspose2d(
+            2 * m_real.in_channels,
+            2 * m_real.out_channels,
+            kernel_size=m_real.kernel_size,
+            stride=m_real.stride,
+            padding=m_real.padding,
+            output_padding=m_real.output_padding,
+            dilation=m_real.dilation,
+            bias=m_real.bias is not None,
+        )
+        if m_real.groups != 1:
+            raise NotImplementedError("Grouped complex convolutions are not supported")
+        with torch.no_grad():
+            self.conv.weight.copy_(
+                torch.cat((torch.cat((A, B), dim=1), torch.cat((-B, A), dim=1)), dim=0)
+            )
+            if m_real.bias is not None:
+                b_real, b_imag = m_real.bias.detach(), m_imag.bias.detach()
+                self.conv.bias.copy_(torch.cat((b_real - b_imag, b_real + b_imag)))
+
+    def forward(self, x):
+        return self.conv(x)
+
+
+class RealPairBatchNorm2d(nn.Module):
+    """torchcvnn BatchNorm2d in eval mode as a per channel 2x2 affine map
+
+    With the running statistics, the whitening and the affine transform
+    collapse into [y_re, y_im] = M [x_re, x_im] + c with M = weight @ cov^-1/2
+    and c = bias - M mean
+    """
+
+    def __init__(self, bn):
+        super().__init__()
+        if not bn.track_running_stats:
+            raise NotImplementedError(
+                "Only BatchNorm with running statistics can be rewritten"
+            )
+        covs = bn.running_var.detach()
+        M = inv_sqrt_2x2(covs + bn.eps * torch.eye(2, device=covs.device))
+        if bn.affine:
+            M = torch.bmm(bn.weight.detach(), M)
+        mean = torch.view_as_real(bn.running_mean.detach())  # C, 2
+        c = -torch.bmm(M, mean.unsqueeze(-1)).squeeze(-1)
+        if bn.affine:
+            c = c + torch.view_as_real(bn.bias.detach())
+        shape = (1, bn.num_features, 1, 1)
+        self.register_buffer("m_rr", M[:, 0, 0].reshape(shape).contiguous())
+        self.register_buffer("m_ri", M[:, 0, 1].reshape(shape).contiguous())
+        self.register_buffer("m_ir", M[:, 1, 0].reshape(shape).contiguous())
+        self.register_buffer("m_ii", M[:, 1, 1].reshape(shape).contiguous())
+        self.register_buffer("c_r", c[:, 0].reshape(shape).contiguous())
+        self.register_buffer("c_i", c[:, 1].reshape(shape).contiguous())
+
+    def forward(self, x):
+        x_real, x_imag = x.chunk(2, dim=1)
+        y_real = self.m_rr * x_real + self.m_ri * x_imag + self.c_r
+        y_imag = self.m_ir * x_real + self.m_ii * x_imag + self.c_i
+        return torch.cat((y_real, y_imag), dim=1)
+
+
+class RealPairChannelShuffle(nn.Module):
+    """nn.ChannelShuffle applied to the real and to the imaginary parts"""
+
+    def __init__(self, shuffle):
+        super().__init__()
+        self.shuffle = nn.ChannelShuffle(shuffle.groups)
+
+    def forward(self, x):
+        x_real, x_imag = x.chunk(2, dim=1)
+        return torch.cat((self.shuffle(x_real), self.shuffle(x_imag)), dim=1)
+
+
+class RealPairModReLU(nn.Module):
+    """modReLU(z) = ReLU(|z| + b) exp(i arg z) on the real and imaginary parts
+
+    As with torch.angle, a null input is given the phase 0
+    """
+
+    def __init__(self, activation):
+        super().__init__()
+        self.register_buffer("b", activation.b.detach().clone())
+
+    def forward(self, x):
+        x_real, x_imag = x.chunk(2, dim=1)
+        modulus = torch.sqrt(x_real * x_real + x_imag * x_imag)
+        nonzero = modulus > 0
+        safe_modulus = torch.where(nonzero, modulus, torch.ones_like(modulus))
+        unit_real = torch.where(nonzero, x_real / safe_modulus, torch.ones_like(x_real))
+        unit_imag = x_imag / safe_modulus
+        amplitude = F.relu(modulus + self.b)
+        return torch.cat((amplitude * unit_real, amplitude * unit_imag), dim=1)
+
+
+def _real_pair_module(module):
+    if isinstance(module, nn.Conv2d):
+        if module.groups == module.in_channels == module.out_channels > 1:
+            return RealPairDepthwiseConv2d(module)
+        return RealPairConv2d(module)
+    if isinstance(module, c_nn.ConvTranspose2d):
+        return RealPairConvTranspose2d(module)
+    if isinstance(module, c_nn.BatchNorm2d):
+        return RealPairBatchNorm2d(module)
+    if isinstance(module, c_nn.modReLU):
+        return RealPairModReLU(module)
+    if isinstance(module, nn.ChannelShuffle):
+        return RealPairChannelShuffle(module)
+    return None
+
+
+def _rewrite(module):
+    # _modules rather than named_children, which yields a module shared by
+    # several layers (e.g. the activation) only once
+    for name, child in module._modules.items():
+        rewritten = _real_pair_module(child)
+        if rewritten is not None:
+            module._modules[name] = rewritten
+        elif len(child._modules) == 0 and not isinstance(child, nn.Identity):
+            raise NotImplementedError(
+                f"No real-valued rewrite for the layer {type(child).__name__}"
+            )
+        else:
+            _rewrite(child)
+
+
+def to_real_pair(model):
+    """
+    Returns a copy of the complex model, in eval mode, where every complex
+    layer is replaced by its real-valued equivalent. The returned model takes
+    and returns (B, 2C, H, W) real tensors.
+    """
+    model = copy.deepcopy(model).eval()
+    rewritten = _real_pair_module(model)
+    if rewritten is not None:
+        return rewritten
+    _rewrite(model)
+    return model
+
+
+class RealPairWrapper(nn.Module):
+    """Complex in, complex out wrapper around a real-pair model
+
+    The real-pair model runs in `dtype`, its outputs being cast back to float32
+    """
+
+    def __init__(self, real_pair_model, dtype=torch.float32):
+        super().__init__()
+        self.model = real_pair_model
+        self.dtype = dtype
+
+    def forward(self, z):
+        x = complex_to_real_pair(z).to(self.dtype)
+        return real_pair_to_complex(self.model(x).float())
+
+
+class RealPairPixelShuffleUp(nn.Module):
+    """Transposed convolution with kernel_size == stride and no padding,
+    rewritten as a 1x1 convolution followed by a pixel shuffle
+
+    out[o, r i + a, r j + b] = sum_c x[c, i, j] W[c, o, a, b] is a 1x1 convolution
+    producing the r * r channels (o, a, b) of every output channel o, which the
+    pixel shuffle then moves to their spatial position
+    """
+
+    def __init__(self, real_pair_up):
+        super().__init__()
+        conv = real_pair_up.conv
+        r = conv.stride[0]
+        in_channels, out_channels = conv.in_channels, conv.out_channels
+        self.conv = nn.Conv2d(
+            in_channels, out_channels * r * r, kernel_size=1, bias=conv.bias is not None
+        )
+        with torch.no_grad():
+            # (in, out, r, r) => (out * r * r, in, 1, 1)
+            weight = conv.weight.detach().permute(1, 2, 3, 0)
+            self.conv.weight.copy_(weight.reshape(out_channels * r * r, in_channels, 1, 1))
+            if conv.bias is not None:
+                self.conv.bias.copy_(conv.bias.detach().repeat_interleave(r * r))
+        self.shuffle = nn.PixelShuffle(r)
+
+    def forward(self, x):
+        return self.shuffle(self.conv(x))
+
+
+def _is_pixel_shuffle_upsampling(conv):
+    return (
+        conv.kernel_size == conv.stride
+        and conv.kernel_size[0] == conv.kernel_size[1]
+        and conv.padding == (0, 0)
+        and conv.output_padding == (0, 0)
+        and conv.dilation == (1, 1)
+        and conv.groups == 1
+    )
+
+
+def fold_batchnorm(real_model):
+    """
+    Folds, in place, every RealPairBatchNorm2d directly following a
+    RealPairConv2d in a nn.Sequential into the weights and bias of the
+    convolution, the BatchNorm being replaced by an identity. For the output
+    channel c, the rows of the real and imaginary outputs become
+    [m_rr W_re + m_ri W_im, m_ir W_re + m_ii W_im] and the bias gets the offset c.
+    """
+    for module in real_model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        names = list(module._modules.keys())
+        for name, next_name in zip(names[:-1], names[1:]):
+            conv, bn = module._modules[name], module._modules[next_name]
+            if not (
+                isinstance(conv, RealPairConv2d) and isinstance(bn, RealPairBatchNorm2d)
+            ):
+                continue
+            old = conv.conv
+            folded = nn.Conv2d(
+                old.in_channels,
+                old.out_channels,
+                kernel_size=old.kernel_size,
+                stride=old.stride,
+                padding=old.padding,
+                dilation=old.dilation,
+                groups=old.groups,
+                bias=True,
+                padding_mode=old.padding_mode,
+            )
+            with torch.no_grad():
+                real_rows, imag_rows = conv.output_rows()
+                weight = old.weight.detach()
+                w_real, w_imag = weight[real_rows], weight[imag_rows]
+                if old.bias is not None:
+                    bias = old.bias.detach()
+                    b_real, b_imag = bias[real_rows], bias[imag_rows]
+                else:
+                    b_real = torch.zeros(old.out_channels // 2)
+                    b_imag = torch.zeros(old.out_channels // 2)
+                m_rr, m_ri = bn.m_rr.flatten(), bn.m_ri.flatten()
+                m_ir, m_ii = bn.m_ir.flatten(), bn.m_ii.flatten()
+                w = lambda m: m.view(-1, 1, 1, 1)
+                folded.weight[real_rows] = w(m_rr) * w_real + w(m_ri) * w_imag
+                folded.weight[imag_rows] = w(m_ir) * w_real + w(m_ii) * w_imag
+                folded.bias[real_rows] = (
+                    m_rr * b_real + m_ri * b_imag + bn.c_r.flatten()
+                )
+                folded.bias[imag_rows] = (
+                    m_ir * b_real + m_ii * b_imag + bn.c_i.flatten()
+                )
+            conv.conv = folded
+            module._modules[next_name] = nn.Identity()
+    return real_model
+
+
+def simplify_upsampling(real_model):
+    """
+    Replaces, in place, the real-pair transposed convolutions whose kernel
+    equals their stride, as in the Up blocks, by a 1x1 convolution and a
+    pixel shuffle
+    """
+    for module in real_model.modules():
+        for name, child in module._modules.items():
+            if isinstance(child, RealPairConvTranspose2d) and (
+                _is_pixel_shuffle_upsampling(child.conv)
+            ):
+                module._modules[name] = RealPairPixelShuffleUp(child)
+    return real_model
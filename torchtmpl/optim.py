@@ -6,11 +6,16 @@ from torchtmpl.losses import (
     ComplexVAELoss,
     ComplexVAEPhaseLoss,
     ComplexAmplitudePhaseError,
+    ComplexHuberLoss,
+    FusedComplexAmplitudePhaseError,
+    FusedComplexVAELoss,
+    FusedComplexVAEPhaseLoss,
 )
 
 
-def get_loss(lossname):
-    return eval(f"{lossname}()")
+def get_loss(lossname, params=None):
+    params = params or {}
+    return eval(f"{lossname}(**params)")
     # return eval(f"nn.{lossname}()")
 
 
@@ -0,0 +1,196 @@
+# coding: utf-8
+
+# Standard imports
+import concurrent.futures
+import copy
+import logging
+import os
+import time
+
+# External imports
+import numpy as np
+import torch
+import torch.multiprocessing
+
+# Local imports
+from . import data as dt
+
+
+def split_strips(num_tile_rows, num_strips):
+    """Splits the rows of tiles into num_strips contiguous and balanced [start, end) ranges"""
+    num_strips = max(1, min(num_strips, num_tile_rows))
+    bounds = np.linspace(0, num_tile_rows, num_strips + 1).round().astype(int)
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def image_tiles(image, segment_size):
+    """
+    Returns the (N, C, s, s) non overlapping tiles of a (C, R s, K s) image,
+    in the row-major order of get_full_image_dataloader
+    """
+    num_channels, height, width = image.shape
+    tiles = np.reshape(
+        image,
+        (
+            num_channels,
+            height // segment_size,
+            segment_size,
+            width // segment_size,
+            segment_size,
+        ),
+    )
+    return tiles.transpose(1, 3, 0, 2, 4).reshape(
+        -1, num_channels, segment_size, segment_size
+    )
+
+
+def _infer_strip(
+    model,
+    scene,
+    tile_rows,
+    segment_size,
+    output_path,
+    num_threads,
+    cores,
+    batch_size,
+    metrics,
+):
+    """Worker of strip_inference: reconstructs the tiles of the rows tile_rows"""
+    if cores:
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads)
+    start_time = time.perf_counter()
+
+    output = np.load(output_path, mmap_mode="r+")
+    start_row, end_row = tile_rows[0] * segment_size, tile_rows[1] * segment_size
+    strip = scene[:, start_row:end_row, : output.shape[2]]
+    patches = dt.InMemoryPatches(
+        strip, (segment_size, segment_size), (segment_size, segment_size)
+    )
+    model.eval()
+    with torch.no_grad():
+        for indices in torch.arange(len(patches)).split(batch_size):
+            inputs = patches.gather(indices)
+            outputs = model(inputs).numpy()
+            if metrics is not None:
+                metrics.update(inputs.numpy(), outputs)
+            for index, tile in zip(indices.tolist(), outputs):
+                row = start_row + (index // patches.nsamples_per_cols) * segment_size
+                col = (index % patches.nsamples_per_cols) * segment_size
+                output[:, row : row + segment_size, col : col + segment_size] = tile
+    output.flush()
+    return metrics, time.perf_counter() - start_time
+
+
+def strip_inference(
+    model,
+    scene,
+    segment_size,
+    output_path,
+    num_workers,
+    num_threads=None,
+    batch_size=16,
+    metrics=None,
+    renderer=None,
+):
+    """
+    Reconstructs a scene with num_workers processes, each holding its own copy
+    of the model and reconstructing a horizontal strip of rows of tiles.
+
+    The tiles are reconstructed independently by the model and by the per tile
+    metrics, so that the strips, aligned on the rows of tiles, do not need to
+    overlap. The scene is shared with the workers through shared memory, and
+    they write their reconstructions into the .npy memory map output_path. Each
+    worker is pinned to its own share of the cores of the process when there
+    are enough of them. As in reassemble_image, the incomplete tiles on the
+    borders of the scene are dropped.
+
+    Arguments:
+        model: the model, run on CPU
+        scene: the (C, H, W) complex scene, in the domain of the model inputs
+        segment_size: the side of the tiles
+        output_path: the .npy file of the (C, H', W') reconstruction
+        num_workers: the number of worker processes
+        num_threads: the compute threads of every worker, by default the cores
+                     of the process divided by num_workers
+        batch_size: the number of tiles reconstructed at once by a worker
+        metrics: an optional StreamingMetrics, in which the metrics of the
+                 strips are merged
+        renderer: an optional SceneRenderer, updated by the parent process
+                  from the reconstruction once the workers are done
+
+    Returns:
+        The reconstruction, as a read-only memory map, and the dictionnary of the timings
+    """
+    start_time = time.perf_counter()
+    scene = torch.as_tensor(scene).contiguous().share_memory_()
+    num_channels, height, width = scene.shape
+    num_tile_rows, num_tile_cols = height // segment_size, width // segment_size
+    np.lib.format.open_memmap(
+        output_path,
+        mode="w+",
+        dtype=np.complex64,
+        shape=(num_channels, num_tile_rows * segment_size, num_tile_cols * segment_size),
+    ).flush()
+
+    strips = split_strips(num_tile_rows, num_workers)
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) >= len(strips):
+        worker_cores = [list(chunk) for chunk in np.array_split(cores, len(strips))]
+    else:
+        worker_cores = [None] * len(strips)
+    if num_threads is None:
+        num_threads = max(1, len(cores) // len(strips))
+
+    model = copy.deepcopy(model).cpu().eval()
+    context = torch.multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=len(strips), mp_context=context
+    ) as executor:
+        futures = [
+            executor.submit(
+                _infer_strip,
+                model,
+                scene,
+                tile_rows,
+                segment_size,
+                str(output_path),
+                num_threads,
+                [int(core) for core in strip_cores] if strip_cores else None,
+                batch_size,
+                copy.deepcopy(metrics),
+            )
+            for tile_rows, strip_cores in zip(strips, worker_cores)
+        ]
+        results = [future.result() for future in futures]
+    inference_time = time.perf_counter() - start_time
+
+    if metrics is not None:
+        for strip_metrics, _ in results:
+            metrics.merge(strip_metrics)
+
+    reconstruction = np.load(output_path, mmap_mode="r")
+    if renderer is not None:
+        originals = image_tiles(
+            scene[:, : reconstruction.shape[1], : reconstruction.shape[2]].numpy(),
+            segment_size,
+        )
+        reconstructions = image_tiles(reconstruction, segment_size)
+        for start in range(0, len(originals), batch_size):
+            renderer.update(
+                originals[start : start + batch_size],
+                reconstructions[start : start + batch_size],
+            )
+
+    timings = {
+        "num_workers": len(strips),
+        "threads_per_worker": num_threads,
+        "strips": strips,
+        "worker_seconds": [seconds for _, seconds in results],
+        "inference_seconds": inference_time,
+    }
+    logging.info(
+        f"  - {len(strips)} strips reconstructed in {inference_time:.2f} s, "
+        f"the slowest worker taking {max(timings['worker_seconds']):.2f} s"
+    )
+    return reconstruction, timings
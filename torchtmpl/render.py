@@ -0,0 +1,288 @@
+# coding: utf-8
+
+# Standard imports
+import json
+import pathlib
+
+# External imports
+import numpy as np
+import matplotlib
+from matplotlib.colors import to_rgb
+from PIL import Image
+
+# Local imports
+from . import data as dt
+
+CHANNELS = ["HH", "HV", "VV"]
+
+# The colors of the H-alpha classes, as in show_images, the unclassified
+# pixels (class 0 and the borders lost by the decomposition) being black
+H_ALPHA_COLORS = {
+    1: "green",
+    2: "yellow",
+    4: "blue",
+    5: "pink",
+    6: "purple",
+    7: "red",
+    8: "brown",
+    9: "gray",
+}
+
+
+def _color_table(colors):
+    table = np.zeros((10, 3), dtype=np.uint8)
+    for label, color in colors.items():
+        table[label] = np.round(np.array(to_rgb(color)) * 255)
+    return table
+
+
+H_ALPHA_TABLE = _color_table(H_ALPHA_COLORS)
+HSV_TABLE = np.round(matplotlib.colormaps["hsv"](np.arange(256))[:, :3] * 255).astype(
+    np.uint8
+)
+
+
+def downsample(strip, categorical=False):
+    """
+    Halves the resolution of a (H, W, 3) uint8 strip, padded to even sizes by
+    replicating its last row and column. The 2x2 blocks are averaged, or
+    subsampled for the categorical maps whose labels must not be mixed.
+    """
+    rows, cols = strip.shape[:2]
+    strip = np.pad(strip, ((0, rows % 2), (0, cols % 2), (0, 0)), mode="edge")
+    if categorical:
+        return strip[::2, ::2]
+    blocks = strip.reshape(strip.shape[0] // 2, 2, strip.shape[1] // 2, 2, -1)
+    return np.round(blocks.mean(axis=(1, 3))).astype(np.uint8)
+
+
+class PyramidWriter:
+    """
+    Writes an image, received strip by strip, as a pyramid of PNG tiles.
+
+    The level 0 is the full resolution and every level halves the previous one,
+    down to the level fitting in a single tile. The tile (row, col) of a level
+    is written to root/level/row_col.png. Only one strip of tile_size rows per
+    level is held in memory.
+
+    Arguments:
+        root: the directory of the pyramid
+        height: the number of rows of the image
+        width: the number of columns of the image
+        tile_size: the side of the tiles
+        categorical: whether the image holds labels, downsampled without averaging
+        level: the level of this writer, the next levels being created recursively
+    """
+
+    def __init__(self, root, height, width, tile_size=256, categorical=False, level=0):
+        self.root = pathlib.Path(root)
+        self.height = height
+        self.width = width
+        self.tile_size = tile_size
+        self.categorical = categorical
+        self.level = level
+        self.pending = []
+        self.num_pending = 0
+        self.tile_row = 0
+        (self.root / str(level)).mkdir(parents=True, exist_ok=True)
+
+        self.next = None
+        if max(height, width) > tile_size:
+            self.next = PyramidWriter(
+                root,
+                -(-height // 2),
+                -(-width // 2),
+                tile_size,
+                categorical,
+                level + 1,
+            )
+
+    def levels(self):
+        """Returns the [height, width] of every level"""
+        sizes = [[self.height, self.width]]
+        if self.next is not None:
+            sizes += self.next.levels()
+        return sizes
+
+    def push(self, rows):
+        """Appends the (r, width, 3) uint8 rows below the ones already received"""
+        self.pending.append(rows)
+        self.num_pending += len(rows)
+        if self.num_pending < self.tile_size:
+            return
+        pending = np.concatenate(self.pending)
+        num_full = (len(pending) // self.tile_size) * self.tile_size
+        for start in range(0, num_full, self.tile_size):
+            self._write_strip(pending[start : start + self.tile_size])
+        self.pending = [pending[num_full:]] if num_full < len(pending) else []
+        self.num_pending = len(pending) - num_full
+
+    def close(self):
+        """Writes the last, incomplete, strip of every level"""
+        if self.num_pending > 0:
+            self._write_strip(np.concatenate(self.pending))
+            self.pending = []
+            self.num_pending = 0
+        if self.next is not None:
+            self.next.close()
+
+    def _write_strip(self, strip):
+        for tile_col, col in enumerate(range(0, self.width, self.tile_size)):
+            Image.fromarray(np.ascontiguousarray(strip[:, col : col + self.tile_size])).save(
+                self.root / str(self.level) / f"{self.tile_row}_{tile_col}.png"
+            )
+        self.tile_row += 1
+        if self.next is not None:
+            self.next.push(downsample(strip, self.categorical))
+
+
+def equalization_percentiles(loader, subsample=1):
+    """
+    Computes, in one pass over the original tiles of the loader, the 2/98
+    percentiles used to equalize the Pauli and Krogager maps of the scene
+
+    Returns:
+        A dictionnary "pauli"/"krogager" -> (p2, p98)
+    """
+    histograms = {
+        "pauli": dt.LogAmplitudeHistogram(),
+        "krogager": dt.LogAmplitudeHistogram(),
+    }
+    for data in loader:
+        inputs = data[0] if isinstance(data, (tuple, list)) else data
+        for tile in dt.exp_amplitude_transform(inputs.numpy()).numpy():
+            histograms["pauli"].update(
+                dt.pauli_transform(tile).transpose(1, 2, 0), subsample
+            )
+            histograms["krogager"].update(
+                dt.krogager_transform(tile).transpose(1, 2, 0), subsample
+            )
+    return {name: h.percentiles((2, 98)) for name, h in histograms.items()}
+
+
+class SceneRenderer:
+    """
+    Renders the tiles streamed out of the inference as image pyramids of the
+    Pauli and Krogager maps of the original and generated scenes, of the
+    angular distance between them per channel and of their H-alpha classes.
+
+    The tiles are expected in the row-major order of get_full_image_dataloader,
+    without overlap, and the incomplete tiles on the borders of the crop are
+    dropped, as in reassemble_image.
+
+    Arguments:
+        root: the directory where one pyramid per map is written
+        num_rows: the number of rows of the crop
+        num_cols: the number of columns of the crop
+        segment_size: the side of the tiles fed to the model
+        percentiles: the equalization percentiles of equalization_percentiles
+        tile_size: the side of the tiles of the pyramids
+        h_alpha: whether to render the H-alpha classes, which is costly. The
+                 classes are computed per tile, and miss a border of 3 pixels
+    """
+
+    def __init__(
+        self,
+        root,
+        num_rows,
+        num_cols,
+        segment_size,
+        percentiles,
+        tile_size=256,
+        h_alpha=True,
+    ):
+        self.root = pathlib.Path(root)
+        self.segment_size = segment_size
+        self.percentiles = percentiles
+        self.h_alpha = h_alpha
+        self.grid_cols = num_cols // segment_size
+        self.height = (num_rows // segment_size) * segment_size
+        self.width = self.grid_cols * segment_size
+
+        names = [
+            "pauli_original",
+            "pauli_generated",
+            "krogager_original",
+            "krogager_generated",
+        ] + [f"angular_distance_{channel}" for channel in CHANNELS]
+        if h_alpha:
+            names += ["h_alpha_original", "h_alpha_generated"]
+        self.writers = {
+            name: PyramidWriter(
+                self.root / name,
+                self.height,
+                self.width,
+                tile_size,
+                categorical=name.startswith("h_alpha"),
+            )
+            for name in names
+        }
+        self.strips = {
+            name: np.zeros((segment_size, self.width, 3), dtype=np.uint8)
+            for name in names
+        }
+        self.num_tiles = 0
+
+    def _maps(self, original, generated):
+        maps = {}
+        for kind, transform in [
+            ("pauli", dt.pauli_transform),
+            ("krogager", dt.krogager_transform),
+        ]:
+            p2, p98 = self.percentiles[kind]
+            for name, image in [("original", original), ("generated", generated)]:
+                maps[f"{kind}_{name}"], _ = dt.equalize(
+                    transform(image).transpose(1, 2, 0), p2=p2, p98=p98, method="histogram"
+                )
+        for ch, channel in enumerate(CHANNELS):
+            maps[f"angular_distance_{channel}"] = HSV_TABLE[
+                dt.plot_angular_distance(original[ch], generated[ch])
+            ]
+        if self.h_alpha:
+            for name, image in [("original", original), ("generated", generated)]:
+                classes = dt.h_alpha_classes(
+                    dt.local_covariances(dt.pauli_transform(image).transpose(1, 2, 0))
+                )
+                border = (self.segment_size - classes.shape[0]) // 2
+                maps[f"h_alpha_{name}"] = H_ALPHA_TABLE[np.pad(classes, border)]
+        return maps
+
+    def update(self, originals, reconstructions):
+        """
+        Renders a batch of tiles
+
+        Arguments:
+            originals: the (B, C, H, W) complex tiles fed to the model
+            reconstructions: the (B, C, H, W) complex outputs of the model
+        """
+        originals = dt.exp_amplitude_transform(np.asarray(originals)).numpy()
+        reconstructions = dt.exp_amplitude_transform(
+            np.asarray(reconstructions)
+        ).numpy()
+        for original, generated in zip(originals, reconstructions):
+            if self.num_tiles >= (self.height // self.segment_size) * self.grid_cols:
+                break
+            col = (self.num_tiles % self.grid_cols) * self.segment_size
+            for name, image in self._maps(original, generated).items():
+                self.strips[name][:, col : col + self.segment_size] = image
+            self.num_tiles += 1
+            # A row of tiles is complete, it is pushed to the pyramids
+            if self.num_tiles % self.grid_cols == 0:
+                for name, writer in self.writers.items():
+                    writer.push(self.strips[name])
+                    self.strips[name] = np.zeros_like(self.strips[name])
+
+    def close(self):
+        """Flushes the pyramids and writes their description to root/pyramid.json"""
+        for writer in self.writers.values():
+            writer.close()
+        description = {
+            "height": self.height,
+            "width": self.width,
+            "tile_size": next(iter(self.writers.values())).tile_size,
+            "percentiles": self.percentiles,
+            "maps": {name: writer.levels() for name, writer in self.writers.items()},
+        }
+        with open(self.root / "pyramid.json", "w") as f:
+            json.dump(description, f, indent=2)
+        return description
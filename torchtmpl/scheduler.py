@@ -0,0 +1,309 @@
+# coding: utf-8
+
+# Standard imports
+import concurrent.futures
+import copy
+import json
+import logging
+import os
+import pathlib
+import time
+
+# External imports
+import numpy as np
+import torch
+import torch.multiprocessing
+import yaml
+
+# Local imports
+from . import data as dt
+from . import metrics as mt
+
+# The model of a worker process, received once from the parent
+_model = None
+
+
+def _init_worker(model, num_threads):
+    global _model
+    torch.set_num_threads(num_threads)
+    _model = model.eval()
+
+
+def write_json(path, content):
+    """Writes the json file atomically, a killed job leaving either the old or the new content"""
+    path = pathlib.Path(path)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(content, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def read_progress(root, name):
+    """Returns the progress of the scene recorded in root, None if it was never started"""
+    path = pathlib.Path(root) / f"{name}.progress.json"
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def load_manifest(manifest_path):
+    """
+    Reads the manifest of the scenes to reconstruct, a yaml or json file
+    holding a list "scenes" of {"name", "crop", optionally "dataset"}, the
+    dataset of the configuration being used by default
+    """
+    with open(manifest_path, "r") as f:
+        scenes = yaml.safe_load(f)["scenes"]
+    names = [scene["name"] for scene in scenes]
+    if len(set(names)) != len(names):
+        raise ValueError(f"The scene names of {manifest_path} are not unique")
+    return scenes
+
+
+def reconstruct_scene(scene, data_config, root, checkpoint_tiles, metrics_config=None):
+    """
+    Reconstructs the tiles of a scene with the model of the worker, resuming
+    after the last checkpointed tile.
+
+    The reconstruction is written into the memory map root/<name>.npy. Every
+    checkpoint_tiles tiles, the memory map is flushed and the number of
+    reconstructed tiles, with the state of the streaming metrics, is written
+    atomically to root/<name>.progress.json, which is the commit point of the
+    progress. A scene is reconstructed in the row-major order of its tiles,
+    the incomplete tiles of its borders being dropped.
+
+    Arguments:
+        scene: the entry of the manifest
+        data_config: the data section of the configuration
+        root: the directory of the outputs
+        checkpoint_tiles: the number of tiles between two checkpoints
+        metrics_config: the optional metrics section of the configuration
+
+    Returns:
+        The dictionnary of the progress of the scene
+    """
+    root = pathlib.Path(root)
+    name = scene["name"]
+    progress_path = root / f"{name}.progress.json"
+    output_path = root / f"{name}.npy"
+
+    progress = read_progress(root, name)
+    if progress is not None and progress["status"] == "done":
+        return progress
+
+    data_config = copy.deepcopy(data_config)
+    data_config["crop"] = scene["crop"]
+    if "dataset" in scene:
+        data_config["dataset"] = scene["dataset"]
+    segment_size = data_config["img_size"]
+    batch_size = data_config["batch_size"]
+
+    image = dt.load_crop(data_config)
+    patches = dt.InMemoryPatches(
+        image, (segment_size, segment_size), (segment_size, segment_size)
+    )
+    num_tiles = len(patches)
+    shape = (
+        image.shape[0],
+        patches.nsamples_per_rows * segment_size,
+        patches.nsamples_per_cols * segment_size,
+    )
+
+    scene_metrics = None
+    if metrics_config is not None:
+        scene_metrics = mt.StreamingMetrics(
+            num_channels=image.shape[0],
+            amplitude_range=metrics_config["amplitude_range"],
+            bins=metrics_config["bins"],
+            h_alpha=metrics_config["h_alpha"],
+        )
+
+    if progress is None or progress["tiles_done"] == 0 or not output_path.exists():
+        progress = {
+            "name": name,
+            "crop": scene["crop"],
+            "num_tiles": num_tiles,
+            "tiles_done": 0,
+            "seconds": 0.0,
+            "metrics_state": None,
+        }
+        output = np.lib.format.open_memmap(
+            output_path, mode="w+", dtype=np.complex64, shape=shape
+        )
+    else:
+        output = np.load(output_path, mmap_mode="r+")
+        if scene_metrics is not None and progress["metrics_state"] is not None:
+            scene_metrics.load_state_dict(progress["metrics_state"])
+        logging.info(
+            f"  - Resuming {name} at tile {progress['tiles_done']}/{num_tiles}"
+        )
+
+    def checkpoint(status, elapsed):
+        output.flush()
+        progress["status"] = status
+        progress["seconds"] += elapsed
+        if scene_metrics is not None:
+            progress["metrics_state"] = scene_metrics.state_dict()
+        write_json(progress_path, progress)
+
+    checkpoint("running", 0.0)
+    start_time = time.perf_counter()
+    last_checkpoint = progress["tiles_done"]
+    with torch.no_grad():
+        for start in range(progress["tiles_done"], num_tiles, batch_size):
+            indices = torch.arange(start, min(start + batch_size, num_tiles))
+            inputs = patches.gather(indices)
+            outputs = _model(inputs).numpy()
+            if scene_metrics is not None:
+                scene_metrics.update(inputs.numpy(), outputs)
+            for index, tile in zip(indices.tolist(), outputs):
+                row = (index // patches.nsamples_per_cols) * segment_size
+                col = (index % patches.nsamples_per_cols) * segment_size
+                output[:, row : row + segment_size, col : col + segment_size] = tile
+            progress["tiles_done"] = int(indices[-1]) + 1
+            if progress["tiles_done"] - last_checkpoint >= checkpoint_tiles:
+                checkpoint("running", time.perf_counter() - start_time)
+                start_time = time.perf_counter()
+                last_checkpoint = progress["tiles_done"]
+
+    if scene_metrics is not None:
+        scene_metrics.save(
+            root / f"metrics_{name}.json", scene=name, crop=scene["crop"]
+        )
+    checkpoint("done", time.perf_counter() - start_time)
+    return progress
+
+
+def _summary(progress):
+    # The progress of a scene without the state of its metrics
+    return {key: value for key, value in progress.items() if key != "metrics_state"}
+
+
+def run_batch(
+    model,
+    scenes,
+    data_config,
+    root,
+    num_workers=1,
+    num_threads=None,
+    checkpoint_tiles=256,
+    metrics_config=None,
+):
+    """
+    Reconstructs the scenes of a manifest with a pool of worker processes,
+    each receiving the loaded model once and reconstructing one scene at a
+    time. The progress of every scene is recorded in root, so that a killed
+    job resumes where it stopped, the scenes already done being skipped. The
+    progress of all the scenes is gathered in root/batch_manifest.json as the
+    scenes complete.
+
+    Arguments:
+        model: the loaded model, run on CPU
+        scenes: the entries of the manifest, see load_manifest
+        data_config: the data section of the configuration
+        root: the directory of the outputs
+        num_workers: the number of worker processes
+        num_threads: the compute threads of every worker, by default the cores
+                     of the process divided by num_workers
+        checkpoint_tiles: the number of tiles between two checkpoints of a scene
+        metrics_config: the optional metrics section of the configuration
+
+    Returns:
+        The dictionnary of the throughput of the run
+    """
+    root = pathlib.Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    if num_threads is None:
+        num_threads = max(1, len(os.sched_getaffinity(0)) // num_workers)
+
+    def write_manifest():
+        write_json(
+            root / "batch_manifest.json",
+            {
+                "scenes": [
+                    _summary(
+                        read_progress(root, scene["name"])
+                        or {"name": scene["name"], "status": "pending"}
+                    )
+                    for scene in scenes
+                ]
+            },
+        )
+
+    tiles_before = {
+        scene["name"]: (read_progress(root, scene["name"]) or {"tiles_done": 0})[
+            "tiles_done"
+        ]
+        for scene in scenes
+    }
+    pending = [
+        scene
+        for scene in scenes
+        if (read_progress(root, scene["name"]) or {"status": "pending"})["status"]
+        != "done"
+    ]
+    logging.info(
+        f"  - {len(scenes) - len(pending)} of the {len(scenes)} scenes already done"
+    )
+    write_manifest()
+
+    model = copy.deepcopy(model).cpu().eval()
+    model.share_memory()
+    start_time = time.perf_counter()
+    context = torch.multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=context,
+        initializer=_init_worker,
+        initargs=(model, num_threads),
+    ) as executor:
+        futures = {
+            executor.submit(
+                reconstruct_scene,
+                scene,
+                data_config,
+                root,
+                checkpoint_tiles,
+                metrics_config,
+            ): scene["name"]
+            for scene in pending
+        }
+        for future in concurrent.futures.as_completed(futures):
+            progress = future.result()
+            write_manifest()
+            logging.info(
+                f"  - {progress['name']} done : {progress['num_tiles']} tiles in "
+                f"{progress['seconds']:.1f} s"
+            )
+    wall_time = time.perf_counter() - start_time
+
+    scene_reports = []
+    for scene in scenes:
+        progress = read_progress(root, scene["name"])
+        scene_reports.append(
+            {
+                "name": scene["name"],
+                "num_tiles": progress["num_tiles"],
+                "tiles_this_run": progress["tiles_done"] - tiles_before[scene["name"]],
+                "seconds": progress["seconds"],
+                "tiles_per_second": progress["num_tiles"]
+                / max(progress["seconds"], 1e-9),
+            }
+        )
+    tiles_this_run = sum(report["tiles_this_run"] for report in scene_reports)
+    report = {
+        "num_scenes": len(scenes),
+        "num_workers": num_workers,
+        "threads_per_worker": num_threads,
+        "tiles_this_run": tiles_this_run,
+        "wall_seconds": wall_time,
+        "tiles_per_second": tiles_this_run / max(wall_time, 1e-9),
+        "scenes": scene_reports,
+    }
+    write_json(root / "batch_report.json", report)
+    logging.info(
+        f"  - {tiles_this_run} tiles reconstructed in {wall_time:.1f} s, "
+        f"{report['tiles_per_second']:.2f} tiles/s"
+    )
+    return report
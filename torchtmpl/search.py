@@ -0,0 +1,305 @@
+# coding: utf-8
+
+# Standard imports
+import copy
+import json
+import time
+
+# External imports
+import numpy as np
+import torch
+
+# Local imports
+from . import data as dt
+
+
+def tile_embeddings(model, scene, tile_size, batch_size=64, device=torch.device("cpu")):
+    """
+    Computes one descriptor per non overlapping tile of a scene by pooling the
+    outputs of the encoder: the mean and the standard deviation over space of
+    the amplitude of every latent channel, L2 normalized. Being built on
+    amplitudes, the descriptor does not depend on the absolute phase of the tile.
+
+    Arguments:
+        model: the trained model, exposing encode
+        scene: the (C, H, W) complex scene, in the domain of the model inputs
+        tile_size: the side of the tiles
+        batch_size: the number of tiles encoded at once
+        device: the device on which to run the encoder
+
+    Returns:
+        The (N, D) float32 descriptors and the (N, 2) (row, col) of the top left corner of the tiles
+    """
+    model = copy.deepcopy(model).to(device).eval()
+    patches = dt.InMemoryPatches(
+        torch.as_tensor(scene), (tile_size, tile_size), (tile_size, tile_size)
+    )
+    vectors = []
+    with torch.no_grad():
+        for indices in torch.arange(len(patches)).split(batch_size):
+            amplitudes = model.encode(patches.gather(indices).to(device)).abs()
+            vectors.append(
+                torch.cat((amplitudes.mean(dim=(2, 3)), amplitudes.std(dim=(2, 3))), dim=1)
+                .float()
+                .cpu()
+            )
+    vectors = torch.nn.functional.normalize(torch.cat(vectors), dim=1)
+
+    indices = torch.arange(len(patches))
+    coordinates = torch.stack(
+        (
+            (indices // patches.nsamples_per_cols) * tile_size,
+            (indices % patches.nsamples_per_cols) * tile_size,
+        ),
+        dim=1,
+    )
+    return vectors, coordinates
+
+
+def nearest_centroids(x, centroids, chunk_size=65536):
+    """Returns the index of the closest centroid of every row of x"""
+    return torch.cat(
+        [torch.cdist(chunk, centroids).argmin(dim=1) for chunk in x.split(chunk_size)]
+    )
+
+
+def kmeans(x, num_clusters, num_iterations=20, seed=0):
+    """
+    Lloyd's k-means, the sums and counts of the clusters being computed with
+    index_add and bincount. An empty cluster keeps its previous centroid.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    centroids = x[torch.randperm(len(x), generator=generator)[:num_clusters]].clone()
+    for _ in range(num_iterations):
+        assignment = nearest_centroids(x, centroids)
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, x)
+        counts = torch.bincount(assignment, minlength=num_clusters)
+        centroids = torch.where(
+            (counts > 0)[:, None], sums / counts.clamp(min=1)[:, None], centroids
+        )
+    return centroids
+
+
+def exact_search(vectors, queries, k):
+    """Brute force k nearest neighbours, returns the (Q, k) distances and indices"""
+    distances = torch.cdist(queries, vectors)
+    k = min(k, len(vectors))
+    distances, indices = distances.topk(k, dim=1, largest=False)
+    return distances.square(), indices
+
+
+class IVFPQIndex:
+    """
+    Inverted file index with product quantization of the residuals.
+
+    The vectors are assigned to the closest of `num_lists` coarse centroids and
+    the residual to this centroid is split into `num_subquantizers` sub-vectors,
+    each encoded by the index of its closest sub-centroid on one byte. A query
+    only visits the `nprobe` closest lists and estimates the distances from
+    per-list lookup tables. Optionally, the vectors are also kept in float16 to
+    rerank exactly a shortlist of `rerank` x k candidates.
+
+    The codebooks are learned by `train` on a first batch of vectors, new
+    scenes are then added incrementally with `add`.
+
+    Arguments:
+        num_lists: the number of coarse centroids
+        num_subquantizers: the number of sub-vectors, must divide the dimension
+        nprobe: the default number of lists visited per query
+        rerank: the size of the shortlist reranked exactly, in multiples of k, 0 to disable
+    """
+
+    def __init__(self, num_lists=64, num_subquantizers=32, nprobe=8, rerank=0):
+        self.num_lists = num_lists
+        self.num_subquantizers = num_subquantizers
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.vectors = None
+        self.centroids = None
+        self.pq_centroids = None
+        self.list_codes = []
+        self.list_ids = []
+        self.metadata = []
+
+    def __len__(self):
+        return len(self.metadata)
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def train(self, vectors, num_iterations=20):
+        dim = vectors.shape[1]
+        if dim % self.num_subquantizers != 0:
+            raise ValueError(
+                f"{self.num_subquantizers} subquantizers do not divide the dimension {dim}"
+            )
+        self.num_lists = min(self.num_lists, len(vectors))
+        self.centroids = kmeans(vectors, self.num_lists, num_iterations)
+        residuals = vectors - self.centroids[nearest_centroids(vectors, self.centroids)]
+        num_codes = min(256, len(vectors))
+        self.pq_centroids = torch.stack(
+            [
+                kmeans(sub_residuals.contiguous(), num_codes, num_iterations)
+                for sub_residuals in residuals.chunk(self.num_subquantizers, dim=1)
+            ]
+        )  # num_subquantizers, num_codes, dsub
+        self.list_codes = [
+            torch.zeros((0, self.num_subquantizers), dtype=torch.uint8)
+            for _ in range(self.num_lists)
+        ]
+        self.list_ids = [
+            torch.zeros((0,), dtype=torch.long) for _ in range(self.num_lists)
+        ]
+        self.vectors = torch.zeros((0, dim if self.rerank > 0 else 0), dtype=torch.float16)
+
+    def encode(self, vectors):
+        """Returns the coarse list and the (N, num_subquantizers) codes of the vectors"""
+        assignment = nearest_centroids(vectors, self.centroids)
+        residuals = vectors - self.centroids[assignment]
+        codes = torch.stack(
+            [
+                nearest_centroids(sub_residuals.contiguous(), codebook)
+                for sub_residuals, codebook in zip(
+                    residuals.chunk(self.num_subquantizers, dim=1), self.pq_centroids
+                )
+            ],
+            dim=1,
+        ).to(torch.uint8)
+        return assignment, codes
+
+    def add(self, vectors, metadata):
+        """
+        Adds the vectors to the index
+
+        Arguments:
+            vectors: the (N, D) vectors
+            metadata: the N json serializable descriptions of the vectors, e.g. [scene, row, col]
+        """
+        if not self.is_trained:
+            self.train(vectors)
+        ids = torch.arange(len(self.metadata), len(self.metadata) + len(vectors))
+        assignment, codes = self.encode(vectors)
+        for list_idx in assignment.unique().tolist():
+            mask = assignment == list_idx
+            self.list_codes[list_idx] = torch.cat((self.list_codes[list_idx], codes[mask]))
+            self.list_ids[list_idx] = torch.cat((self.list_ids[list_idx], ids[mask]))
+        if self.rerank > 0:
+            self.vectors = torch.cat((self.vectors, vectors.half()))
+        self.metadata.extend(metadata)
+        return ids
+
+    def search(self, queries, k, nprobe=None):
+        """
+        Approximate k nearest neighbours of the (Q, D) queries. The lists are
+        visited one after the other, each for all the queries probing it at once.
+
+        Returns:
+            The (Q, k) estimated squared distances and ids, padded with inf and -1
+        """
+        nprobe = min(nprobe or self.nprobe, self.num_lists)
+        probes = torch.cdist(queries, self.centroids).topk(
+            nprobe, dim=1, largest=False
+        )
+        shortlist = k * self.rerank if self.rerank > 0 else k
+        best_distances = torch.full((len(queries), shortlist), float("inf"))
+        best_ids = torch.full((len(queries), shortlist), -1, dtype=torch.long)
+        subquantizers = torch.arange(self.num_subquantizers)
+
+        for list_idx in probes.indices.unique().tolist():
+            codes = self.list_codes[list_idx]
+            if len(codes) == 0:
+                continue
+            query_idx = (probes.indices == list_idx).any(dim=1).nonzero().squeeze(1)
+            residuals = (queries[query_idx] - self.centroids[list_idx]).view(
+                len(query_idx), self.num_subquantizers, 1, -1
+            )
+            # (Q', num_subquantizers, num_codes) lookup tables of the partial distances
+            tables = (residuals - self.pq_centroids).square().sum(dim=-1)
+            distances = tables[:, subquantizers, codes.long()].sum(dim=-1)  # Q', n
+
+            # Merge with the best candidates found so far
+            distances = torch.cat((best_distances[query_idx], distances), dim=1)
+            ids = torch.cat(
+                (best_ids[query_idx], self.list_ids[list_idx].expand(len(query_idx), -1)),
+                dim=1,
+            )
+            top = distances.topk(shortlist, dim=1, largest=False)
+            best_distances[query_idx] = top.values
+            best_ids[query_idx] = ids.gather(1, top.indices)
+
+        if self.rerank > 0:
+            candidates = self.vectors[best_ids.clamp(min=0)].float()
+            distances = (queries[:, None, :] - candidates).square().sum(dim=-1)
+            distances = torch.where(best_ids >= 0, distances, float("inf"))
+            top = distances.topk(k, dim=1, largest=False)
+            best_distances = top.values
+            best_ids = best_ids.gather(1, top.indices)
+        return best_distances, best_ids
+
+    def save(self, path):
+        list_sizes = [len(ids) for ids in self.list_ids]
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                num_lists=self.num_lists,
+                num_subquantizers=self.num_subquantizers,
+                nprobe=self.nprobe,
+                rerank=self.rerank,
+                vectors=self.vectors.numpy(),
+                centroids=self.centroids.numpy(),
+                pq_centroids=self.pq_centroids.numpy(),
+                list_sizes=np.array(list_sizes, dtype=np.int64),
+                codes=torch.cat(self.list_codes).numpy(),
+                ids=torch.cat(self.list_ids).numpy(),
+                metadata=json.dumps(self.metadata),
+            )
+
+    @classmethod
+    def load(cls, path):
+        archive = np.load(path)
+        index = cls(
+            int(archive["num_lists"]),
+            int(archive["num_subquantizers"]),
+            int(archive["nprobe"]),
+            int(archive["rerank"]),
+        )
+        index.vectors = torch.from_numpy(archive["vectors"])
+        index.centroids = torch.from_numpy(archive["centroids"])
+        index.pq_centroids = torch.from_numpy(archive["pq_centroids"])
+        list_sizes = archive["list_sizes"].tolist()
+        index.list_codes = list(torch.from_numpy(archive["codes"]).split(list_sizes))
+        index.list_ids = list(torch.from_numpy(archive["ids"]).split(list_sizes))
+        index.metadata = json.loads(str(archive["metadata"]))
+        return index
+
+
+def benchmark_index(index, vectors, queries, k=10, nprobe=None):
+    """
+    Compares the index with the brute force search over `vectors`, which must
+    hold the vectors of the index in the order of their ids
+
+    Returns:
+        The recall at k of the index and the mean latency per query of both searches
+    """
+    start_time = time.perf_counter()
+    _, exact_ids = exact_search(vectors, queries, k)
+    exact_time = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    _, approximate_ids = index.search(queries, k, nprobe)
+    approximate_time = time.perf_counter() - start_time
+
+    hits = sum(
+        len(set(exact.tolist()) & set(approximate.tolist()))
+        for exact, approximate in zip(exact_ids, approximate_ids)
+    )
+    return {
+        "num_vectors": len(vectors),
+        "num_queries": len(queries),
+        "k": k,
+        "nprobe": min(nprobe or index.nprobe, index.num_lists),
+        "recall_at_k": hits / exact_ids.numel(),
+        "exact_ms_per_query": 1e3 * exact_time / len(queries),
+        "index_ms_per_query": 1e3 * approximate_time / len(queries),
+    }
@@ -49,6 +49,7 @@ def train_epoch(
     optim: torch.optim.Optimizer,
     device: torch.device,
     config,
+    on_batch=None,
 ) -> Tuple[float, float]:
     """
     Run the training loop for nsteps minibatches of the dataloader
@@ -59,6 +60,8 @@ def train_epoch(
         f_loss (nn.Module): the loss
         optim : an optimizing algorithm
         device: the device on which to run the code
+        on_batch: an optional function called with the number of batches
+                  done after every update, e.g. to checkpoint the position
 
     Returns:
         The averaged training loss
@@ -69,6 +72,7 @@ def train_epoch(
     loss_avg = 0
 
     num_samples = 0
+    num_batches = 0
     gradient_norm = 0
     for data in tqdm.tqdm(loader):
         if isinstance(data, tuple) or isinstance(data, list):
@@ -99,6 +103,9 @@ def train_epoch(
         gradient_norm += total_norm
 
         optim.step()
+        num_batches += 1
+        if on_batch is not None:
+            on_batch(num_batches)
 
         num_samples += inputs.shape[0]
 
@@ -160,7 +167,28 @@ def one_forward(
     model,
     loader,
     device,
+    metrics=None,
+    renderer=None,
+    keep_outputs=True,
+    cache=None,
 ):
+    """
+    Reconstructs every sample of the loader
+
+    Arguments:
+        model: the model to evaluate
+        loader: an iterable dataloader
+        device: the device on which to run the code
+        metrics: an optional StreamingMetrics updated with every batch
+        renderer: an optional SceneRenderer updated with every batch
+        keep_outputs: whether to return the reconstructions, which can be
+                      disabled when only the metrics are needed
+        cache: an optional TileCache, from which the tiles already
+               reconstructed by the model are read
+
+    Returns:
+        The list of the reconstructed batches, as numpy arrays
+    """
 
     outputs = []
     model.eval()
@@ -174,9 +202,17 @@ def one_forward(
             inputs = Variable(inputs).to(device)
             # Forward propagate through the model
 
-            pred_outputs = model(inputs)
-
-            outputs.append(pred_outputs.cpu().detach().numpy())
+            if cache is not None:
+                pred_outputs = cache.forward(model, inputs)
+            else:
+                pred_outputs = model(inputs)
+
+            if metrics is not None:
+                metrics.update(inputs.cpu().numpy(), pred_outputs.cpu().numpy())
+            if renderer is not None:
+                renderer.update(inputs.cpu().numpy(), pred_outputs.cpu().numpy())
+            if keep_outputs:
+                outputs.append(pred_outputs.cpu().detach().numpy())
 
     return outputs
 